@@ -0,0 +1,216 @@
+# Benchmark parsing a page of large reports, and encoding it, as opencti_reports_lookup does at the
+# full level of detail.
+#
+# The reports are built by the stub server's fixtures (see stub_server.py), as pycti returns
+# them, and each run goes through the same steps as the tool: forgetting cached misses for every
+# object, parsing the reports, fitting them into the size budget, storing them in the response
+# cache, and FastMCP's encoding of the response. Each step is timed, and its peak memory
+# allocation measured with tracemalloc, once with each of the available JSON encoders (see
+# pycti_mcp.encoding).
+#
+#   python benchmarks/encode.py --objects 5000 --output encode.json
+#   python benchmarks/encode.py --objects 5000 --compare encode.json
+#
+# The results are printed, and written as JSON with --output. With --compare, the results are
+# compared with an earlier run, and the exit status is 1 if any median time or peak regressed
+# by more than --threshold.
+import argparse
+import json
+import platform
+import statistics
+import sys
+import time
+import tracemalloc
+from datetime import datetime, timezone
+
+from pydantic_core import to_json
+
+from pycti_mcp import encoding
+from pycti_mcp.cache import (
+    ResponseCache,
+    forget_misses,
+    get_negative_cache,
+    make_key,
+)
+from pycti_mcp.pycti_tools.lookup_reports import (
+    content_types,
+    count_alias,
+    fit_reports,
+    parse_rpt,
+)
+
+import stub_server
+
+
+# A report as pycti returns it: its connections flattened into lists of their nodes
+def pycti_report(r):
+    rpt = dict(stub_server.report(r))
+    for field in ("objects", "externalReferences"):
+        rpt[field] = [edge["node"] for edge in rpt[field]["edges"]]
+    for t in content_types:
+        rpt[count_alias(t)] = {"pageInfo": {"globalCount": 1}}
+    return rpt
+
+
+def forget(reports):
+    forget_misses(
+        *[
+            term
+            for rpt in reports
+            for o in rpt["objects"]
+            for term in (
+                o["id"],
+                o.get("standard_id"),
+                o.get("observable_value"),
+                o.get("value"),
+                o.get("name"),
+            )
+        ]
+    )
+
+
+def parse(reports):
+    return [parse_rpt(rpt, "full") for rpt in reports]
+
+
+def fit(parsed):
+    # A budget the page fits in, so that every object is measured
+    page = {"has_more": False, "next_cursor": None}
+    return fit_reports(parsed, [None] * len(parsed), None, page, 1 << 30)[0]
+
+
+def cache(result):
+    ResponseCache(max_bytes=1 << 30).put("page", result, 60)
+
+
+def respond(result):
+    return to_json(result)
+
+
+def measure(fn, arg, runs):
+    """The median time taken by fn(arg), and the peak memory it allocated"""
+    fn(arg)
+    seconds = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        fn(arg)
+        seconds.append(time.perf_counter() - start)
+
+    tracemalloc.start()
+    fn(arg)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return statistics.median(seconds), peak
+
+
+def print_result(r):
+    print(
+        f"{r['encoder']:<8} {r['step']:<8} median={r['median_ms']:8.2f}ms "
+        f"peak={r['peak_kib']:9.1f}KiB",
+        flush=True,
+    )
+
+
+def compare(baseline, results, threshold):
+    """Print the change in median time and peak memory from the baseline, returning the number
+    of regressions beyond the threshold"""
+    old = {(r["encoder"], r["step"]): r for r in baseline["results"]}
+    regressions = 0
+    for r in results:
+        b = old.get((r["encoder"], r["step"]))
+        if b is None:
+            continue
+        changes = [
+            r["median_ms"] / b["median_ms"] - 1,
+            r["peak_kib"] / b["peak_kib"] - 1 if b["peak_kib"] else 0,
+        ]
+        regressed = any(change > threshold for change in changes)
+        regressions += regressed
+        print(
+            f"{r['encoder']:<8} {r['step']:<8} median {changes[0]:+7.1%} "
+            f"peak {changes[1]:+7.1%}" + ("  REGRESSION" if regressed else "")
+        )
+    return regressions
+
+
+def main():
+    ap = argparse.ArgumentParser(
+        description="Benchmark parsing and encoding a page of large reports"
+    )
+    ap.add_argument(
+        "--objects",
+        type=int,
+        default=5000,
+        help="Objects in each report (default 5000)",
+    )
+    ap.add_argument(
+        "--reports", type=int, default=5, help="Reports in the page (default 5)"
+    )
+    ap.add_argument(
+        "--runs", type=int, default=10, help="Runs of each step (default 10)"
+    )
+    ap.add_argument("--output", help="Write the results, as JSON, to this file")
+    ap.add_argument("--compare", help="Compare with the results of an earlier run")
+    ap.add_argument(
+        "--threshold",
+        type=float,
+        default=0.10,
+        help="Fractional change counted as a regression by --compare (default 0.10)",
+    )
+    args = ap.parse_args()
+
+    stub_server.StubConfig.report_objects = args.objects
+    reports = [pycti_report(r) for r in range(args.reports)]
+    # A miss is cached, as they usually are, so that forgetting them has to look for each object
+    get_negative_cache().put(make_key("opencti_observable_lookup", "-"), None, 3600)
+
+    encoders = ["json"] if encoding.orjson is None else ["json", "orjson"]
+
+    results = []
+    for name in encoders:
+        encoding.use_encoder(name)
+        parsed = parse(reports)
+        result = fit(parsed)
+        for step, fn, arg in [
+            ("forget", forget, reports),
+            ("parse", parse, reports),
+            ("fit", fit, parsed),
+            ("cache", cache, result),
+            ("respond", respond, result),
+        ]:
+            seconds, peak = measure(fn, arg, args.runs)
+            results.append(
+                {
+                    "encoder": name,
+                    "step": step,
+                    "median_ms": seconds * 1000,
+                    "peak_kib": peak / 1024,
+                }
+            )
+            print_result(results[-1])
+
+    report = {
+        "meta": {
+            "timestamp": datetime.now(timezone.utc).isoformat(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "response_bytes": len(respond(result)),
+            "args": {k: v for k, v in vars(args).items() if k not in ("compare",)},
+        },
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+    failed = False
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        print(f"\nCompared with {args.compare} ({baseline['meta']['timestamp']}):")
+        failed = compare(baseline, results, args.threshold) > 0
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,310 @@
+# Benchmark the MCP tools against the stub OpenCTI server (see stub_server.py).
+#
+# The stub runs in its own process, so that generating its responses doesn't compete with the
+# MCP server for the GIL. The tools are registered exactly as the pycti-mcp command does, and
+# called through an in-memory FastMCP client, at each of the requested concurrency levels.
+#
+#   python benchmarks/run.py --latency 20 --concurrency 1,8,32 --output results.json
+#   python benchmarks/run.py --compare results.json
+#
+# The results are printed as a table, and written as JSON with --output. With --compare, the
+# results are compared with an earlier run, and the exit status is 1 if any p95 latency or
+# throughput regressed by more than --threshold.
+import argparse
+import asyncio
+import json
+import logging
+import platform
+import resource
+import subprocess
+import sys
+import time
+from datetime import datetime, timezone
+from pathlib import Path
+
+from fastmcp import Client, FastMCP
+
+from pycti_mcp.cache import CacheConfig
+from pycti_mcp.client_pool import PoolConfig
+from pycti_mcp.executor import ExecutorConfig
+from pycti_mcp.mcp_server_octi import register_tools
+from pycti_mcp.metrics import get_metrics
+from pycti_mcp.mirror import fresh_mirror, get_mirror, run_mirror
+
+from stub_server import StubConfig, observable_value
+
+
+# The arguments for the i'th call of each tool. A quarter of the observable lookups are for
+# values the stub doesn't know, so that both the found and not-found paths are measured.
+def observable_args(i):
+    if i % 4 == 3:
+        return {"observable": f"192.0.2.{i % 256}"}
+    return {"observable": observable_value(i * 7919 % StubConfig.observables)}
+
+
+scenarios = {
+    "opencti_observable_lookup": observable_args,
+    "opencti_observable_bulk_lookup": lambda i: {
+        "observables": [
+            observable_value((i * 200 + j) % StubConfig.observables) for j in range(200)
+        ]
+    },
+    "opencti_indicator_lookup": lambda i: {"pattern_search_strings": ["evil"]},
+    "opencti_adversary_lookup": lambda i: {"name": f"APT{i % StubConfig.adversaries}"},
+    "opencti_reports_lookup": lambda i: {"limit": 5, "earliest": "2024-01-01"},
+    "opencti_report_contents": lambda i: {
+        "report_id": f"report-{i % StubConfig.reports}",
+        "entity_types": ["Indicator", "Stix-Cyber-Observable"],
+        "limit": 100,
+    },
+}
+
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return None
+    k = max(0, min(len(sorted_values) - 1, round(p / 100 * len(sorted_values)) - 1))
+    return sorted_values[k]
+
+
+def peak_rss_mb():
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in KiB on Linux, but bytes on macOS
+    return rss / (1024 * 1024) if sys.platform == "darwin" else rss / 1024
+
+
+async def run_scenario(client, tool, concurrency, requests):
+    make_args = scenarios[tool]
+    latencies = []
+    errors = 0
+    sem = asyncio.Semaphore(concurrency)
+    before = get_metrics().stats().get(tool, {})
+
+    async def call(i):
+        nonlocal errors
+        async with sem:
+            start = time.perf_counter()
+            try:
+                result = await client.call_tool(
+                    tool, make_args(i), raise_on_error=False
+                )
+                if result.is_error:
+                    errors += 1
+            except Exception:
+                errors += 1
+            latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*[call(i) for i in range(requests)])
+    elapsed = time.perf_counter() - start
+
+    after = get_metrics().stats().get(tool, {})
+    latencies.sort()
+    ms = [t * 1000 for t in latencies]
+    return {
+        "tool": tool,
+        "concurrency": concurrency,
+        "requests": requests,
+        "errors": errors,
+        "p50_ms": percentile(ms, 50),
+        "p95_ms": percentile(ms, 95),
+        "p99_ms": percentile(ms, 99),
+        "mean_ms": sum(ms) / len(ms),
+        "throughput_rps": requests / elapsed,
+        "upstream_requests": after.get("round_trips", 0) - before.get("round_trips", 0),
+        "upstream_response_bytes": after.get("response_bytes", 0)
+        - before.get("response_bytes", 0),
+        "peak_rss_mb": peak_rss_mb(),
+    }
+
+
+def start_stub(args):
+    cmd = [
+        sys.executable,
+        str(Path(__file__).with_name("stub_server.py")),
+        "--latency",
+        str(args.latency),
+        "--jitter",
+        str(args.jitter),
+        "--report-objects",
+        str(args.report_objects),
+        "--adversary-reports",
+        str(args.adversary_reports),
+        "--indicators",
+        str(args.indicators),
+    ]
+    stub = subprocess.Popen(cmd, stdout=subprocess.PIPE, text=True)
+    url = stub.stdout.readline().strip()
+    if not url:
+        stub.kill()
+        raise RuntimeError("The stub OpenCTI server failed to start")
+    return stub, url
+
+
+# The tools' log messages to the client would swamp the results
+async def ignore_log(message):
+    pass
+
+
+async def load_mirror(url):
+    start = time.perf_counter()
+    job = asyncio.create_task(run_mirror(url, "benchmark"))
+    while fresh_mirror() is None:
+        if job.done():
+            job.result()
+        await asyncio.sleep(0.1)
+    print(
+        f"Loaded the mirror in {time.perf_counter() - start:.1f}s: "
+        f"{get_mirror().stats()['entities']}",
+        flush=True,
+    )
+    return job
+
+
+async def run(args, url):
+    mcp = FastMCP("OpenCTI.MCP")
+    register_tools(mcp, url, "benchmark")
+    if args.mirror:
+        await load_mirror(url)
+
+    results = []
+    async with Client(mcp, log_handler=ignore_log) as client:
+        for tool in args.tools:
+            # Warm up: creates the pooled clients, and imports anything loaded lazily
+            for i in range(args.pool_size):
+                await client.call_tool(tool, scenarios[tool](i), raise_on_error=False)
+
+            for concurrency in args.concurrency:
+                result = await run_scenario(client, tool, concurrency, args.requests)
+                results.append(result)
+                print_result(result)
+    return results
+
+
+def print_result(r):
+    print(
+        f"{r['tool']:<32} c={r['concurrency']:<4} "
+        f"p50={r['p50_ms']:9.1f}ms p95={r['p95_ms']:9.1f}ms p99={r['p99_ms']:9.1f}ms "
+        f"{r['throughput_rps']:8.1f} req/s  errors={r['errors']}  "
+        f"upstream={r['upstream_requests']}  rss={r['peak_rss_mb']:.0f}MiB",
+        flush=True,
+    )
+
+
+def compare(baseline, results, threshold):
+    """Print the change in p95 latency and throughput from the baseline, returning the number
+    of regressions beyond the threshold"""
+    old = {(r["tool"], r["concurrency"]): r for r in baseline["results"]}
+    regressions = 0
+    for r in results:
+        b = old.get((r["tool"], r["concurrency"]))
+        if b is None:
+            continue
+        p95 = r["p95_ms"] / b["p95_ms"] - 1
+        rps = r["throughput_rps"] / b["throughput_rps"] - 1
+        regressed = p95 > threshold or rps < -threshold
+        regressions += regressed
+        print(
+            f"{r['tool']:<32} c={r['concurrency']:<4} "
+            f"p95 {p95:+7.1%}  throughput {rps:+7.1%}"
+            + ("  REGRESSION" if regressed else "")
+        )
+    return regressions
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Benchmark the pycti-mcp tools")
+    ap.add_argument(
+        "--tools",
+        type=lambda s: s.split(","),
+        default=list(scenarios),
+        help="Comma-separated tools to benchmark (default: all)",
+    )
+    ap.add_argument(
+        "--concurrency",
+        type=lambda s: [int(c) for c in s.split(",")],
+        default=[1, 4, 16],
+        help="Comma-separated concurrency levels (default 1,4,16)",
+    )
+    ap.add_argument(
+        "--requests",
+        type=int,
+        default=50,
+        help="Tool calls per tool and concurrency level (default 50)",
+    )
+    ap.add_argument(
+        "--latency",
+        type=float,
+        default=10.0,
+        help="Stub server latency per request, in milliseconds (default 10)",
+    )
+    ap.add_argument(
+        "--jitter",
+        type=float,
+        default=0.0,
+        help="Random extra stub server latency, up to this many milliseconds (default 0)",
+    )
+    ap.add_argument("--report-objects", type=int, default=StubConfig.report_objects)
+    ap.add_argument(
+        "--adversary-reports", type=int, default=StubConfig.adversary_reports
+    )
+    ap.add_argument("--indicators", type=int, default=StubConfig.indicators)
+    ap.add_argument("--pool-size", type=int, default=8)
+    ap.add_argument(
+        "--cache",
+        default=False,
+        action="store_true",
+        help="Leave the response cache enabled (default: off, so every call reaches the stub)",
+    )
+    ap.add_argument(
+        "--mirror",
+        default=False,
+        action="store_true",
+        help="Load a local mirror of the stub before calling the tools, so that they answer from it",
+    )
+    ap.add_argument("--output", help="Write the results, as JSON, to this file")
+    ap.add_argument("--compare", help="Compare with the results of an earlier run")
+    ap.add_argument(
+        "--threshold",
+        type=float,
+        default=0.10,
+        help="Fractional change counted as a regression by --compare (default 0.10)",
+    )
+    args = ap.parse_args()
+
+    for tool in args.tools:
+        if tool not in scenarios:
+            ap.error(f"Unknown tool {tool}")
+
+    logging.basicConfig(level="WARN")
+    logging.getLogger("fastmcp").setLevel("WARN")
+    PoolConfig.pool_size = args.pool_size
+    ExecutorConfig.max_workers = args.pool_size
+    CacheConfig.enabled = args.cache
+
+    stub, url = start_stub(args)
+    try:
+        results = asyncio.run(run(args, url))
+    finally:
+        stub.kill()
+
+    report = {
+        "meta": {
+            "timestamp": datetime.now(timezone.utc).isoformat(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "args": {k: v for k, v in vars(args).items() if k not in ("compare",)},
+        },
+        "results": results,
+    }
+    if args.output:
+        Path(args.output).write_text(json.dumps(report, indent=2))
+
+    if args.compare:
+        baseline = json.loads(Path(args.compare).read_text())
+        if compare(baseline, results, args.threshold):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,211 @@
+# Benchmark the cold start of the pycti-mcp command, as an editor spawning it over stdio sees it.
+#
+# Each run starts a fresh server process, and times how long it takes to answer the MCP
+# initialize request, and then tools/list. The import time of the server module, and of
+# fastmcp alone (which the server can't start any faster than), are measured in fresh
+# processes too. No OpenCTI server is needed: none is contacted until a tool is called.
+#
+#   python benchmarks/startup.py --runs 10 --output startup.json
+#   python benchmarks/startup.py --compare startup.json
+#
+# The results are printed, and written as JSON with --output. With --compare, the results are
+# compared with an earlier run, and the exit status is 1 if any median regressed by more than
+# --threshold. With --max-ms, the exit status is 1 if the median time from spawning the server
+# to its tools/list response exceeds it.
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import time
+from datetime import datetime, timezone
+
+SERVER = [sys.executable, "-c", "from pycti_mcp.cli import main; main()"]
+
+
+def percentile(sorted_values, p):
+    k = max(0, min(len(sorted_values) - 1, round(p / 100 * len(sorted_values)) - 1))
+    return sorted_values[k]
+
+
+def import_seconds(module):
+    """The time taken to import the module in a fresh interpreter"""
+    out = subprocess.run(
+        [
+            sys.executable,
+            "-c",
+            "import time; t = time.perf_counter(); "
+            f"import {module}; print(time.perf_counter() - t)",
+        ],
+        check=True,
+        capture_output=True,
+        text=True,
+    )
+    return float(out.stdout)
+
+
+def handshake_seconds():
+    """Spawn the server, and return the times from spawning it to its initialize and tools/list
+    responses"""
+    env = dict(os.environ, OPENCTI_URL="http://localhost:8080", OPENCTI_KEY="startup")
+    start = time.perf_counter()
+    proc = subprocess.Popen(
+        SERVER,
+        stdin=subprocess.PIPE,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.DEVNULL,
+        env=env,
+        text=True,
+    )
+
+    def request(id_, method, params=None):
+        message = {"jsonrpc": "2.0", "id": id_, "method": method}
+        if params is not None:
+            message["params"] = params
+        proc.stdin.write(json.dumps(message) + "\n")
+        proc.stdin.flush()
+        # Skip any notifications (such as log messages) until the response arrives
+        while True:
+            line = proc.stdout.readline()
+            if not line:
+                raise RuntimeError(f"The server exited before answering {method}")
+            response = json.loads(line)
+            if response.get("id") == id_:
+                return response
+
+    try:
+        request(
+            1,
+            "initialize",
+            {
+                "protocolVersion": "2025-06-18",
+                "capabilities": {},
+                "clientInfo": {"name": "startup-benchmark", "version": "0"},
+            },
+        )
+        initialized = time.perf_counter() - start
+        proc.stdin.write(
+            json.dumps({"jsonrpc": "2.0", "method": "notifications/initialized"}) + "\n"
+        )
+        tools = request(2, "tools/list")
+        listed = time.perf_counter() - start
+    finally:
+        proc.kill()
+        proc.wait()
+
+    if not tools.get("result", {}).get("tools"):
+        raise RuntimeError(f"tools/list failed: {tools}")
+    return initialized, listed
+
+
+def summarize(name, seconds):
+    ms = sorted(s * 1000 for s in seconds)
+    return {
+        "measure": name,
+        "median_ms": statistics.median(ms),
+        "p95_ms": percentile(ms, 95),
+        "min_ms": ms[0],
+    }
+
+
+def print_result(r):
+    print(
+        f"{r['measure']:<28} median={r['median_ms']:8.1f}ms "
+        f"p95={r['p95_ms']:8.1f}ms min={r['min_ms']:8.1f}ms",
+        flush=True,
+    )
+
+
+def compare(baseline, results, threshold):
+    """Print the change in median from the baseline, returning the number of regressions
+    beyond the threshold"""
+    old = {r["measure"]: r for r in baseline["results"]}
+    regressions = 0
+    for r in results:
+        b = old.get(r["measure"])
+        if b is None:
+            continue
+        change = r["median_ms"] / b["median_ms"] - 1
+        regressed = change > threshold
+        regressions += regressed
+        print(
+            f"{r['measure']:<28} median {change:+7.1%}"
+            + ("  REGRESSION" if regressed else "")
+        )
+    return regressions
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Benchmark the pycti-mcp cold start")
+    ap.add_argument(
+        "--runs",
+        type=int,
+        default=10,
+        help="Fresh processes started for each measurement (default 10)",
+    )
+    ap.add_argument("--output", help="Write the results, as JSON, to this file")
+    ap.add_argument("--compare", help="Compare with the results of an earlier run")
+    ap.add_argument(
+        "--threshold",
+        type=float,
+        default=0.10,
+        help="Fractional change counted as a regression by --compare (default 0.10)",
+    )
+    ap.add_argument(
+        "--max-ms",
+        type=float,
+        help="Fail if the median time from spawning the server to its tools/list response exceeds this",
+    )
+    args = ap.parse_args()
+
+    # Warm the OS file cache first, so that the first run isn't an outlier
+    handshake_seconds()
+
+    fastmcp_import = [import_seconds("fastmcp") for _ in range(args.runs)]
+    server_import = [
+        import_seconds("pycti_mcp.mcp_server_octi") for _ in range(args.runs)
+    ]
+    handshakes = [handshake_seconds() for _ in range(args.runs)]
+    results = [
+        summarize("import fastmcp", fastmcp_import),
+        summarize("import server", server_import),
+        summarize("spawn to initialize", [h[0] for h in handshakes]),
+        summarize("spawn to tools/list", [h[1] for h in handshakes]),
+        summarize("initialize to tools/list", [h[1] - h[0] for h in handshakes]),
+    ]
+    for r in results:
+        print_result(r)
+
+    report = {
+        "meta": {
+            "timestamp": datetime.now(timezone.utc).isoformat(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "args": {k: v for k, v in vars(args).items() if k not in ("compare",)},
+        },
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+    failed = False
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        print(f"\nCompared with {args.compare} ({baseline['meta']['timestamp']}):")
+        failed = compare(baseline, results, args.threshold) > 0
+    if args.max_ms is not None:
+        listed = next(r for r in results if r["measure"] == "spawn to tools/list")
+        if listed["median_ms"] > args.max_ms:
+            print(
+                f"\nspawn to tools/list took {listed['median_ms']:.1f}ms, over {args.max_ms}ms"
+            )
+            failed = True
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,569 @@
+# A stand-in for the OpenCTI GraphQL API (and an idle OpenCTI stream), serving generated
+# fixtures, for benchmarking the MCP tools without a real OpenCTI platform. It answers the
+# queries which pycti builds for the tools (dispatching on the top-level field of the query),
+# and ignores their projections: every entity is returned with all of the fields any of the
+# tools could ask for.
+#
+# Run directly, it prints the URL it listens on, then serves until killed:
+#
+#   python benchmarks/stub_server.py --latency 20 --report-objects 5000
+import argparse
+import base64
+import json
+import random
+import re
+import socket
+import threading
+import time
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class StubConfig:
+    # Simulated server-side processing time for each request, in milliseconds
+    latency = 0.0
+    jitter = 0.0
+    observables = 5000
+    indicators = 2000
+    indicator_size = 4096
+    adversaries = 50
+    adversary_reports = 300
+    reports = 200
+    report_objects = 5000
+    seed = 1
+    # Seconds between the heartbeats sent on the stream
+    heartbeat_interval = 1.0
+
+
+object_types = [
+    ("IPv4-Addr", "StixCyberObservable"),
+    ("Domain-Name", "StixCyberObservable"),
+    ("StixFile", "StixCyberObservable"),
+    ("Url", "StixCyberObservable"),
+    ("Indicator", "Indicator"),
+    ("Malware", "Named"),
+    ("Attack-Pattern", "Named"),
+    ("Intrusion-Set", "Named"),
+    ("Vulnerability", "Named"),
+    ("stix-core-relationship", "Relationship"),
+]
+
+# The abstract types a report's objects can be filtered by, and the kinds of object under them
+abstract_types = {
+    "Stix-Cyber-Observable": ["StixCyberObservable"],
+    "Stix-Domain-Object": ["Indicator", "Named"],
+    "stix-core-relationship": ["Relationship"],
+}
+
+
+def type_matches(j, types):
+    entity_type, kind = object_types[j % len(object_types)]
+    return any(t == entity_type or kind in abstract_types.get(t, []) for t in types)
+
+
+def connection(nodes, offset=0, total=None):
+    total = len(nodes) if total is None else total
+    return {
+        # A node's cursor is the offset of the node after it, which the next page starts at
+        "edges": [
+            {"cursor": cursor(offset + i + 1), "node": n} for i, n in enumerate(nodes)
+        ],
+        "pageInfo": {
+            "startCursor": cursor(offset),
+            "endCursor": cursor(offset + len(nodes)),
+            "hasNextPage": offset + len(nodes) < total,
+            "hasPreviousPage": offset > 0,
+            "globalCount": total,
+        },
+    }
+
+
+def cursor(offset):
+    return base64.b64encode(str(offset).encode()).decode()
+
+
+def parse_cursor(after):
+    return int(base64.b64decode(after)) if after else 0
+
+
+def refs(prefix, count):
+    return connection(
+        [
+            {
+                "id": f"{prefix}-{i}",
+                "name": f"{prefix} {i}",
+                "published": f"2024-{1 + i % 12:02d}-{1 + i % 28:02d}T00:00:00Z",
+                "externalReferences": connection(
+                    [{"url": f"https://example.com/{prefix}/{i}"}]
+                ),
+            }
+            for i in range(count)
+        ]
+    )
+
+
+def common(entity_type, i, name):
+    return {
+        "id": f"{entity_type.lower()}-{i}",
+        "standard_id": f"{entity_type.lower()}--{i:08d}-0000-4000-8000-000000000000",
+        "entity_type": entity_type,
+        "name": name,
+        "description": f"Generated {entity_type} number {i}",
+        "created_at": "2024-01-01T00:00:00Z",
+        "updated_at": "2024-06-01T00:00:00Z",
+        "created": "2024-01-01T00:00:00Z",
+        "modified": "2024-06-01T00:00:00Z",
+        "confidence": 75,
+        "revoked": False,
+        "createdBy": {"id": "identity-1", "name": "Stub Feed"},
+        "objectLabel": [{"id": "label-1", "value": "stub"}],
+        "externalReferences": connection(
+            [{"url": f"https://example.com/{entity_type}/{i}"}]
+        ),
+        "cases": refs(f"{entity_type.lower()}-{i}-case", 1),
+        "groupings": refs(f"{entity_type.lower()}-{i}-grouping", 1),
+    }
+
+
+def observable(i):
+    o = common("IPv4-Addr", i, None)
+    o.update(
+        {
+            "observable_value": observable_value(i),
+            "x_opencti_description": f"Observed address {i}",
+            "x_opencti_score": 50,
+            "reports": refs(f"obs-{i}-report", 3),
+            "notes": connection([{"id": f"note-{i}", "content": "Seen in the wild"}]),
+            "opinions": connection(
+                [{"id": f"op-{i}", "opinion": "agree", "explanation": "Confirmed"}]
+            ),
+        }
+    )
+    return o
+
+
+def observable_value(i):
+    return f"10.{i >> 16 & 255}.{i >> 8 & 255}.{i & 255}"
+
+
+def indicator(i, rng):
+    # A YARA rule padded out with strings to the configured size
+    strings = []
+    while sum(len(s) for s in strings) < StubConfig.indicator_size:
+        strings.append(f'    $s{len(strings)} = "{rng.randbytes(16).hex()}"\n')
+    pattern = f"rule evil_{i} {{\n  strings:\n{''.join(strings)}  condition:\n    any of them\n}}"
+    ind = common("Indicator", i, f"evil_{i}")
+    ind.update(
+        {
+            # Each indicator was updated at a different time, so that the updated ones can be
+            # listed
+            "updated_at": f"2024-06-01T{i // 3600 % 24:02d}:{i // 60 % 60:02d}:{i % 60:02d}Z",
+            "pattern": pattern,
+            "pattern_type": "yara",
+            "pattern_version": "4.0",
+            "x_opencti_score": 80,
+            "x_opencti_detection": True,
+            "x_mitre_platforms": ["windows", "linux"],
+            "x_opencti_main_observable_type": "StixFile",
+            "x_opencti_observable_values": [
+                {"type": "file:hashes.SHA256", "value": rng.randbytes(32).hex()}
+            ],
+            "killChainPhases": [
+                {
+                    "id": "kcp-1",
+                    "kill_chain_name": "mitre-attack",
+                    "phase_name": "execution",
+                }
+            ],
+        }
+    )
+    return ind
+
+
+def adversary(i):
+    a = common("Intrusion-Set", i, f"APT{i}")
+    a.update(
+        {
+            "aliases": [f"Stub Group {i}", f"SG{i}"],
+            "first_seen": "2020-01-01T00:00:00Z",
+            "last_seen": "2024-06-01T00:00:00Z",
+            "goals": ["espionage"],
+            "resource_level": "government",
+            "primary_motivation": "organizational-gain",
+            "secondary_motivations": [],
+        }
+    )
+    return a
+
+
+def report_object(r, j):
+    entity_type, kind = object_types[j % len(object_types)]
+    o = {
+        "id": f"report-{r}-object-{j}",
+        "standard_id": f"{entity_type.lower()}--{r:04d}{j:08d}",
+        "entity_type": entity_type,
+        "parent_types": ["Basic-Object", "Stix-Object"],
+    }
+    if kind == "StixCyberObservable":
+        o["observable_value"] = f"value-{r}-{j}"
+    elif kind == "Indicator":
+        o.update(
+            {
+                "name": f"ind-{r}-{j}",
+                "pattern": f"[file:name = 'x{j}']",
+                "pattern_type": "stix",
+            }
+        )
+    elif kind == "Named":
+        o["name"] = f"{entity_type} {r}-{j}"
+    else:
+        o["relationship_type"] = "uses"
+    return o
+
+
+def report_published(r):
+    return f"2024-{1 + r % 12:02d}-{1 + r % 28:02d}T{r % 24:02d}:00:00Z"
+
+
+def report(r):
+    rpt = common("Report", r, f"Threat report {r}")
+    rpt.update(
+        {
+            "published": report_published(r),
+            "report_types": ["threat-report"],
+            "objects": connection(
+                [report_object(r, j) for j in range(StubConfig.report_objects)]
+            ),
+        }
+    )
+    return rpt
+
+
+def filter_conditions(filters, key):
+    """The (operator, value) of each filter on key anywhere in a FilterGroup"""
+    if not filters:
+        return []
+    conditions = []
+    for f in filters.get("filters") or []:
+        if f.get("key") == key:
+            operator = f.get("operator") or "eq"
+            conditions += [(operator, v) for v in f.get("values") or []]
+    for g in filters.get("filterGroups") or []:
+        conditions += filter_conditions(g, key)
+    return conditions
+
+
+# Compare the timestamps as strings, which is correct as long as they are all in UTC
+comparisons = {
+    "eq": lambda a, b: a == b,
+    "gt": lambda a, b: a > b,
+    "gte": lambda a, b: a >= b,
+    "lt": lambda a, b: a < b,
+    "lte": lambda a, b: a <= b,
+}
+
+
+def utc(ts):
+    return ts.replace("Z", "").replace("+00:00", "")
+
+
+def filter_values(filters, key):
+    """All of the values given for key anywhere in a FilterGroup"""
+    if not filters:
+        return []
+    values = []
+    for f in filters.get("filters") or []:
+        keys = f.get("key")
+        if keys == key or (isinstance(keys, list) and key in keys):
+            values += f.get("values") or []
+    for g in filters.get("filterGroups") or []:
+        values += filter_values(g, key)
+    return values
+
+
+class Fixtures:
+    def __init__(self):
+        rng = random.Random(StubConfig.seed)
+        self.observables = {}
+        for i in range(StubConfig.observables):
+            o = observable(i)
+            for k in (o["id"], o["standard_id"], o["observable_value"]):
+                self.observables[k] = o
+        self.indicators = [indicator(i, rng) for i in range(StubConfig.indicators)]
+        self.adversaries = {}
+        for i in range(StubConfig.adversaries):
+            a = adversary(i)
+            for k in [a["id"], a["standard_id"], a["name"]] + a["aliases"]:
+                self.adversaries[k] = a
+        # Reports are large, so they are built on demand and only the recent ones are kept
+        self._reports = OrderedDict()
+        self._lock = threading.Lock()
+
+    def report(self, r):
+        with self._lock:
+            rpt = self._reports.get(r)
+            if rpt is None:
+                rpt = self._reports[r] = report(r)
+                if len(self._reports) > 64:
+                    self._reports.popitem(last=False)
+            return rpt
+
+    def report_objects(self, r, types, first, offset):
+        # Only the matching objects' positions are counted, to avoid building the report
+        matching = [
+            j for j in range(StubConfig.report_objects) if type_matches(j, types)
+        ]
+        nodes = [report_object(r, j) for j in matching[offset : offset + first]]
+        return connection(nodes, offset, len(matching))
+
+    def answer(self, field, variables, query=""):
+        filters = variables.get("filters")
+        first = variables.get("first") or 100
+        offset = parse_cursor(variables.get("after"))
+
+        if field == "about":
+            return {"version": "6.7.0"}
+
+        if field == "stixCyberObservables":
+            found = {}
+            for key in ("value", "id", "standard_id"):
+                for v in filter_values(filters, key):
+                    o = self.observables.get(v)
+                    if o is not None:
+                        found[o["id"]] = o
+            if not filters:
+                found = {o["id"]: o for o in self.observables.values()}
+            nodes = list(found.values())
+            return connection(nodes[offset : offset + first], offset, len(nodes))
+
+        if field == "indicators":
+            # Every indicator contains "evil", so searches for it return large result sets
+            names = filter_values(filters, "name") + filter_values(filters, "id")
+            nodes = (
+                [i for i in self.indicators if i["name"] in names or i["id"] in names]
+                if names
+                else self.indicators
+            )
+            strings = [s.casefold() for s in filter_values(filters, "pattern")]
+            types = filter_values(filters, "pattern_type")
+            since = filter_values(filters, "updated_at")
+            nodes = [
+                i
+                for i in nodes
+                if all(s in i["pattern"].casefold() for s in strings)
+                and (not types or i["pattern_type"] in types)
+                and (not since or i["updated_at"] >= since[0])
+            ]
+            return connection(nodes[offset : offset + first], offset, len(nodes))
+
+        if field == "intrusionSets" and not filters:
+            # Listing every adversary, as the mirror's bulk load does
+            found = list({a["id"]: a for a in self.adversaries.values()}.values())
+            nodes = [self.enriched(a) for a in found[offset : offset + first]]
+            return connection(nodes, offset, len(found))
+
+        if field == "intrusionSets":
+            found = []
+            for name in (
+                filter_values(filters, "name")
+                + filter_values(filters, "aliases")
+                + filter_values(filters, "id")
+                + filter_values(filters, "standard_id")
+            ):
+                a = self.adversaries.get(name)
+                if a is not None and a["id"] not in [f["id"] for f in found]:
+                    found.append(self.enriched(a))
+            return connection(found[:first])
+
+        if field in ("campaigns", "threatActorsGroup", "threatActorsIndividuals"):
+            return connection([])
+
+        if field == "reports":
+            if filter_values(filters, "objects"):
+                # The reports containing an adversary
+                return refs("adv-report", min(first, StubConfig.adversary_reports))
+            # Reports can be filtered by their Ids and when they were published, and ordered
+            # by when they were published
+            ids = filter_values(filters, "id")
+            published = filter_conditions(filters, "published")
+            matching = [
+                r
+                for r in range(StubConfig.reports)
+                if (not ids or f"report-{r}" in ids)
+                and all(
+                    comparisons[op](utc(report_published(r)), utc(v))
+                    for op, v in published
+                )
+            ]
+            if variables.get("orderBy") == "published":
+                matching.sort(
+                    key=report_published,
+                    reverse=variables.get("orderMode") == "desc",
+                )
+            nodes = [self.report(r) for r in matching[offset : offset + first]]
+            counts = count_fields.findall(query)
+            if counts:
+                nodes = [dict(rpt) for rpt in nodes]
+                for rpt in nodes:
+                    r = int(rpt["id"].rpartition("-")[2])
+                    for alias, t in counts:
+                        rpt[alias] = self.report_objects(r, [t], 0, 0)
+            return connection(nodes, offset, len(matching))
+
+        if field == "report":
+            r = int(variables["id"].rpartition("-")[2])
+            if r >= StubConfig.reports:
+                return None
+            rpt = dict(self.report(r))
+            rpt["objects"] = self.report_objects(
+                r, variables.get("types") or [], first, offset
+            )
+            return rpt
+
+        if field == "notes":
+            return connection([{"id": "note-1", "content": "An analyst note"}] * 20)
+
+        if field == "opinions":
+            return connection(
+                [{"id": "op-1", "opinion": "agree", "explanation": "Matches"}] * 5
+            )
+
+        return None
+
+    def enriched(self, a):
+        # The connections the combined adversary query asks for on the adversary itself
+        a = dict(a)
+        a["reports"] = refs("adv-report", min(100, StubConfig.adversary_reports))
+        a["notes"] = self.answer("notes", {})
+        a["opinions"] = self.answer("opinions", {})
+        return a
+
+
+# A field selected by the query, with its alias and arguments if it has them
+field_at = re.compile(r"\s*(?:(\w+)\s*:\s*)?(\w+)\s*(?:\(([^)]*)\))?\s*\{")
+field_arg = re.compile(r"(\w+):\s*(\$?\w+)")
+
+
+def top_fields(query):
+    """The alias (or None), name, and arguments of each field selected at the top of the query"""
+    fields = []
+    depth = 0
+    for m in re.finditer(r"[{}]", query):
+        depth += 1 if m.group() == "{" else -1
+        if depth == 1:
+            field = field_at.match(query, m.end())
+            if field:
+                fields.append(field.groups())
+    return fields
+
+
+def field_variables(args, variables):
+    """The arguments given to a field, as the variables of a query selecting only that field.
+    Arguments given in the query itself are numbers or enum values."""
+    found = {}
+    for name, value in field_arg.findall(args or ""):
+        if value.startswith("$"):
+            found[name] = variables.get(value[1:])
+        else:
+            found[name] = int(value) if value.isdigit() else value
+    return found
+
+
+# The aliased, single-type objects connections which count a report's objects by type
+count_fields = re.compile(r'(\w+): objects\(types: \["([^"]+)"\]')
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    fixtures = None
+
+    def setup(self):
+        super().setup()
+        # The headers and body are written separately, so don't let Nagle's algorithm hold
+        # the body back waiting for an ACK
+        self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        variables = body.get("variables") or {}
+        fields = top_fields(body["query"])
+
+        delay = StubConfig.latency + random.uniform(0, StubConfig.jitter)
+        if delay:
+            time.sleep(delay / 1000)
+
+        if len(fields) == 1:
+            alias, field, _ = fields[0]
+            data = {
+                alias or field: self.fixtures.answer(field, variables, body["query"])
+            }
+        else:
+            # Several aliased fields, as when the reports containing each of many adversaries
+            # are listed at once
+            data = {
+                alias
+                or field: self.fixtures.answer(
+                    field, field_variables(args, variables), body["query"]
+                )
+                for alias, field, args in fields
+            }
+        payload = json.dumps({"data": data}).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def do_GET(self):
+        # The OpenCTI stream, which never has any changes to send, only heartbeats
+        if not self.path.startswith("/stream"):
+            self.send_error(404)
+            return
+
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Cache-Control", "no-cache")
+        self.end_headers()
+        try:
+            while True:
+                event = f"event: heartbeat\ndata: {time.time()}\n\n"
+                self.wfile.write(event.encode())
+                self.wfile.flush()
+                time.sleep(StubConfig.heartbeat_interval)
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(port=0):
+    """Start the stub server on a background thread. Returns the server; its URL is
+    f"http://127.0.0.1:{server.server_port}"."""
+    StubHandler.fixtures = Fixtures()
+    server = ThreadingHTTPServer(("127.0.0.1", port), StubHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Stub OpenCTI GraphQL server")
+    ap.add_argument("--port", type=int, default=0)
+    for name, value in vars(StubConfig).items():
+        if not name.startswith("_"):
+            ap.add_argument(
+                f"--{name.replace('_', '-')}", type=type(value), default=value
+            )
+    args = ap.parse_args()
+    for name in vars(StubConfig):
+        if not name.startswith("_"):
+            setattr(StubConfig, name, getattr(args, name))
+
+    server = serve(args.port)
+    print(f"http://127.0.0.1:{server.server_port}", flush=True)
+    threading.Event().wait()
+
+
+if __name__ == "__main__":
+    main()
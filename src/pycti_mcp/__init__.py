@@ -1 +1,21 @@
-__all__ = ["mcp_server_octi", "pycti_tools"]
+__all__ = [
+    "alias_index",
+    "budget",
+    "cache",
+    "client_pool",
+    "coalesce",
+    "encoding",
+    "entity_store",
+    "executor",
+    "governor",
+    "mcp_server_octi",
+    "membership",
+    "metrics",
+    "mirror",
+    "pattern_index",
+    "projection",
+    "registry",
+    "report_buckets",
+    "workers",
+    "pycti_tools",
+]
@@ -0,0 +1,306 @@
+import asyncio
+import difflib
+import json
+import logging
+import os
+import time
+import unicodedata
+from collections import Counter
+
+from pycti_mcp.client_pool import get_client_pool
+from pycti_mcp.membership import snapshot_mtime
+from pycti_mcp.metrics import current_tool
+from pycti_mcp.mirror import adversary_kinds
+from pycti_mcp.workers import WorkersConfig
+
+
+# Settings for the optional in-memory index of the names and aliases of the adversaries in
+# OpenCTI. These are overwritten by the command-line handling in mcp_server_octi.main().
+class AliasIndexConfig:
+    enabled = False
+    refresh_interval = 900
+    # How similar (as difflib's ratio of the normalized names) a name has to be to an adversary's
+    # name or alias to be resolved to it, when it isn't an exact match for any of them
+    fuzzy_cutoff = 0.85
+    snapshot_path = None
+    page_size = 500
+    # Max number of the names sharing the most trigrams with a name which are compared with it
+    fuzzy_candidates = 50
+
+
+# Names are compared ignoring case, accents, spaces, and punctuation, so that "APT 28",
+# "apt-28", and "APT28" are all the same name
+def normalize(name):
+    decomposed = unicodedata.normalize("NFKD", name or "")
+    return "".join(c for c in decomposed.casefold() if c.isalnum())
+
+
+def trigrams(key):
+    return {key[i : i + 3] for i in range(max(1, len(key) - 2))}
+
+
+def digits(key):
+    return "".join(c for c in key if c.isdigit())
+
+
+class AliasIndex:
+    """The name and aliases of every adversary in OpenCTI, so that the name an adversary is
+    looked up by can be resolved to the adversaries it refers to (and their types) without any
+    request, and names no adversary has can be answered as not found at once.
+
+    Names are matched once normalized (see normalize()), and failing that, to the most similar
+    name or alias, as long as they are at least fuzzy_cutoff similar and have the same digits,
+    since names like "APT28" and "APT29" are of different adversaries."""
+
+    def __init__(self, url):
+        self.url = url
+        # The adversary type, name, and aliases of each adversary, by its OpenCTI Id
+        self.adversaries = None
+        # The adversaries (their types, OpenCTI Ids, and names, and the name or alias itself)
+        # with each normalized name or alias, in adversary_kinds order, and the normalized names
+        # and aliases containing each trigram, for the fuzzy matches. These are replaced together,
+        # as a snapshot may be loaded while names are being resolved.
+        self.tables = ({}, {})
+        self.last_refresh = None
+        self.resolved = 0
+        self.fuzzy = 0
+        self.unknown = 0
+
+    def ready(self):
+        return self.adversaries is not None
+
+    def current(self):
+        """Whether the index has been refreshed recently enough to resolve names with: within
+        the refresh interval, allowing for one refresh running late (or for a snapshot, its
+        last refresh before it was saved)"""
+        return (
+            self.last_refresh is not None
+            and time.time() - self.last_refresh < 2 * AliasIndexConfig.refresh_interval
+        )
+
+    def build(self, adversaries):
+        names = {}
+        for opencti_id, (adv_type, name, aliases) in sorted(
+            adversaries.items(), key=lambda a: adversary_kinds.index(a[1][0])
+        ):
+            for term in [name] + aliases:
+                key = normalize(term)
+                if not key:
+                    continue
+                entries = names.setdefault(key, [])
+                if (adv_type, opencti_id) not in [e[:2] for e in entries]:
+                    entries.append((adv_type, opencti_id, name, term))
+
+        grams = {}
+        for key in names:
+            for gram in trigrams(key):
+                grams.setdefault(gram, []).append(key)
+
+        self.tables = (names, grams)
+        self.adversaries = adversaries
+
+    def closest(self, key, grams):
+        """The normalized name or alias most similar to key, if any is similar enough"""
+        # Trigrams in many of the names (like those of "group") say little about which is closest,
+        # and counting them is most of the work, so only the rarer ones are counted, unless there
+        # are none
+        postings = [grams[gram] for gram in trigrams(key) if gram in grams]
+        common = max(50, len(self.tables[0]) // 20)
+        shared = Counter()
+        for keys in [p for p in postings if len(p) <= common] or postings:
+            shared.update(keys)
+        best, best_ratio = None, AliasIndexConfig.fuzzy_cutoff
+        for candidate, _ in shared.most_common(AliasIndexConfig.fuzzy_candidates):
+            if digits(candidate) != digits(key):
+                continue
+            ratio = difflib.SequenceMatcher(None, key, candidate).ratio()
+            if ratio >= best_ratio and (best is None or ratio > best_ratio):
+                best, best_ratio = candidate, ratio
+        return best
+
+    def resolve(self, name):
+        """The adversaries with name as their name or an alias: a dict of the OpenCTI Id, name,
+        and the name or alias matched, of the first of each adversary type, which is empty if no
+        adversary has it. Returns None if the name can't be normalized, and has to be looked up
+        in OpenCTI."""
+        key = normalize(name)
+        if not key:
+            return None
+
+        names, grams = self.tables
+        found = names.get(key)
+        if found:
+            self.resolved += 1
+        else:
+            closest = self.closest(key, grams)
+            found = names[closest] if closest else []
+            if closest:
+                self.fuzzy += 1
+            else:
+                self.unknown += 1
+
+        resolved = {}
+        for adv_type, opencti_id, adv_name, term in found:
+            resolved.setdefault(adv_type, (opencti_id, adv_name, term))
+        return resolved
+
+    async def refresh(self, pool):
+        """List every adversary of each type, and rebuild the index from them. Adversaries are
+        few enough, even on large platforms, to be listed in full each time, which also drops
+        those deleted or renamed since the last refresh."""
+        adversaries = {}
+        for adv_type in adversary_kinds:
+            after = None
+            while True:
+                page = await pool.run(list_adversary_names, adv_type, after)
+                for ta in page["entities"]:
+                    adversaries[ta["id"]] = (
+                        adv_type,
+                        ta["name"],
+                        list(ta.get("aliases") or []),
+                    )
+                if not page["pagination"].get("hasNextPage"):
+                    break
+                after = page["pagination"]["endCursor"]
+
+        self.build(adversaries)
+        self.last_refresh = time.time()
+
+    def stats(self):
+        if self.adversaries is None:
+            return {"ready": False}
+        return {
+            "ready": True,
+            "adversaries": len(self.adversaries),
+            "names": len(self.tables[0]),
+            "resolved": self.resolved,
+            "fuzzy": self.fuzzy,
+            "unknown": self.unknown,
+            "last_refresh": self.last_refresh,
+        }
+
+    def save(self, path):
+        snapshot = {
+            "url": self.url,
+            "adversaries": self.adversaries,
+            "last_refresh": self.last_refresh,
+        }
+
+        # Write to a temporary file first, so that a crash never leaves a partial snapshot
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(snapshot, f)
+        os.replace(tmp_path, path)
+
+    def load(self, path):
+        with open(path) as f:
+            snapshot = json.load(f)
+
+        # A snapshot of some other OpenCTI platform is of no use
+        if snapshot["url"] != self.url:
+            return False
+
+        self.build(
+            {
+                opencti_id: (adv_type, name, aliases)
+                for opencti_id, (adv_type, name, aliases) in snapshot[
+                    "adversaries"
+                ].items()
+            }
+        )
+        self.last_refresh = snapshot.get("last_refresh")
+        return True
+
+
+# Fetch one page of the names and aliases of the adversaries of a type
+def list_adversary_names(octi, adv_type, after):
+    return getattr(octi, adv_type).list(
+        first=AliasIndexConfig.page_size,
+        after=after,
+        withPagination=True,
+        customAttributes="""
+            id
+            name
+            aliases
+        """,
+    )
+
+
+_index = None
+
+
+def get_alias_index():
+    """Return the adversary alias index, or None if it hasn't been enabled or isn't ready"""
+    return _index
+
+
+def resolve_adversary(name, bypass=False):
+    """The OpenCTI Ids of the adversaries name refers to, by adversary type (see
+    AliasIndex.resolve()), or None if the name has to be looked up in OpenCTI: as when the index
+    is out of date (its refreshes failing), or the caller asked for a fresh query (bypass)
+    """
+    if _index is None or bypass or not _index.current():
+        return None
+    return _index.resolve(name)
+
+
+def match_fields(name, term):
+    """The fields added to an adversary which name was resolved to by the alias index, when it
+    isn't the adversary's name or one of its aliases as given: the one it was matched to, and
+    whether it was only similar to it, rather than the same but for case, accents, spaces, and
+    punctuation"""
+    if name.casefold() == term.casefold():
+        return {}
+    return {"matched_name": term, "fuzzy": normalize(name) != normalize(term)}
+
+
+def load_snapshot(index, path):
+    log = logging.getLogger(__name__)
+    try:
+        if index.load(path):
+            log.info(f"Loaded adversary alias index snapshot from {path}")
+    except (OSError, ValueError, KeyError, TypeError) as e:
+        log.warning(f"Ignoring unreadable alias index snapshot {path}: {e}")
+
+
+async def run_alias_index_refresh(url, key, follower=False):
+    """Background task which prefetches the adversary alias index at startup (or loads it from
+    the persisted snapshot, if there is one), and keeps it up to date. A follower (one of
+    several HTTP workers, other than the first) instead loads each snapshot the first saves.
+    """
+    global _index
+    log = logging.getLogger(__name__)
+    # Report the refresh requests in the metrics as if they came from a tool of this name
+    current_tool.set("alias_index_refresh")
+    index = AliasIndex(url)
+    path = AliasIndexConfig.snapshot_path
+
+    loaded_mtime = snapshot_mtime(path) if path else None
+    if loaded_mtime is not None:
+        load_snapshot(index, path)
+
+    # Only resolve names with the index once it covers every adversary
+    if index.ready():
+        _index = index
+
+    while follower:
+        await asyncio.sleep(WorkersConfig.reload_interval)
+        mtime = snapshot_mtime(path)
+        if mtime is not None and mtime != loaded_mtime:
+            await asyncio.to_thread(load_snapshot, index, path)
+            loaded_mtime = mtime
+            if index.ready():
+                _index = index
+
+    pool = get_client_pool(url, key)
+    while True:
+        try:
+            await index.refresh(pool)
+            _index = index
+            log.info(f"Refreshed adversary alias index: {index.stats()}")
+            if path:
+                await asyncio.to_thread(index.save, path)
+        except Exception as e:
+            log.error(f"Failed to refresh adversary alias index: {e}")
+
+        await asyncio.sleep(AliasIndexConfig.refresh_interval)
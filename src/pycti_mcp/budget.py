@@ -0,0 +1,142 @@
+from pycti_mcp import encoding
+
+
+# Settings for the response size budget. These are overwritten by the command-line handling in
+# mcp_server_octi.main().
+class BudgetConfig:
+    # Default max size, in bytes, of a tool's JSON-encoded response. 0 for no limit.
+    max_bytes = 256 * 1024
+
+
+def encoded_size(obj):
+    # The trailing separator (a comma) is counted too
+    return encoding.encoded_size(obj) + 1
+
+
+# The dicts holding an item's list fields: the item itself, or the dict (or list of dicts) in its
+# within field
+def holders(item, within):
+    if not within:
+        return [item]
+    inner = item.get(within)
+    if isinstance(inner, list):
+        return inner
+    return [inner] if inner else []
+
+
+class Budget:
+    """Tracks how much of a tool response's size budget is left, as the response is built up.
+    The sizes are approximate: each object is measured as it is added, but the keys and
+    brackets of the containers they're added to aren't counted."""
+
+    def __init__(self, max_bytes=None):
+        if max_bytes is None:
+            max_bytes = BudgetConfig.max_bytes
+        self.limit = max_bytes if max_bytes > 0 else None
+        self.used = 0
+        # Set once anything has been left out of the response
+        self.truncated = False
+
+    @property
+    def limited(self):
+        return self.limit is not None
+
+    def take(self, obj):
+        """Count obj against the budget, if it fits. Returns whether it did."""
+        if self.limit is None:
+            return True
+
+        size = encoded_size(obj)
+        if self.used + size > self.limit:
+            # Once something doesn't fit, nothing else is added either, so that the parts of
+            # the response which are kept are always a prefix of each list
+            self.used = self.limit
+            self.truncated = True
+            return False
+        self.used += size
+        return True
+
+    def take_list(self, values):
+        kept = []
+        for v in values:
+            if not self.take(v):
+                break
+            kept.append(v)
+        return kept
+
+    def fit_items(self, items, lists=(), within=None):
+        """Fit a list of parsed items into the budget, in priority order: first each item's own
+        fields, in turn, then the entries of each of the items' list fields, a field at a time
+        in the order given by lists. If within is given, the list fields are those of the
+        dict (or of each of the list of dicts) held in each item's within field.
+
+        The first item's own fields are always kept, even if they are over the budget, so that
+        the response is never empty. items can be a generator, which is only consumed until
+        the budget runs out, so that no more items than can be returned are parsed. Items
+        which are left out entirely aren't counted here; list entries which are left out are
+        counted in a "truncated" field added to the item (or to its within dict). The items
+        aren't modified: trimmed items are returned as copies.
+        """
+        if self.limit is None:
+            return list(items)
+
+        kept = []
+        for item in items:
+            inners = holders(item, within)
+            if not any(inner.get(f) for inner in inners for f in lists):
+                if not self.take(item) and kept:
+                    break
+                kept.append(item)
+                continue
+
+            stripped = [
+                {k: v for k, v in inner.items() if k not in lists} for inner in inners
+            ]
+            if within:
+                inner = item[within]
+                stripped = {
+                    **item,
+                    within: stripped if isinstance(inner, list) else stripped[0],
+                }
+            else:
+                stripped = stripped[0]
+            if not self.take(stripped) and kept:
+                break
+            kept.append(item)
+
+        kept = [dict(item) for item in kept]
+        for item in kept:
+            inner = item.get(within) if within else None
+            if isinstance(inner, list):
+                item[within] = [dict(i) for i in inner]
+            elif inner:
+                item[within] = dict(inner)
+
+        for f in lists:
+            for item in kept:
+                for inner in holders(item, within):
+                    values = inner.get(f)
+                    if not values:
+                        continue
+                    inner[f] = self.take_list(values)
+                    if len(inner[f]) < len(values):
+                        inner.setdefault("truncated", {})[f] = len(values) - len(
+                            inner[f]
+                        )
+
+        return kept
+
+    def fit(self, item, lists=()):
+        """Fit a single parsed item into the budget, as fit_items() does"""
+        return self.fit_items([item], lists)[0]
+
+
+def fit_list(items, total, max_bytes, field, lists=(), within=None):
+    """Fit a tool's list result into the budget (see Budget.fit_items()). If any of the total
+    items had to be left out, an entry counting them, {"truncated": {field: omitted}}, is
+    appended to the list. Returns the list, and whether anything was left out of it."""
+    budget = Budget(max_bytes)
+    fitted = budget.fit_items(items, lists, within)
+    if len(fitted) < total:
+        fitted.append({"truncated": {field: total - len(fitted)}})
+    return fitted, budget.truncated
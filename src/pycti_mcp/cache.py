@@ -0,0 +1,232 @@
+import json
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+from pycti_mcp import encoding
+
+
+# Settings for the process-wide tool response cache. These are overwritten by the
+# command-line handling in mcp_server_octi.main() before any tool is initialized.
+class CacheConfig:
+    enabled = True
+    max_entries = 4096
+    max_bytes = 64 * 1024 * 1024
+    default_ttl = 300
+    # Per-tool overrides of default_ttl, in seconds, keyed by the tool name
+    ttl = {
+        "opencti_adversary_lookup": 900,
+        "opencti_reports_lookup": 120,
+    }
+    # Not-found results from these tools go to a separate cache, with its own (shorter) TTL
+    # and bounds, so that misses can't crowd out the real responses
+    negative_tools = [
+        "opencti_adversary_lookup",
+        "opencti_indicator_lookup",
+        "opencti_observable_lookup",
+        "opencti_report_contents",
+    ]
+    negative_ttl = 60
+    negative_max_entries = 16384
+    negative_max_bytes = 8 * 1024 * 1024
+
+
+def tool_ttl(tool):
+    return CacheConfig.ttl.get(tool, CacheConfig.default_ttl)
+
+
+# The encoder is built once, rather than by each json.dumps() call given its options
+_key_encoder = json.JSONEncoder(sort_keys=True, default=str)
+
+
+# Build the cache key for a tool call from its (already normalized) arguments
+def make_key(tool, *args):
+    return tool + ":" + _key_encoder.encode(args)
+
+
+class ResponseCache:
+    """A thread-safe LRU cache with per-entry expiry, bounded by both entry count and the
+    (approximate, JSON-encoded) size of the cached values."""
+
+    def __init__(self, max_entries=None, max_bytes=None):
+        self.max_entries = max_entries or CacheConfig.max_entries
+        self.max_bytes = max_bytes or CacheConfig.max_bytes
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, key):
+        """Returns a (hit, value) tuple for the key"""
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return False, None
+
+            value, expires, size = entry
+            if expires <= now:
+                self._remove(key)
+                self.expirations += 1
+                self.misses += 1
+                return False, None
+
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return True, value
+
+    def put(self, key, value, ttl):
+        if ttl <= 0:
+            return
+
+        size = len(key) + encoding.encoded_size(value)
+        if size > self.max_bytes:
+            return
+
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (value, time.monotonic() + ttl, size)
+            self._bytes += size
+
+            # Evict least-recently used entries until back under both bounds
+            while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    def invalidate(self, *keys):
+        with self._lock:
+            for key in keys:
+                if key in self._entries:
+                    self._remove(key)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def keys(self):
+        with self._lock:
+            return list(self._entries)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def _remove(self, key):
+        _, _, size = self._entries.pop(key)
+        self._bytes -= size
+
+    def stats(self):
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+            }
+
+
+_cache = None
+_negative_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_response_cache():
+    """Return the process-wide tool response cache, creating it on first use. Returns None if
+    caching has been disabled."""
+    global _cache
+    if not CacheConfig.enabled:
+        return None
+
+    with _cache_lock:
+        if _cache is None:
+            _cache = ResponseCache()
+            logging.getLogger(__name__).info(
+                f"Created response cache ({_cache.max_entries} entries, {_cache.max_bytes} bytes)"
+            )
+        return _cache
+
+
+def get_negative_cache():
+    """Return the process-wide cache of not-found tool responses, creating it on first use.
+    Returns None if caching has been disabled."""
+    global _negative_cache
+    if not CacheConfig.enabled:
+        return None
+
+    with _cache_lock:
+        if _negative_cache is None:
+            _negative_cache = ResponseCache(
+                max_entries=CacheConfig.negative_max_entries,
+                max_bytes=CacheConfig.negative_max_bytes,
+            )
+        return _negative_cache
+
+
+async def cache_lookup(ctx, key, bypass, miss_key=None):
+    """Look up a tool's cached response, or cached not-found response. Returns a (hit, value)
+    tuple; always a miss when the cache is disabled or the caller asked to bypass it.
+
+    Not-found responses are cached under miss_key, if given, which should be the key built from
+    only the looked-up value, without any arguments (such as the level of detail) which don't
+    affect whether it is found."""
+    cache = get_response_cache()
+    if cache is None or bypass:
+        return False, None
+
+    hit, value = cache.get(key)
+    if not hit:
+        hit, value = get_negative_cache().get(miss_key or key)
+    if hit:
+        await ctx.debug(f"Returning cached response for {key}")
+    return hit, value
+
+
+def cache_store(tool, key, value, miss_key=None):
+    cache = get_response_cache()
+    if cache is None:
+        return
+
+    negative_cache = get_negative_cache()
+    if not value and tool in CacheConfig.negative_tools:
+        negative_cache.put(miss_key or key, value, CacheConfig.negative_ttl)
+    else:
+        negative_cache.invalidate(miss_key or key)
+        cache.put(key, value, tool_ttl(tool))
+
+
+def forget_misses(*terms):
+    """Drop any cached not-found responses for lookups of the given values (names, observable
+    values, or Ids), because some tool has just found an entity by that value"""
+    negative_cache = get_negative_cache()
+    if negative_cache is None or not len(negative_cache):
+        return
+
+    terms = {term for term in terms if term}
+    if len(negative_cache) >= len(terms):
+        negative_cache.invalidate(
+            *[
+                make_key(tool, term)
+                for term in terms
+                for tool in CacheConfig.negative_tools
+            ]
+        )
+        return
+
+    # Fewer misses are cached than there are terms (as when given every object in a report), so
+    # look through the misses for the terms, rather than building the keys for every term
+    forgotten = []
+    for key in negative_cache.keys():
+        tool, _, args = key.partition(":")
+        if tool in CacheConfig.negative_tools:
+            args = json.loads(args)
+            if len(args) == 1 and isinstance(args[0], str) and args[0] in terms:
+                forgotten.append(key)
+    negative_cache.invalidate(*forgotten)
@@ -0,0 +1,162 @@
+import logging
+import queue
+import threading
+from contextlib import contextmanager
+
+
+from pycti_mcp.executor import run_blocking
+from pycti_mcp.governor import get_governor, raise_for_overload
+from pycti_mcp.metrics import record_response
+
+
+# Process-wide settings for the shared OpenCTI client pool. These are overwritten by the
+# command-line handling in mcp_server_octi.main() before any tool is initialized.
+class PoolConfig:
+    pool_size = 8
+    health_check = True
+    ssl_verify = True
+
+
+class OpenCTIClientPool:
+    """A bounded pool of keep-alive OpenCTIApiClient instances sharing one set of credentials.
+
+    Clients are created lazily, on first demand, up to pool_size. Each client owns its own
+    requests.Session (which is not safe to share across threads), so a client is handed out
+    to only one caller at a time and returned to the pool afterward, keeping its HTTP
+    connection (and TLS session) alive for the next caller."""
+
+    def __init__(self, url, key, pool_size=None, health_check=None):
+        self.url = url
+        self.key = key
+        self.pool_size = max(1, pool_size or PoolConfig.pool_size)
+        self.health_check = (
+            PoolConfig.health_check if health_check is None else health_check
+        )
+        self.healthy = None
+        # Idle clients, and free slots (as None) for clients to be built in
+        self._idle = queue.LifoQueue()
+        # Slots handed out, each holding a client or free in _idle
+        self._created = 0
+        self._lock = threading.Lock()
+
+    def _new_client(self):
+        # Only pay for pycti's health check on the first client the pool builds. Later clients
+        # reuse the already-verified configuration.
+        check = self.health_check and self.healthy is None
+        # pycti (and requests, which it uses) are slow to import, so they are only imported
+        # once the first client is needed, rather than when the server starts
+        from pycti import OpenCTIApiClient
+
+        try:
+            octi = OpenCTIApiClient(
+                url=self.url,
+                token=self.key,
+                ssl_verify=PoolConfig.ssl_verify,
+                perform_health_check=check,
+            )
+        except Exception:
+            if check:
+                self.healthy = False
+            raise
+
+        if check:
+            self.healthy = True
+
+        # Count the requests made (and bytes moved) on behalf of each tool
+        octi.session.hooks["response"].append(record_response)
+        octi.session.hooks["response"].append(raise_for_overload)
+        return octi
+
+    def acquire(self):
+        try:
+            octi = self._idle.get_nowait()
+        except queue.Empty:
+            with self._lock:
+                grow = self._created < self.pool_size
+                if grow:
+                    self._created += 1
+            # Pool is at capacity, so wait for another caller to hand a client (or its slot)
+            # back
+            octi = None if grow else self._idle.get()
+
+        if octi is not None:
+            return octi
+
+        # A free slot: either a new one, or one whose client was discarded or failed to build
+        try:
+            return self._new_client()
+        except Exception:
+            # Hand the slot on, so that the next caller (or one already waiting) tries again
+            self._idle.put(None)
+            raise
+
+    def release(self, octi):
+        self._idle.put(octi)
+
+    def discard(self, octi):
+        # Drop a client whose connection is suspect, handing its slot to the next caller, who
+        # builds a fresh client in it
+        octi.session.close()
+        self._idle.put(None)
+
+    @contextmanager
+    def client(self):
+        # Already imported along with pycti, by the time there are any clients
+        import requests
+
+        octi = self.acquire()
+        try:
+            yield octi
+        except requests.exceptions.RequestException:
+            # Transport-level failure: don't hand this session to anyone else
+            self.discard(octi)
+            raise
+        except Exception:
+            self.release(octi)
+            raise
+        else:
+            self.release(octi)
+
+    def _call(self, fn, args, kwargs):
+        with self.client() as octi:
+            return fn(octi, *args, **kwargs)
+
+    async def run(self, fn, *args, **kwargs):
+        """Call fn(octi, *args, **kwargs) with a pooled client on the upstream thread pool, so
+        that the blocking pycti request does not stall the event loop. The request is subject to
+        the governor's concurrency limit, retries, and circuit breaker."""
+        governor = get_governor()
+        if governor is None:
+            return await run_blocking(self._call, fn, args, kwargs)
+        return await governor.run(lambda: run_blocking(self._call, fn, args, kwargs))
+
+    def check_health(self):
+        with self.client() as octi:
+            self.healthy = octi.health_check()
+        return self.healthy
+
+    def stats(self):
+        return {
+            "pool_size": self.pool_size,
+            "clients_created": self._created,
+            "clients_idle": sum(1 for octi in list(self._idle.queue) if octi),
+            "healthy": self.healthy,
+        }
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_client_pool(url, key):
+    """Return the process-wide client pool for the given OpenCTI URL and API key, creating it
+    (but none of its clients) on first use."""
+    with _pools_lock:
+        pool = _pools.get((url, key))
+        if pool is None:
+            pool = OpenCTIClientPool(url, key)
+            _pools[(url, key)] = pool
+            logging.getLogger(__name__).info(
+                f"Created OpenCTI client pool for {url} (size {pool.pool_size})"
+            )
+        return pool
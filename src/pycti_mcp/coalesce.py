@@ -0,0 +1,133 @@
+import asyncio
+import functools
+import inspect
+
+from fastmcp import Context
+
+from pycti_mcp.cache import make_key
+from pycti_mcp.metrics import record_coalesced
+
+
+# Settings for the coalescing of identical concurrent tool calls. These are overwritten by the
+# command-line handling in mcp_server_octi.main().
+class CoalesceConfig:
+    enabled = True
+
+
+class Flight:
+    """A call in progress, and the number of callers waiting for its result"""
+
+    def __init__(self, task):
+        self.task = task
+        self.waiters = 0
+
+
+class SingleFlight:
+    """Runs at most one call at a time for each key: callers with the same key as a call still
+    in progress wait for its result (or exception) instead of making their own.
+
+    A caller which is cancelled stops waiting without cancelling the call, which carries on
+    for the others. Only once every caller has stopped waiting is the call itself cancelled.
+    """
+
+    def __init__(self):
+        self._flights = {}
+
+    def in_flight(self):
+        return len(self._flights)
+
+    def _forget(self, key, flight):
+        if self._flights.get(key) is flight:
+            del self._flights[key]
+
+    async def run(self, key, fn, on_join=None):
+        """Return the result of the coroutine function fn(), or of the call in progress with
+        the same key. on_join() is called if an existing call is joined."""
+        flight = self._flights.get(key)
+        if flight is None:
+            flight = self._flights[key] = Flight(asyncio.ensure_future(fn()))
+            flight.task.add_done_callback(lambda _: self._forget(key, flight))
+        elif on_join is not None:
+            on_join()
+
+        flight.waiters += 1
+        try:
+            return await asyncio.shield(flight.task)
+        finally:
+            flight.waiters -= 1
+            if flight.waiters == 0 and not flight.task.done():
+                # Every caller was cancelled. Later callers start a call of their own,
+                # rather than joining this one as it is cancelled.
+                self._forget(key, flight)
+                flight.task.cancel()
+
+
+class SharedContext:
+    """The MCP context of the caller which started a shared call, as the call sees it. Its log
+    messages are sent to that caller as usual, but one which can't be sent (as when the caller
+    has gone away) is dropped, rather than failing the call for every caller sharing it.
+    """
+
+    def __init__(self, ctx):
+        self._ctx = ctx
+
+    def __getattr__(self, name):
+        return getattr(self._ctx, name)
+
+    async def _send(self, level, message):
+        try:
+            await getattr(self._ctx, level)(message)
+        except Exception:
+            pass
+
+    async def debug(self, message):
+        await self._send("debug", message)
+
+    async def info(self, message):
+        await self._send("info", message)
+
+    async def warning(self, message):
+        await self._send("warning", message)
+
+    async def error(self, message):
+        await self._send("error", message)
+
+
+_flights = SingleFlight()
+
+
+def get_flights():
+    return _flights
+
+
+def coalesce_tool(fn):
+    """Wrap a tool function so that concurrent calls with the same arguments (once the defaults
+    have been filled in) share a single call. The MCP context isn't part of the arguments
+    compared: the shared call logs to the context of the caller which started it, through a
+    SharedContext."""
+    tool = fn.__name__
+    sig = inspect.signature(fn)
+    context_args = [
+        name for name, p in sig.parameters.items() if p.annotation is Context
+    ]
+
+    @functools.wraps(fn)
+    async def wrapper(*args, **kwargs):
+        if not CoalesceConfig.enabled:
+            return await fn(*args, **kwargs)
+
+        bound = sig.bind(*args, **kwargs)
+        bound.apply_defaults()
+        key = make_key(
+            tool,
+            {k: v for k, v in bound.arguments.items() if k not in context_args},
+        )
+        for name in context_args:
+            bound.arguments[name] = SharedContext(bound.arguments[name])
+        return await _flights.run(
+            key,
+            lambda: fn(*bound.args, **bound.kwargs),
+            on_join=record_coalesced,
+        )
+
+    return wrapper
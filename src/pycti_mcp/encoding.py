@@ -0,0 +1,65 @@
+# JSON encoding and decoding of the parsed entities, for encoding the tool responses (dumps_str()
+# is each tool's FastMCP serializer), sizing them against the response budget and the caches,
+# logging them, and storing them in the mirror.
+#
+# orjson is used when it is installed (pip install pycti-mcp[fast]), as it is several times
+# faster than the json module, and builds the encoded bytes directly rather than joining them
+# from a list of chunks. Either way the encoding is compact, without spaces after the separators,
+# just as FastMCP's own serializer would encode the responses, so that sizes measured here are
+# those of the response.
+#
+# The parsed entities stay plain dicts and lists rather than slotted models: the caches, the
+# budget's trimming, the mirror and FastMCP's structured content all take them as they are.
+# FastMCP still converts each response to its structured content itself.
+#
+# Callers use the functions through this module (encoding.dumps() rather than importing dumps),
+# so that use_encoder() can switch between the encoders.
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def _default(obj):
+    return str(obj)
+
+
+def json_dumps(obj):
+    return json.dumps(
+        obj, default=_default, separators=(",", ":"), ensure_ascii=False
+    ).encode()
+
+
+# Non-ASCII characters are measured as the json module escapes them, which makes the encoding
+# ASCII, so that its length in characters is its size in bytes without encoding it a second time
+def json_size(obj):
+    return len(json.dumps(obj, default=_default, separators=(",", ":")))
+
+
+def orjson_dumps(obj):
+    return orjson.dumps(obj, default=_default, option=orjson.OPT_NON_STR_KEYS)
+
+
+def orjson_size(obj):
+    return len(orjson_dumps(obj))
+
+
+def use_encoder(name):
+    """Encode with the "json" module, or with "orjson" """
+    global encoder, dumps, encoded_size, loads
+    encoder = name
+    if name == "orjson":
+        dumps, encoded_size, loads = orjson_dumps, orjson_size, orjson.loads
+    else:
+        dumps, encoded_size, loads = json_dumps, json_size, json.loads
+
+
+# dumps(obj) encodes obj as compact JSON, returning bytes, and encoded_size(obj) returns the size
+# of that. Values JSON can't represent are encoded as their str().
+use_encoder("json" if orjson is None else "orjson")
+
+
+def dumps_str(obj):
+    return dumps(obj).decode()
@@ -0,0 +1,236 @@
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+from pycti_mcp import encoding
+
+
+# Settings for the process-wide store of the entities seen in tool responses. These are
+# overwritten by the command-line handling in mcp_server_octi.main().
+class EntityStoreConfig:
+    enabled = True
+    max_entries = 16384
+    max_bytes = 32 * 1024 * 1024
+    # Stored entities are served without checking for changes for this many seconds since they
+    # were stored (or last checked). After that, their updated_at is read from OpenCTI first.
+    check_after = 60
+    # The containers (reports, cases, groupings, notes, and opinions) an entity is in change
+    # without changing its updated_at, so stored lists of them are only served for this many
+    # seconds since they were fetched
+    max_age = 300
+
+
+# Names of the pycti client attributes for each kind of stored entity, used to check whether
+# they have been updated
+store_kinds = {
+    "indicator": "indicator",
+    "observable": "stix_cyber_observable",
+}
+
+# The parsed fields listing the containers an entity is in
+container_fields = {"external_reports", "cases", "groupings", "notes", "opinions"}
+
+
+class StoredEntity:
+    """The fields parsed from an entity so far, with when it was last updated in OpenCTI, when
+    that was last checked, and when the oldest of its container lists was fetched"""
+
+    __slots__ = ("kind", "fields", "updated", "checked", "fetched", "size")
+
+    def __init__(self, kind, fields, updated, size, fetched=None):
+        self.kind = kind
+        self.fields = fields
+        self.updated = updated
+        self.checked = time.monotonic()
+        self.fetched = self.checked if fetched is None else fetched
+        self.size = size
+
+
+class EntityStore:
+    """A thread-safe LRU store of parsed entities, found by either their OpenCTI Id or their
+    STIX Id, and bounded by both entry count and the (approximate, JSON-encoded) size of the
+    entities.
+
+    Each tool parses only the fields of an entity that its level of detail needs, so the fields
+    stored for an entity are merged from every response it was in, as long as they were parsed
+    from the same version of it (with the same updated_at). A newer version replaces them, and
+    an older one is ignored."""
+
+    def __init__(self, max_entries=None, max_bytes=None):
+        self.max_entries = max_entries or EntityStoreConfig.max_entries
+        self.max_bytes = max_bytes or EntityStoreConfig.max_bytes
+        self._entries = OrderedDict()
+        # Maps both the OpenCTI and STIX Ids of each entity to its OpenCTI Id
+        self._ids = {}
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def put(self, kind, entity):
+        opencti_id = entity.get("opencti_id")
+        updated = entity.get("last_updated")
+        if not opencti_id or not updated:
+            return
+
+        with self._lock:
+            stored = self._entries.get(opencti_id)
+            if stored is not None and stored.updated > updated:
+                return
+            fetched = None
+            if stored is not None and stored.updated == updated:
+                fields = {**stored.fields, **entity}
+                # Container lists kept from the stored fields are as old as they were
+                if any(
+                    f in stored.fields and f not in entity for f in container_fields
+                ):
+                    fetched = stored.fetched
+            else:
+                fields = dict(entity)
+
+            size = encoding.encoded_size(fields)
+            if size > self.max_bytes:
+                return
+            if stored is not None:
+                self._remove(opencti_id)
+            self._entries[opencti_id] = StoredEntity(
+                kind, fields, updated, size, fetched
+            )
+            self._bytes += size
+            self._ids[opencti_id] = opencti_id
+            if entity.get("stix_id"):
+                self._ids[entity["stix_id"]] = opencti_id
+
+            # Evict least-recently used entries until back under both bounds
+            while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    def get(self, kind, id_, profile):
+        """Returns the stored entity of the kind with the Id, if the fields in the profile have
+        all been stored for it (and any container lists among them are no older than max_age),
+        or None"""
+        with self._lock:
+            stored = self._entries.get(self._ids.get(id_))
+            if (
+                stored is None
+                or stored.kind != kind
+                or not all(f in stored.fields for f in profile)
+                or (
+                    container_fields.intersection(profile)
+                    and time.monotonic() - stored.fetched > EntityStoreConfig.max_age
+                )
+            ):
+                self.misses += 1
+                return None
+            self._entries.move_to_end(stored.fields["opencti_id"])
+            return stored
+
+    def checked(self, stored, updated):
+        """Record the updated_at just read from OpenCTI for the stored entity. Returns whether
+        it is unchanged, and can still be served. Changed entities are dropped."""
+        opencti_id = stored.fields["opencti_id"]
+        with self._lock:
+            if updated == stored.updated:
+                stored.checked = time.monotonic()
+                return True
+            # Unless it has already been replaced by a newer version
+            if self._entries.get(opencti_id) is stored:
+                self._remove(opencti_id)
+            self.expirations += 1
+            return False
+
+    def hit(self):
+        with self._lock:
+            self.hits += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._ids.clear()
+            self._bytes = 0
+
+    def _remove(self, opencti_id):
+        stored = self._entries.pop(opencti_id)
+        self._bytes -= stored.size
+        for id_ in (opencti_id, stored.fields.get("stix_id")):
+            if self._ids.get(id_) == opencti_id:
+                del self._ids[id_]
+
+    def stats(self):
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+            }
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_entity_store():
+    """Return the process-wide entity store, creating it on first use. Returns None if it has
+    been disabled."""
+    global _store
+    if not EntityStoreConfig.enabled:
+        return None
+
+    with _store_lock:
+        if _store is None:
+            _store = EntityStore()
+            logging.getLogger(__name__).info(
+                f"Created entity store ({_store.max_entries} entries, {_store.max_bytes} bytes)"
+            )
+        return _store
+
+
+def remember(kind, entity):
+    """Store an entity parsed for a tool response, and return it"""
+    store = get_entity_store()
+    if store is not None and entity:
+        store.put(kind, entity)
+    return entity
+
+
+# Read when the entity with the given OpenCTI Id was last updated, or None if it no longer exists
+def read_updated(octi, kind, opencti_id):
+    found = getattr(octi, store_kinds[kind]).list(
+        filters={
+            "mode": "and",
+            "filters": [{"key": "id", "values": [opencti_id]}],
+            "filterGroups": [],
+        },
+        first=1,
+        customAttributes="id\nupdated_at",
+    )
+    return found[0]["updated_at"] if found else None
+
+
+async def stored_entity(pool, kind, id_, profile):
+    """Return the fields in the profile of the stored entity of the kind with the given OpenCTI
+    or STIX Id, or None if it isn't stored with all of them. Entities stored more than
+    check_after seconds ago are only returned if their updated_at in OpenCTI is unchanged,
+    which is much cheaper to read than the entity itself. Their container lists, which can
+    change without changing updated_at, are only returned for max_age seconds."""
+    store = get_entity_store()
+    if store is None:
+        return None
+    stored = store.get(kind, id_, profile)
+    if stored is None:
+        return None
+
+    if time.monotonic() - stored.checked > EntityStoreConfig.check_after:
+        updated = await pool.run(read_updated, kind, stored.fields["opencti_id"])
+        if not store.checked(stored, updated):
+            return None
+
+    store.hit()
+    return {f: stored.fields[f] for f in profile}
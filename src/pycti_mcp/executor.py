@@ -0,0 +1,70 @@
+import asyncio
+import contextvars
+import functools
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+
+# Settings for the thread pool that runs the (blocking) pycti calls. These are overwritten by
+# the command-line handling in mcp_server_octi.main(), which keeps max_workers equal to the
+# client pool size so that every worker thread can always hold a pooled client.
+class ExecutorConfig:
+    max_workers = 8
+    queue_depth = 64
+    # Max number of values sent in one upstream request by the batch tools. Larger batches are
+    # split into several requests of this size, which run concurrently.
+    batch_size = 100
+
+
+class UpstreamBusyError(RuntimeError):
+    pass
+
+
+_executor = None
+_slots = None
+_lock = threading.Lock()
+
+
+def get_executor():
+    global _executor, _slots
+    with _lock:
+        if _executor is None:
+            workers = max(1, ExecutorConfig.max_workers)
+            _executor = ThreadPoolExecutor(
+                max_workers=workers, thread_name_prefix="opencti-upstream"
+            )
+            # One slot per running call plus one per call allowed to wait for a worker
+            _slots = threading.BoundedSemaphore(workers + ExecutorConfig.queue_depth)
+        return _executor
+
+
+async def run_blocking(fn, *args, **kwargs):
+    """Run the blocking callable fn(*args, **kwargs) on the upstream thread pool, without
+    blocking the event loop. Raises UpstreamBusyError, rather than queueing without bound,
+    when all workers are busy and the wait queue is full."""
+    executor = get_executor()
+    if not _slots.acquire(blocking=False):
+        raise UpstreamBusyError(
+            "Too many OpenCTI requests are already in progress, try again shortly"
+        )
+
+    # Carry the caller's context variables into the worker thread
+    call = functools.partial(contextvars.copy_context().run, fn, *args, **kwargs)
+    try:
+        fut = executor.submit(call)
+    except BaseException:
+        _slots.release()
+        raise
+
+    # Only give the slot back once the thread is really done, even if the awaiting task is
+    # cancelled in the meantime
+    fut.add_done_callback(lambda _: _slots.release())
+    return await asyncio.wrap_future(fut)
+
+
+def shutdown():
+    global _executor
+    with _lock:
+        if _executor is not None:
+            _executor.shutdown(wait=False, cancel_futures=True)
+            _executor = None
@@ -0,0 +1,305 @@
+import asyncio
+import collections
+import random
+import time
+
+from pycti_mcp.executor import ExecutorConfig, UpstreamBusyError
+from pycti_mcp.metrics import current_tool
+
+
+# Settings for the governor of upstream OpenCTI requests. These are overwritten by the
+# command-line handling in mcp_server_octi.main().
+class GovernorConfig:
+    enabled = True
+    # The concurrency limit is cut by this factor whenever OpenCTI looks overloaded: when a
+    # tool's recent latency exceeds latency_tolerance times its usual latency (and the
+    # latency_floor, below which differences are noise), or a request fails with an error
+    # indicating overload. Otherwise, it grows by one for each limit's worth of requests.
+    decrease_factor = 0.5
+    latency_tolerance = 2.0
+    latency_floor = 0.05
+    # Failed reads are retried this many times, after a random delay of up to base_delay
+    # (doubling with each retry, up to max_delay) seconds
+    retries = 2
+    retry_base_delay = 0.25
+    retry_max_delay = 4.0
+    # The circuit breaker opens when at least breaker_error_rate of the last breaker_window
+    # requests failed (once there have been breaker_min_requests), then fails every request at
+    # once for breaker_cooldown seconds before letting a single trial request through
+    breaker_window = 20
+    breaker_min_requests = 10
+    breaker_error_rate = 0.5
+    breaker_cooldown = 30
+
+
+class UpstreamOverloadedError(RuntimeError):
+    """OpenCTI answered with a status showing it is overloaded or unavailable"""
+
+    def __init__(self, status):
+        super().__init__(f"OpenCTI responded with HTTP status {status}")
+        self.status = status
+
+
+class CircuitOpenError(UpstreamBusyError):
+    pass
+
+
+# requests response hook, installed on the session of each pooled OpenCTI client. pycti turns
+# every non-200 response into a ValueError holding just the body, so check the status first.
+def raise_for_overload(response, *args, **kwargs):
+    if response.status_code == 429 or response.status_code >= 500:
+        raise UpstreamOverloadedError(response.status_code)
+
+
+# Whether a failed read is worth retrying: it failed in transit, or OpenCTI was overloaded.
+# Other errors (such as GraphQL errors) would just fail again.
+def retryable(e):
+    # Imported here, as requests is only imported along with pycti, when it's first used
+    import requests
+
+    return isinstance(
+        e,
+        (
+            requests.exceptions.ConnectionError,
+            requests.exceptions.Timeout,
+            UpstreamOverloadedError,
+        ),
+    )
+
+
+class LatencyTracker:
+    """The usual latency of one tool's requests, and its recent latency"""
+
+    def __init__(self, latency):
+        self.baseline = latency
+        self.recent = latency
+
+    def observe(self, latency):
+        self.recent += 0.2 * (latency - self.recent)
+        # The baseline follows the fastest requests, and only slowly drifts up, so that it
+        # adapts if OpenCTI gets slower for good
+        if latency < self.baseline:
+            self.baseline = latency
+        else:
+            self.baseline += 0.01 * (latency - self.baseline)
+
+    def congested(self):
+        return (
+            self.recent > GovernorConfig.latency_floor
+            and self.recent > GovernorConfig.latency_tolerance * self.baseline
+        )
+
+
+class AIMDLimiter:
+    """Caps the number of upstream requests in progress at an adaptive limit, which is increased
+    additively while latency stays normal, and decreased multiplicatively when it rises or
+    requests fail from overload. Latency is compared per tool, as their requests differ
+    greatly in cost. Callers wait their turn in order, and are turned away once max_waiting
+    are already waiting."""
+
+    def __init__(self, max_limit, max_waiting):
+        self.max_limit = max(1, max_limit)
+        self.max_waiting = max_waiting
+        self.limit = float(self.max_limit)
+        self.in_flight = 0
+        self.waiters = collections.deque()
+        self.latencies = {}
+        self.last_decrease = 0.0
+
+    async def acquire(self):
+        if self.in_flight < int(self.limit) and not self.waiters:
+            self.in_flight += 1
+            return
+
+        if len(self.waiters) >= self.max_waiting:
+            raise UpstreamBusyError(
+                "Too many OpenCTI requests are already waiting, try again shortly"
+            )
+        waiter = asyncio.get_running_loop().create_future()
+        self.waiters.append(waiter)
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                # The slot was handed over just as the caller was cancelled
+                self.release()
+            elif waiter in self.waiters:
+                self.waiters.remove(waiter)
+            raise
+
+    def release(self, latency=None, overloaded=False):
+        """Give back a request's slot, adjusting the limit by its latency (None if unknown)"""
+        self.in_flight -= 1
+        now = time.monotonic()
+
+        congested = overloaded
+        if latency is not None:
+            tracker = self.latencies.get(current_tool.get())
+            if tracker is None:
+                tracker = self.latencies[current_tool.get()] = LatencyTracker(latency)
+            tracker.observe(latency)
+            congested = congested or tracker.congested()
+
+        if congested:
+            # Only decrease once per round trip, as the requests in progress were all sent
+            # before the last decrease took effect
+            if now - self.last_decrease > (latency or 0):
+                self.limit = max(1.0, self.limit * GovernorConfig.decrease_factor)
+                self.last_decrease = now
+        elif latency is not None:
+            self.limit = min(float(self.max_limit), self.limit + 1 / self.limit)
+
+        while self.waiters and self.in_flight < int(self.limit):
+            waiter = self.waiters.popleft()
+            if not waiter.done():
+                self.in_flight += 1
+                waiter.set_result(None)
+
+
+class CircuitBreaker:
+    """Stops sending requests to OpenCTI while most of them fail, so that callers fail at once
+    instead of waiting for requests which will likely time out"""
+
+    def __init__(self):
+        self.outcomes = collections.deque(maxlen=GovernorConfig.breaker_window)
+        self.opened_at = None
+        self.trial = False
+        self.rejected = 0
+        self.opened = 0
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at < GovernorConfig.breaker_cooldown:
+            return "open"
+        return "half_open"
+
+    def check(self):
+        """Raise CircuitOpenError if a request shouldn't be sent now. Once the cooldown is over,
+        a single trial request is let through at a time."""
+        state = self.state
+        if state == "closed":
+            return False
+        if state == "half_open" and not self.trial:
+            self.trial = True
+            return True
+
+        self.rejected += 1
+        wait = max(
+            0, GovernorConfig.breaker_cooldown - (time.monotonic() - self.opened_at)
+        )
+        raise CircuitOpenError(
+            f"OpenCTI is failing, so requests to it are paused for {wait:.0f}s"
+        )
+
+    def record(self, ok, trial=False):
+        if trial:
+            self.trial = False
+            if ok:
+                self.opened_at = None
+                self.outcomes.clear()
+            else:
+                self.opened_at = time.monotonic()
+            return
+
+        self.outcomes.append(ok)
+        failures = self.outcomes.count(False)
+        if (
+            self.opened_at is None
+            and len(self.outcomes) >= GovernorConfig.breaker_min_requests
+            and failures >= GovernorConfig.breaker_error_rate * len(self.outcomes)
+        ):
+            self.opened_at = time.monotonic()
+            self.opened += 1
+
+
+class Governor:
+    """Governs the requests sent to OpenCTI: limits how many run at once (see AIMDLimiter),
+    retries the reads which fail in ways worth retrying, and fails fast while OpenCTI is down
+    (see CircuitBreaker). Every request the tools make is a read, so all can be retried.
+    """
+
+    def __init__(self, max_limit=None, max_waiting=None):
+        self.limiter = AIMDLimiter(
+            max_limit or ExecutorConfig.max_workers,
+            ExecutorConfig.queue_depth if max_waiting is None else max_waiting,
+        )
+        self.breaker = CircuitBreaker()
+        self.retries = 0
+
+    async def run(self, fn):
+        """Return the result of the coroutine function fn(), which sends a request to OpenCTI"""
+        attempt = 0
+        while True:
+            trial = self.breaker.check()
+            try:
+                await self.limiter.acquire()
+            except BaseException:
+                if trial:
+                    self.breaker.trial = False
+                raise
+
+            start = time.monotonic()
+            # A request carries on in its worker thread even once its caller is cancelled, so
+            # its slot is only given back once it is done
+            request = asyncio.ensure_future(fn())
+            try:
+                result = await asyncio.shield(request)
+            except asyncio.CancelledError:
+                request.add_done_callback(self.release_abandoned)
+                if trial:
+                    self.breaker.trial = False
+                raise
+            except Exception as e:
+                failed = retryable(e)
+                self.limiter.release(time.monotonic() - start, overloaded=failed)
+                # Other errors mean OpenCTI answered, which counts as it being up
+                self.breaker.record(not failed, trial)
+                if not failed or attempt >= GovernorConfig.retries:
+                    raise
+
+                attempt += 1
+                self.retries += 1
+                delay = min(
+                    GovernorConfig.retry_max_delay,
+                    GovernorConfig.retry_base_delay * 2 ** (attempt - 1),
+                )
+                await asyncio.sleep(random.uniform(0, delay))
+                continue
+
+            self.limiter.release(time.monotonic() - start)
+            self.breaker.record(True, trial)
+            return result
+
+    def release_abandoned(self, request):
+        # Done callback of a request whose caller was cancelled. Its outcome is retrieved, as
+        # nobody else will.
+        if not request.cancelled():
+            request.exception()
+        self.limiter.release()
+
+    def stats(self):
+        return {
+            "limit": self.limiter.limit,
+            "in_flight": self.limiter.in_flight,
+            "waiting": len(self.limiter.waiters),
+            "retries": self.retries,
+            "circuit_state": self.breaker.state,
+            "circuit_opened": self.breaker.opened,
+            "circuit_rejected": self.breaker.rejected,
+        }
+
+
+_governor = None
+
+
+def get_governor():
+    """Return the process-wide governor, creating it on first use. Returns None if it has been
+    disabled."""
+    global _governor
+    if not GovernorConfig.enabled:
+        return None
+    if _governor is None:
+        _governor = Governor()
+    return _governor
@@ -1,12 +1,35 @@
 import asyncio
 
+import fastmcp
 import pycti_mcp.pycti_tools
 import importlib
 import logging
 import os
+import socket
+import sqlite3
+import sys
+import tempfile
+import uvicorn
 
-from argparse import ArgumentParser
+from argparse import SUPPRESS, ArgumentParser
 from fastmcp import FastMCP
+from pycti_mcp import encoding
+from pycti_mcp.alias_index import AliasIndexConfig, run_alias_index_refresh
+from pycti_mcp.budget import BudgetConfig
+from pycti_mcp.cache import CacheConfig
+from pycti_mcp.client_pool import PoolConfig
+from pycti_mcp.coalesce import CoalesceConfig, coalesce_tool
+from pycti_mcp.entity_store import EntityStoreConfig
+from pycti_mcp.executor import ExecutorConfig
+from pycti_mcp.governor import GovernorConfig
+from pycti_mcp.membership import MembershipConfig, run_membership_refresh
+from pycti_mcp.metrics import MetricsConfig, get_metrics, instrument_tool
+from pycti_mcp.mirror import Mirror, MirrorConfig, run_mirror
+from pycti_mcp.pattern_index import PatternIndex, PatternIndexConfig, run_pattern_index
+from pycti_mcp.registry import read_registry, register_lazy_tools
+from pycti_mcp.report_buckets import ReportBucketConfig
+from pycti_mcp.workers import Supervisor, WorkersConfig
+from starlette.responses import PlainTextResponse
 
 
 def main():
@@ -27,6 +50,21 @@ def main():
         action="store_true",
         help="Start an SSE server (default: off)",
     )
+    ap.add_argument(
+        "-w",
+        "--workers",
+        required=False,
+        type=int,
+        default=int(os.getenv("OPENCTI_MCP_WORKERS", "1")),
+        help="Number of worker processes serving HTTP on the port, with -s/--sse (default 1). Send the main process SIGHUP to restart them one at a time - Can also be provided in OPENCTI_MCP_WORKERS environment variable",
+    )
+    ap.add_argument(
+        "--graceful-timeout",
+        required=False,
+        type=int,
+        default=int(os.getenv("OPENCTI_MCP_GRACEFUL_TIMEOUT", "30")),
+        help="How long, in seconds, a stopping HTTP worker is given to finish the requests in progress (default 30) - Can also be provided in OPENCTI_MCP_GRACEFUL_TIMEOUT environment variable",
+    )
     ap.add_argument(
         "-v",
         "--verbose",
@@ -35,6 +73,14 @@ def main():
         action="store_true",
         help="Run in VERBOSE mode (INFO level logging). Default: off (WARN level logging)",
     )
+    ap.add_argument(
+        "-d",
+        "--debug",
+        required=False,
+        default=False,
+        action="store_true",
+        help="Run in DEBUG mode (DEBUG level logging), which also sends the raw and parsed OpenCTI data to the client as debug messages. Default: off",
+    )
     ap.add_argument(
         "-u",
         "--url",
@@ -49,31 +95,504 @@ def main():
         default=os.getenv("OPENCTI_KEY", ""),
         help="OpenCTI API Key - Can also be provided in OPENCTI_KEY environment variable",
     )
+    ap.add_argument(
+        "--pool-size",
+        required=False,
+        type=int,
+        default=int(os.getenv("OPENCTI_POOL_SIZE", "8")),
+        help="Max number of pooled keep-alive OpenCTI client connections, and of worker threads running concurrent OpenCTI requests (default 8) - Can also be provided in OPENCTI_POOL_SIZE environment variable",
+    )
+    ap.add_argument(
+        "--queue-depth",
+        required=False,
+        type=int,
+        default=int(os.getenv("OPENCTI_QUEUE_DEPTH", "64")),
+        help="Max number of OpenCTI requests allowed to wait for a free worker thread before new requests are rejected (default 64) - Can also be provided in OPENCTI_QUEUE_DEPTH environment variable",
+    )
+    ap.add_argument(
+        "--batch-size",
+        required=False,
+        type=int,
+        default=int(os.getenv("OPENCTI_BATCH_SIZE", "100")),
+        help="Max number of values sent to OpenCTI in one request by the batch lookup tools (default 100) - Can also be provided in OPENCTI_BATCH_SIZE environment variable",
+    )
+    ap.add_argument(
+        "--upstream-retries",
+        required=False,
+        type=int,
+        default=int(os.getenv("OPENCTI_UPSTREAM_RETRIES", "2")),
+        help="Max number of times an OpenCTI request which failed in transit, or because OpenCTI was overloaded, is retried (default 2) - Can also be provided in OPENCTI_UPSTREAM_RETRIES environment variable",
+    )
+    ap.add_argument(
+        "--circuit-cooldown",
+        required=False,
+        type=int,
+        default=int(os.getenv("OPENCTI_CIRCUIT_COOLDOWN", "30")),
+        help="How long, in seconds, tool calls fail at once without sending requests to OpenCTI, after most recent requests failed (default 30) - Can also be provided in OPENCTI_CIRCUIT_COOLDOWN environment variable",
+    )
+    ap.add_argument(
+        "--no-governor",
+        required=False,
+        default=False,
+        action="store_true",
+        help="Disable the adaptive limit on concurrent OpenCTI requests, the retries, and the circuit breaker (default: off)",
+    )
+    ap.add_argument(
+        "--max-bytes",
+        required=False,
+        type=int,
+        default=int(os.getenv("OPENCTI_MAX_BYTES", str(BudgetConfig.max_bytes))),
+        help="Default max size, in bytes, of each tool response. Larger responses are cut short, with counts of what was left out. 0 for no limit (default 262144) - Can also be provided in OPENCTI_MAX_BYTES environment variable",
+    )
+    ap.add_argument(
+        "--no-cache",
+        required=False,
+        default=False,
+        action="store_true",
+        help="Disable caching of tool responses (default: off)",
+    )
+    ap.add_argument(
+        "--cache-entries",
+        required=False,
+        type=int,
+        default=int(os.getenv("OPENCTI_CACHE_ENTRIES", "4096")),
+        help="Max number of cached tool responses (default 4096) - Can also be provided in OPENCTI_CACHE_ENTRIES environment variable",
+    )
+    ap.add_argument(
+        "--cache-memory",
+        required=False,
+        type=int,
+        default=int(os.getenv("OPENCTI_CACHE_MEMORY", "64")),
+        help="Max size of the cached tool responses, in MiB (default 64) - Can also be provided in OPENCTI_CACHE_MEMORY environment variable",
+    )
+    ap.add_argument(
+        "--cache-ttl",
+        required=False,
+        action="append",
+        default=[],
+        metavar="[TOOL=]SECONDS",
+        help="How long tool responses stay cached. Given as SECONDS, sets the default for all tools (default 300), or as TOOL=SECONDS for a single tool. May be repeated",
+    )
+    ap.add_argument(
+        "--negative-cache-ttl",
+        required=False,
+        type=int,
+        default=int(os.getenv("OPENCTI_NEGATIVE_CACHE_TTL", "60")),
+        help="How long, in seconds, not-found results from the observable, indicator, adversary, and report contents lookups stay cached (default 60) - Can also be provided in OPENCTI_NEGATIVE_CACHE_TTL environment variable",
+    )
+    ap.add_argument(
+        "--negative-cache-entries",
+        required=False,
+        type=int,
+        default=int(os.getenv("OPENCTI_NEGATIVE_CACHE_ENTRIES", "16384")),
+        help="Max number of cached not-found results (default 16384) - Can also be provided in OPENCTI_NEGATIVE_CACHE_ENTRIES environment variable",
+    )
+    ap.add_argument(
+        "--no-entity-store",
+        required=False,
+        default=False,
+        action="store_true",
+        help="Disable answering lookups by Id from the observables and indicators in earlier tool responses (default: off)",
+    )
+    ap.add_argument(
+        "--entity-store-entries",
+        required=False,
+        type=int,
+        default=int(os.getenv("OPENCTI_ENTITY_STORE_ENTRIES", "16384")),
+        help="Max number of observables and indicators kept from tool responses (default 16384) - Can also be provided in OPENCTI_ENTITY_STORE_ENTRIES environment variable",
+    )
+    ap.add_argument(
+        "--entity-store-memory",
+        required=False,
+        type=int,
+        default=int(os.getenv("OPENCTI_ENTITY_STORE_MEMORY", "32")),
+        help="Max size of the observables and indicators kept from tool responses, in MiB (default 32) - Can also be provided in OPENCTI_ENTITY_STORE_MEMORY environment variable",
+    )
+    ap.add_argument(
+        "--entity-store-check",
+        required=False,
+        type=int,
+        default=int(os.getenv("OPENCTI_ENTITY_STORE_CHECK", "60")),
+        help="How long, in seconds, a kept observable or indicator is returned before checking with OpenCTI that it hasn't been updated (default 60) - Can also be provided in OPENCTI_ENTITY_STORE_CHECK environment variable",
+    )
+    ap.add_argument(
+        "--entity-store-max-age",
+        required=False,
+        type=int,
+        default=int(os.getenv("OPENCTI_ENTITY_STORE_MAX_AGE", "300")),
+        help="How long, in seconds, the reports, cases, groupings, notes, and opinions listed on a kept observable are returned, as they change without it being updated (default 300) - Can also be provided in OPENCTI_ENTITY_STORE_MAX_AGE environment variable",
+    )
+    ap.add_argument(
+        "--report-day-ttl",
+        required=False,
+        type=int,
+        default=int(os.getenv("OPENCTI_REPORT_DAY_TTL", "21600")),
+        help="How long, in seconds, the reports published on a day more than a day ago stay cached, for report date ranges to be assembled from (default 21600). Later days are cached for the opencti_reports_lookup TTL - Can also be provided in OPENCTI_REPORT_DAY_TTL environment variable",
+    )
+    ap.add_argument(
+        "--no-report-days",
+        required=False,
+        default=False,
+        action="store_true",
+        help="Disable caching the reports published on each day, so that every report date range is queried from OpenCTI as a whole (default: off)",
+    )
+    ap.add_argument(
+        "--no-coalesce",
+        required=False,
+        default=False,
+        action="store_true",
+        help="Run every tool call on its own, rather than having identical concurrent calls share one call's result (default: off)",
+    )
+    ap.add_argument(
+        "--membership-filter",
+        required=False,
+        default=False,
+        action="store_true",
+        help="Keep an in-memory filter of the observables in OpenCTI, refreshed in the background, so lookups of unknown observables don't need a request (default: off)",
+    )
+    ap.add_argument(
+        "--membership-refresh",
+        required=False,
+        type=int,
+        default=int(os.getenv("OPENCTI_MEMBERSHIP_REFRESH", "900")),
+        help="How often, in seconds, new and changed observables are added to the membership filter (default 900) - Can also be provided in OPENCTI_MEMBERSHIP_REFRESH environment variable",
+    )
+    ap.add_argument(
+        "--membership-snapshot",
+        required=False,
+        default=os.getenv("OPENCTI_MEMBERSHIP_SNAPSHOT"),
+        help="File the membership filter is saved to after each refresh, and loaded from at startup - Can also be provided in OPENCTI_MEMBERSHIP_SNAPSHOT environment variable",
+    )
+    ap.add_argument(
+        "--alias-index",
+        required=False,
+        default=False,
+        action="store_true",
+        help="Keep an in-memory index of the names and aliases of the adversaries in OpenCTI, prefetched at startup and refreshed in the background, so adversary names are resolved (allowing for slight misspellings) before any request, and unknown names don't need one (default: off)",
+    )
+    ap.add_argument(
+        "--alias-index-refresh",
+        required=False,
+        type=int,
+        default=int(os.getenv("OPENCTI_ALIAS_INDEX_REFRESH", "900")),
+        help="How often, in seconds, the adversary alias index is rebuilt (default 900) - Can also be provided in OPENCTI_ALIAS_INDEX_REFRESH environment variable",
+    )
+    ap.add_argument(
+        "--alias-index-snapshot",
+        required=False,
+        default=os.getenv("OPENCTI_ALIAS_INDEX_SNAPSHOT"),
+        help="File the adversary alias index is saved to after each refresh, and loaded from at startup - Can also be provided in OPENCTI_ALIAS_INDEX_SNAPSHOT environment variable",
+    )
+    ap.add_argument(
+        "--alias-fuzzy-cutoff",
+        required=False,
+        type=float,
+        default=float(os.getenv("OPENCTI_ALIAS_FUZZY_CUTOFF", "0.85")),
+        help="How similar (from 0 to 1) a name has to be to an adversary's name or alias in the alias index to be resolved to it, when no adversary has that exact name (default 0.85). 1 allows no misspellings - Can also be provided in OPENCTI_ALIAS_FUZZY_CUTOFF environment variable",
+    )
+    ap.add_argument(
+        "--mirror",
+        required=False,
+        default=False,
+        action="store_true",
+        help="Keep a local copy of the observables, indicators, adversaries, and reports in OpenCTI, loaded at startup and kept up to date from the OpenCTI stream, and answer lookups from it (default: off)",
+    )
+    ap.add_argument(
+        "--mirror-path",
+        required=False,
+        default=os.getenv("OPENCTI_MIRROR_PATH"),
+        help="SQLite database file the mirror is kept in, so that a restarted server resumes from it rather than reloading it (default: in memory) - Can also be provided in OPENCTI_MIRROR_PATH environment variable",
+    )
+    ap.add_argument(
+        "--mirror-stream",
+        required=False,
+        default=os.getenv("OPENCTI_MIRROR_STREAM"),
+        help="Id of the OpenCTI live stream the mirror follows (default: the raw stream, which needs an administrator's API key) - Can also be provided in OPENCTI_MIRROR_STREAM environment variable",
+    )
+    ap.add_argument(
+        "--mirror-max-lag",
+        required=False,
+        type=int,
+        default=int(os.getenv("OPENCTI_MIRROR_MAX_LAG", "60")),
+        help="Max number of seconds the mirror may be behind OpenCTI for lookups to be answered from it, rather than OpenCTI (default 60) - Can also be provided in OPENCTI_MIRROR_MAX_LAG environment variable",
+    )
+    ap.add_argument(
+        "--pattern-index",
+        required=False,
+        default=False,
+        action="store_true",
+        help="Keep a local trigram index of the indicator patterns in OpenCTI, refreshed in the background, to narrow indicator pattern searches down before querying OpenCTI (default: off)",
+    )
+    ap.add_argument(
+        "--pattern-index-path",
+        required=False,
+        default=os.getenv("OPENCTI_PATTERN_INDEX_PATH"),
+        help="SQLite database file the pattern index is kept in, so that a restarted server resumes from it rather than rebuilding it (default: in memory) - Can also be provided in OPENCTI_PATTERN_INDEX_PATH environment variable",
+    )
+    ap.add_argument(
+        "--pattern-index-refresh",
+        required=False,
+        type=int,
+        default=int(os.getenv("OPENCTI_PATTERN_INDEX_REFRESH", "300")),
+        help="How often, in seconds, new and changed indicators are added to the pattern index in the background (default 300). Searches also catch the index up first, if it is more than a few seconds old - Can also be provided in OPENCTI_PATTERN_INDEX_REFRESH environment variable",
+    )
+    ap.add_argument(
+        "--no-metrics",
+        required=False,
+        default=False,
+        action="store_true",
+        help="Disable the per-tool metrics, and the /metrics endpoint served in SSE mode (default: off)",
+    )
+    ap.add_argument(
+        "--no-health-check",
+        required=False,
+        default=False,
+        action="store_true",
+        help="Skip the OpenCTI health check performed when the first pooled client connects (default: off)",
+    )
+    # Passed to each of the worker processes by the one supervising them (see run_workers())
+    ap.add_argument("--worker-socket", type=int, help=SUPPRESS)
+    ap.add_argument("--worker-ready", type=int, help=SUPPRESS)
+    ap.add_argument("--worker-index", type=int, help=SUPPRESS)
     args = ap.parse_args()
 
-    if args.verbose:
+    if args.workers > 1 and not args.sse:
+        ap.error("-w/--workers can only be used with -s/--sse")
+    if args.workers > 1 and os.name != "posix":
+        ap.error("-w/--workers is only supported on POSIX platforms")
+
+    if args.debug:
+        logging.basicConfig(level="DEBUG")
+    elif args.verbose:
         logging.basicConfig(level="INFO")
     else:
         logging.basicConfig(level="WARN")
 
+    # Configure the process-wide OpenCTI client pool shared by all of the tools
+    PoolConfig.pool_size = args.pool_size
+    PoolConfig.health_check = not args.no_health_check
+    ExecutorConfig.max_workers = args.pool_size
+    ExecutorConfig.queue_depth = args.queue_depth
+    ExecutorConfig.batch_size = args.batch_size
+
+    # Configure the governor of OpenCTI requests
+    GovernorConfig.enabled = not args.no_governor
+    GovernorConfig.retries = args.upstream_retries
+    GovernorConfig.breaker_cooldown = args.circuit_cooldown
+
+    # Configure the response size budget
+    BudgetConfig.max_bytes = args.max_bytes
+
+    # Configure the tool response cache
+    CacheConfig.enabled = not args.no_cache
+    CacheConfig.max_entries = args.cache_entries
+    CacheConfig.max_bytes = args.cache_memory * 1024 * 1024
+    CacheConfig.negative_ttl = args.negative_cache_ttl
+    CacheConfig.negative_max_entries = args.negative_cache_entries
+    for ttl in args.cache_ttl:
+        tool, _, seconds = ttl.rpartition("=")
+        if tool:
+            CacheConfig.ttl[tool] = int(seconds)
+        else:
+            CacheConfig.default_ttl = int(seconds)
+
+    # Configure the store of the entities seen in tool responses
+    EntityStoreConfig.enabled = not args.no_entity_store
+    EntityStoreConfig.max_entries = args.entity_store_entries
+    EntityStoreConfig.max_bytes = args.entity_store_memory * 1024 * 1024
+    EntityStoreConfig.check_after = args.entity_store_check
+    EntityStoreConfig.max_age = args.entity_store_max_age
+
+    # Configure the cache of the reports published on each day
+    ReportBucketConfig.enabled = not args.no_report_days
+    ReportBucketConfig.closed_ttl = args.report_day_ttl
+
+    # Configure the coalescing of identical concurrent tool calls
+    CoalesceConfig.enabled = not args.no_coalesce
+
+    # Configure the optional observable membership filter
+    MembershipConfig.enabled = args.membership_filter
+    MembershipConfig.refresh_interval = args.membership_refresh
+    MembershipConfig.snapshot_path = args.membership_snapshot
+
+    # Configure the optional adversary alias index
+    AliasIndexConfig.enabled = args.alias_index
+    AliasIndexConfig.refresh_interval = args.alias_index_refresh
+    AliasIndexConfig.snapshot_path = args.alias_index_snapshot
+    AliasIndexConfig.fuzzy_cutoff = args.alias_fuzzy_cutoff
+
+    # Configure the optional local mirror
+    MirrorConfig.enabled = args.mirror
+    MirrorConfig.path = args.mirror_path
+    MirrorConfig.stream_id = args.mirror_stream
+    MirrorConfig.max_lag = args.mirror_max_lag
+
+    # Configure the optional indicator pattern index
+    PatternIndexConfig.enabled = args.pattern_index
+    PatternIndexConfig.path = args.pattern_index_path
+    PatternIndexConfig.refresh_interval = args.pattern_index_refresh
+
+    # Configure the per-tool metrics
+    MetricsConfig.enabled = not args.no_metrics
+
+    # Configure the HTTP worker processes, which are started instead of serving from this one
+    WorkersConfig.workers = args.workers
+    WorkersConfig.graceful_timeout = args.graceful_timeout
+    if args.workers > 1 and args.worker_socket is None:
+        run_workers(args)
+        return
+
+    mcp = FastMCP("OpenCTI.MCP", tool_serializer=encoding.dumps_str)
+    register_tools(mcp, args.url, args.key)
+
+    # Expose the metrics for Prometheus to scrape, when serving over HTTP
+    if args.sse and MetricsConfig.enabled:
+
+        @mcp.custom_route("/metrics", methods=["GET"])
+        async def metrics(request):
+            return PlainTextResponse(
+                get_metrics().render(),
+                media_type="text/plain; version=0.0.4",
+            )
+
+    asyncio.run(serve(mcp, args))
+
+
+def register_tools(mcp, url, key):
     log = logging.getLogger(__name__)
 
-    mcp = FastMCP("OpenCTI.MCP")
+    # List the tools from the schemas in the static registry, so that their modules (and pycti)
+    # are only imported once a tool is called, and the MCP handshake isn't held up by them
+    try:
+        register_lazy_tools(mcp, url, key, read_registry())
+        return
+    except Exception as e:
+        log.warning(
+            f"Failed to load the tool registry, importing every tool instead: {e}"
+        )
 
     # Dynamically walk through ./pycti_tools/ and import each tool into MCP via its init_tool fn
     for m in pycti_mcp.pycti_tools.__all__:
         tmpmod = importlib.import_module(f"pycti_mcp.pycti_tools.{m}")
         try:
-            mcp.tool(tmpmod.tool_init(url=args.url, key=args.key))
+            tool = coalesce_tool(tmpmod.tool_init(url=url, key=key))
+            mcp.tool(instrument_tool(tool))
             log.info(f"Added Tool {m} to MCP")
         except Exception as e:
             log.critical(f"Failed to load ToolSpec from pycti_tools.{m}")
             raise e
 
-    if args.sse:
-        asyncio.run(mcp.run_http_async(port=args.port))
-    else:
-        asyncio.run(mcp.run_stdio_async())
+
+def run_workers(args):
+    """Serve HTTP from several worker processes, supervising them until stopped"""
+    log = logging.getLogger(__name__)
+
+    # The workers share the mirror, pattern index, membership filter, and alias index through
+    # their files, which the first worker keeps up to date. Those not given a file are kept in a
+    # temporary directory for as long as the server runs.
+    with tempfile.TemporaryDirectory(prefix="pycti-mcp-") as tmp:
+        shared = []
+        if MembershipConfig.enabled and args.url:
+            path = MembershipConfig.snapshot_path or os.path.join(tmp, "membership")
+            shared += ["--membership-snapshot", path]
+        if AliasIndexConfig.enabled and args.url:
+            path = AliasIndexConfig.snapshot_path or os.path.join(tmp, "aliases.json")
+            shared += ["--alias-index-snapshot", path]
+        if MirrorConfig.enabled and args.url:
+            path = MirrorConfig.path or os.path.join(tmp, "mirror.sqlite")
+            shared += ["--mirror-path", path]
+            # Opened here first, so that a file kept from some other OpenCTI platform is
+            # cleared before any of the workers can read it
+            Mirror(path, args.url).db.close()
+        if PatternIndexConfig.enabled and args.url:
+            path = PatternIndexConfig.path or os.path.join(tmp, "patterns.sqlite")
+            shared += ["--pattern-index-path", path]
+            try:
+                PatternIndex(path, args.url).db.close()
+            except sqlite3.OperationalError as e:
+                log.error(f"Failed to open the pattern index: {e}")
+
+        host = fastmcp.settings.host
+        sock = socket.create_server(
+            (host, args.port),
+            family=socket.AF_INET6 if ":" in host else socket.AF_INET,
+            backlog=2048,
+        )
+
+        def command(index, socket_fd, ready_fd):
+            return [
+                sys.executable,
+                "-m",
+                "pycti_mcp.mcp_server_octi",
+                *sys.argv[1:],
+                *shared,
+                "--worker-socket",
+                str(socket_fd),
+                "--worker-ready",
+                str(ready_fd),
+                "--worker-index",
+                str(index),
+            ]
+
+        log.info(f"Starting {args.workers} workers on port {args.port}")
+        with sock:
+            Supervisor(sock, command).run()
+
+
+async def serve_worker(mcp, args):
+    """Serve HTTP from a worker process started by run_workers(), on the listening socket it
+    inherited, telling the supervisor once it has started up. FastMCP's run_http_async() only
+    serves on a socket of its own, so the worker runs FastMCP's app with uvicorn itself.
+    """
+    log = logging.getLogger(__name__)
+    # A client's requests may each reach a different worker, so none can keep sessions
+    app = mcp.http_app(stateless_http=True)
+    server = uvicorn.Server(
+        uvicorn.Config(
+            app,
+            lifespan="on",
+            timeout_graceful_shutdown=WorkersConfig.graceful_timeout,
+            log_level=fastmcp.settings.log_level.lower(),
+        )
+    )
+
+    # Connections made before the worker's server starts accepting them wait in the backlog
+    os.write(args.worker_ready, b"1")
+    os.close(args.worker_ready)
+    log.info(f"Worker {args.worker_index} serving on port {args.port}")
+    await server.serve(sockets=[socket.socket(fileno=args.worker_socket)])
+
+
+async def serve(mcp, args):
+    # Start any background jobs, which run alongside the MCP server on its event loop. With
+    # several HTTP workers, only the first keeps the shared files up to date.
+    follower = bool(args.worker_index)
+    jobs = []
+    if MembershipConfig.enabled and args.url:
+        jobs.append(
+            asyncio.create_task(run_membership_refresh(args.url, args.key, follower))
+        )
+    if AliasIndexConfig.enabled and args.url:
+        jobs.append(
+            asyncio.create_task(run_alias_index_refresh(args.url, args.key, follower))
+        )
+    if MirrorConfig.enabled and args.url:
+        jobs.append(asyncio.create_task(run_mirror(args.url, args.key, follower)))
+    if PatternIndexConfig.enabled and args.url:
+        jobs.append(
+            asyncio.create_task(run_pattern_index(args.url, args.key, follower))
+        )
+
+    try:
+        if args.sse and args.worker_socket is not None:
+            await serve_worker(mcp, args)
+        elif args.sse:
+            await mcp.run_http_async(port=args.port)
+        else:
+            await mcp.run_stdio_async()
+    finally:
+        for job in jobs:
+            job.cancel()
 
 
 if __name__ == "__main__":
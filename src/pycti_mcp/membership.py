@@ -0,0 +1,285 @@
+import asyncio
+import hashlib
+import json
+import logging
+import math
+import os
+import time
+
+from pycti_mcp.client_pool import get_client_pool
+from pycti_mcp.metrics import current_tool
+from pycti_mcp.workers import WorkersConfig
+
+
+# Settings for the optional in-memory filter of observables known to OpenCTI. These are
+# overwritten by the command-line handling in mcp_server_octi.main().
+class MembershipConfig:
+    enabled = False
+    refresh_interval = 900
+    fp_rate = 0.01
+    snapshot_path = None
+    page_size = 500
+
+
+class BloomFilter:
+    """A fixed-size Bloom filter of strings. Membership tests may return false positives (at a
+    rate of about fp_rate once capacity values are added), but never false negatives."""
+
+    def __init__(self, capacity, fp_rate, bits=None, hashes=None, data=None, count=0):
+        self.capacity = capacity
+        self.fp_rate = fp_rate
+        self.bits = bits or max(
+            64, int(-capacity * math.log(fp_rate) / (math.log(2) ** 2))
+        )
+        self.hashes = hashes or max(1, round(self.bits / capacity * math.log(2)))
+        self.data = data or bytearray((self.bits + 7) // 8)
+        self.count = count
+
+    def _positions(self, value):
+        digest = hashlib.blake2b(value.encode("utf-8"), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        return [(h1 + i * h2) % self.bits for i in range(self.hashes)]
+
+    def add(self, value):
+        for p in self._positions(value):
+            self.data[p >> 3] |= 1 << (p & 7)
+        self.count += 1
+
+    def __contains__(self, value):
+        return all(self.data[p >> 3] & (1 << (p & 7)) for p in self._positions(value))
+
+    def estimated_fp_rate(self):
+        # Probability that all of the hashed bits of an absent value happen to be set
+        bits_set = sum(b.bit_count() for b in self.data)
+        return (bits_set / self.bits) ** self.hashes
+
+    def full(self):
+        return self.count >= self.capacity
+
+
+class ObservableMembership:
+    """Tracks which observable values and Ids exist in OpenCTI, so that lookups of observables
+    which definitely don't exist can be answered without a request. Values are added (and
+    checked) case-folded, since OpenCTI normalizes the case of some observable values.
+    """
+
+    def __init__(self, url):
+        self.url = url
+        self.filter = None
+        self.last_updated = None
+        self.last_refresh = None
+        self.rebuild = True
+
+    def ready(self):
+        return self.filter is not None
+
+    def current(self):
+        """Whether the filter has been refreshed recently enough to answer lookups with: within
+        the refresh interval, allowing for one refresh running late (or for a snapshot, its
+        last refresh before it was saved)"""
+        return (
+            self.last_refresh is not None
+            and time.time() - self.last_refresh < 2 * MembershipConfig.refresh_interval
+        )
+
+    def might_exist(self, value):
+        # Until the filter has been built, everything might exist
+        return self.filter is None or value.casefold() in self.filter
+
+    async def refresh(self, pool):
+        """Page through the observables created or changed since the last refresh, adding them
+        to the filter. Builds a new filter from scratch on the first run, or if the current
+        one has filled up."""
+        since = None if self.rebuild else self.last_updated
+        bloom = None if self.rebuild else self.filter
+        last_updated = since
+        after = None
+
+        while True:
+            page = await pool.run(list_observable_ids, since, after)
+            if bloom is None:
+                # Leave room for the platform to grow before the filter has to be rebuilt. Each
+                # observable contributes its value and both of its Ids.
+                total = page["pagination"].get("globalCount") or 0
+                bloom = BloomFilter(max(3 * 2 * total, 1024), MembershipConfig.fp_rate)
+
+            for o in page["entities"]:
+                for v in [o["observable_value"], o["id"], o["standard_id"]]:
+                    if v:
+                        bloom.add(v.casefold())
+                if o["updated_at"] and (
+                    not last_updated or o["updated_at"] > last_updated
+                ):
+                    last_updated = o["updated_at"]
+
+            if not page["pagination"].get("hasNextPage"):
+                break
+            after = page["pagination"]["endCursor"]
+
+        self.filter = bloom
+        self.last_updated = last_updated
+        self.rebuild = bloom.full()
+        self.last_refresh = time.time()
+
+    def stats(self):
+        if self.filter is None:
+            return {"ready": False}
+        return {
+            "ready": True,
+            "values": self.filter.count,
+            "capacity": self.filter.capacity,
+            "memory_bytes": len(self.filter.data),
+            "estimated_fp_rate": self.filter.estimated_fp_rate(),
+            "last_updated": self.last_updated,
+            "last_refresh": self.last_refresh,
+        }
+
+    def save(self, path):
+        header = {
+            "url": self.url,
+            "capacity": self.filter.capacity,
+            "fp_rate": self.filter.fp_rate,
+            "bits": self.filter.bits,
+            "hashes": self.filter.hashes,
+            "count": self.filter.count,
+            "last_updated": self.last_updated,
+            "last_refresh": self.last_refresh,
+        }
+
+        # Write to a temporary file first, so that a crash never leaves a partial snapshot
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(json.dumps(header).encode("utf-8") + b"\n")
+            f.write(self.filter.data)
+        os.replace(tmp_path, path)
+
+    def load(self, path):
+        with open(path, "rb") as f:
+            header = json.loads(f.readline())
+            data = bytearray(f.read())
+
+        # A snapshot of some other OpenCTI platform is of no use
+        if header["url"] != self.url:
+            return False
+
+        self.filter = BloomFilter(
+            header["capacity"],
+            header["fp_rate"],
+            bits=header["bits"],
+            hashes=header["hashes"],
+            data=data,
+            count=header["count"],
+        )
+        self.last_updated = header["last_updated"]
+        self.last_refresh = header.get("last_refresh")
+        self.rebuild = self.filter.full()
+        return True
+
+
+# Fetch one page of observable values and Ids, optionally only those updated since then
+def list_observable_ids(octi, since, after):
+    filters = None
+    if since:
+        filters = {
+            "mode": "and",
+            "filters": [{"key": "updated_at", "values": [since], "operator": "gte"}],
+            "filterGroups": [],
+        }
+
+    return octi.stix_cyber_observable.list(
+        filters=filters,
+        first=MembershipConfig.page_size,
+        after=after,
+        orderBy="updated_at",
+        orderMode="asc",
+        withPagination=True,
+        customAttributes="""
+            id
+            standard_id
+            observable_value
+            updated_at
+        """,
+    )
+
+
+_membership = None
+
+
+def get_membership():
+    """Return the observable membership filter, or None if it hasn't been enabled"""
+    return _membership
+
+
+def might_exist(value):
+    """Returns False only if value definitely isn't an observable (value or Id) in OpenCTI. A
+    filter which hasn't been refreshed for too long (as when OpenCTI can't be reached) is no
+    longer used."""
+    if _membership is None or not _membership.current():
+        return True
+    return _membership.might_exist(value)
+
+
+def load_snapshot(membership, path):
+    log = logging.getLogger(__name__)
+    try:
+        if membership.load(path):
+            log.info(f"Loaded observable membership snapshot from {path}")
+    except (OSError, ValueError, KeyError) as e:
+        log.warning(f"Ignoring unreadable membership snapshot {path}: {e}")
+
+
+def snapshot_mtime(path):
+    try:
+        return os.stat(path).st_mtime_ns
+    except OSError:
+        return None
+
+
+def snapshot_is_current(mtime):
+    """Whether a snapshot was saved recently enough to have been caught up by a refresh of the
+    worker which saves them (one refresh may be running late)"""
+    return time.time() - mtime / 1e9 < 2 * MembershipConfig.refresh_interval
+
+
+async def run_membership_refresh(url, key, follower=False):
+    """Background task which keeps the observable membership filter up to date, starting from
+    the persisted snapshot, if there is one. A follower (one of several HTTP workers, other
+    than the first) instead loads each snapshot the first saves.
+
+    A snapshot may be long out of date, so lookups are only answered from the filter once it
+    has been caught up: by a refresh, or for a follower, by the snapshot being saved after one.
+    They stop being answered from it if the refreshes then fail for too long (see current()).
+    """
+    global _membership
+    log = logging.getLogger(__name__)
+    # Report the refresh requests in the metrics as if they came from a tool of this name
+    current_tool.set("membership_refresh")
+    membership = ObservableMembership(url)
+    path = MembershipConfig.snapshot_path
+
+    loaded_mtime = snapshot_mtime(path) if path else None
+    if loaded_mtime is not None:
+        load_snapshot(membership, path)
+
+    while follower:
+        current = loaded_mtime is not None and snapshot_is_current(loaded_mtime)
+        _membership = membership if current and membership.ready() else None
+        await asyncio.sleep(WorkersConfig.reload_interval)
+        mtime = snapshot_mtime(path)
+        if mtime is not None and mtime != loaded_mtime:
+            await asyncio.to_thread(load_snapshot, membership, path)
+            loaded_mtime = mtime
+
+    pool = get_client_pool(url, key)
+    while True:
+        try:
+            await membership.refresh(pool)
+            _membership = membership
+            log.info(f"Refreshed observable membership filter: {membership.stats()}")
+            if path:
+                await asyncio.to_thread(membership.save, path)
+        except Exception as e:
+            log.error(f"Failed to refresh observable membership filter: {e}")
+
+        await asyncio.sleep(MembershipConfig.refresh_interval)
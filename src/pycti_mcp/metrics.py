@@ -0,0 +1,395 @@
+import contextvars
+import functools
+import logging
+import threading
+import time
+from bisect import bisect_left
+
+from pycti_mcp.cache import get_negative_cache, get_response_cache
+from pycti_mcp import encoding
+from pycti_mcp.entity_store import get_entity_store
+
+
+# Settings for the per-tool metrics. These are overwritten by the command-line handling in
+# mcp_server_octi.main().
+class MetricsConfig:
+    enabled = True
+    # Upper bounds, in seconds, of the latency histogram buckets
+    latency_buckets = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30]
+    # Upper bounds, in bytes, of the response size histogram buckets
+    size_buckets = [256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304]
+
+
+# The type and HELP text of each of the caches' stats, rendered as pycti_mcp_cache_{stat}
+cache_stats = {
+    "entries": ("gauge", "Entries in the cache"),
+    "bytes": ("gauge", "Approximate size of the cached entries, in bytes"),
+    "hits": ("counter", "Cache lookups which found an entry"),
+    "misses": ("counter", "Cache lookups which found no entry"),
+    "evictions": ("counter", "Entries evicted to keep the cache within its bounds"),
+    "expirations": ("counter", "Entries dropped once past their TTL"),
+}
+
+# The name of the tool being run by the current task. Copied into the upstream worker threads
+# along with the rest of the context (see executor.run_blocking()), so that the requests made
+# and the parsing done on behalf of a tool call are attributed to that tool.
+current_tool = contextvars.ContextVar("current_tool", default=None)
+
+# The errors handled so far by the tool call in progress (see record_error()). A list, shared
+# with the tasks the call fans out to, so that the call is counted as failed once in
+# instrument_tool(), however many of its requests failed.
+call_errors = contextvars.ContextVar("call_errors", default=None)
+
+
+class Histogram:
+    """Cumulative-bucket histogram, in the form Prometheus expects"""
+
+    def __init__(self, buckets):
+        self.buckets = list(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative(self):
+        total = 0
+        for bound, n in zip(self.buckets + ["+Inf"], self.counts):
+            total += n
+            yield bound, total
+
+
+class ToolMetrics:
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0
+        # Calls which shared the result of an identical call already in progress
+        self.coalesced = 0
+        self.round_trips = 0
+        self.request_bytes = 0
+        self.response_bytes = 0
+        self.latency = Histogram(MetricsConfig.latency_buckets)
+        self.parse_time = Histogram(MetricsConfig.latency_buckets)
+        self.response_size = Histogram(MetricsConfig.size_buckets)
+
+
+class Metrics:
+    """Thread-safe registry of the metrics for each tool"""
+
+    def __init__(self):
+        self._tools = {}
+        self._lock = threading.Lock()
+
+    def _tool(self, tool):
+        m = self._tools.get(tool)
+        if m is None:
+            m = self._tools[tool] = ToolMetrics()
+        return m
+
+    def record_call(self, tool, seconds, failed):
+        with self._lock:
+            m = self._tool(tool)
+            m.calls += 1
+            m.latency.observe(seconds)
+            if failed:
+                m.errors += 1
+
+    def record_error(self, tool):
+        with self._lock:
+            self._tool(tool).errors += 1
+
+    def record_coalesced(self, tool):
+        with self._lock:
+            self._tool(tool).coalesced += 1
+
+    def record_round_trip(self, tool, request_bytes, response_bytes):
+        with self._lock:
+            m = self._tool(tool)
+            m.round_trips += 1
+            m.request_bytes += request_bytes
+            m.response_bytes += response_bytes
+            m.response_size.observe(response_bytes)
+
+    def record_parse(self, tool, seconds):
+        with self._lock:
+            self._tool(tool).parse_time.observe(seconds)
+
+    def stats(self):
+        with self._lock:
+            return {
+                tool: {
+                    "calls": m.calls,
+                    "errors": m.errors,
+                    "coalesced": m.coalesced,
+                    "round_trips": m.round_trips,
+                    "request_bytes": m.request_bytes,
+                    "response_bytes": m.response_bytes,
+                    "latency_seconds": m.latency.sum,
+                    "parse_seconds": m.parse_time.sum,
+                }
+                for tool, m in self._tools.items()
+            }
+
+    def render(self):
+        """Render the metrics in the Prometheus text exposition format"""
+        lines = []
+
+        def header(name, kind, text):
+            lines.append(f"# HELP {name} {text}")
+            lines.append(f"# TYPE {name} {kind}")
+
+        def counter(name, text, attr):
+            header(name, "counter", text)
+            for tool, m in self._tools.items():
+                lines.append(f'{name}{{tool="{tool}"}} {getattr(m, attr)}')
+
+        def histogram(name, text, attr):
+            header(name, "histogram", text)
+            for tool, m in self._tools.items():
+                h = getattr(m, attr)
+                for bound, total in h.cumulative():
+                    lines.append(f'{name}_bucket{{tool="{tool}",le="{bound}"}} {total}')
+                lines.append(f'{name}_sum{{tool="{tool}"}} {h.sum}')
+                lines.append(f'{name}_count{{tool="{tool}"}} {h.count}')
+
+        with self._lock:
+            counter("pycti_mcp_tool_calls_total", "Tool calls", "calls")
+            counter("pycti_mcp_tool_errors_total", "Failed tool calls", "errors")
+            counter(
+                "pycti_mcp_tool_coalesced_total",
+                "Tool calls which shared the result of an identical call in progress",
+                "coalesced",
+            )
+            counter(
+                "pycti_mcp_upstream_requests_total",
+                "GraphQL requests sent to OpenCTI",
+                "round_trips",
+            )
+            counter(
+                "pycti_mcp_upstream_request_bytes_total",
+                "Bytes sent to OpenCTI",
+                "request_bytes",
+            )
+            counter(
+                "pycti_mcp_upstream_response_bytes_total",
+                "Bytes received from OpenCTI",
+                "response_bytes",
+            )
+            histogram("pycti_mcp_tool_latency_seconds", "Tool call latency", "latency")
+            histogram(
+                "pycti_mcp_parse_seconds",
+                "Time spent parsing OpenCTI entities",
+                "parse_time",
+            )
+            histogram(
+                "pycti_mcp_upstream_response_size_bytes",
+                "Size of OpenCTI responses",
+                "response_size",
+            )
+
+        # Each stat is one family, with a sample for each cache
+        caches = [
+            (name, cache.stats())
+            for name, cache in [
+                ("response", get_response_cache()),
+                ("negative", get_negative_cache()),
+                ("entities", get_entity_store()),
+            ]
+            if cache is not None
+        ]
+        for stat, (kind, text) in cache_stats.items():
+            if not caches:
+                break
+            header(f"pycti_mcp_cache_{stat}", kind, text)
+            for name, stats in caches:
+                lines.append(f'pycti_mcp_cache_{stat}{{cache="{name}"}} {stats[stat]}')
+
+        # Imported here, as the governor, the mirror, and the pattern index report their own
+        # requests through this module
+        from pycti_mcp.governor import get_governor
+        from pycti_mcp.mirror import get_mirror
+        from pycti_mcp.pattern_index import get_pattern_index
+
+        governor = get_governor()
+        if governor is not None:
+            stats = governor.stats()
+            header(
+                "pycti_mcp_upstream_limit",
+                "gauge",
+                "Adaptive limit on concurrent OpenCTI requests",
+            )
+            lines.append(f"pycti_mcp_upstream_limit {stats['limit']}")
+            header(
+                "pycti_mcp_upstream_in_flight", "gauge", "OpenCTI requests in progress"
+            )
+            lines.append(f"pycti_mcp_upstream_in_flight {stats['in_flight']}")
+            header(
+                "pycti_mcp_upstream_waiting",
+                "gauge",
+                "OpenCTI requests waiting for the concurrency limit",
+            )
+            lines.append(f"pycti_mcp_upstream_waiting {stats['waiting']}")
+            header(
+                "pycti_mcp_upstream_retries_total",
+                "counter",
+                "Failed OpenCTI requests which were retried",
+            )
+            lines.append(f"pycti_mcp_upstream_retries_total {stats['retries']}")
+            header(
+                "pycti_mcp_circuit_open",
+                "gauge",
+                "Whether the circuit breaker is stopping requests to OpenCTI",
+            )
+            lines.append(
+                f"pycti_mcp_circuit_open {int(stats['circuit_state'] == 'open')}"
+            )
+            header(
+                "pycti_mcp_circuit_rejected_total",
+                "counter",
+                "Requests failed at once by the open circuit breaker",
+            )
+            lines.append(
+                f"pycti_mcp_circuit_rejected_total {stats['circuit_rejected']}"
+            )
+
+        mirror = get_mirror()
+        if mirror is not None:
+            stats = mirror.stats()
+            header(
+                "pycti_mcp_mirror_lag_seconds",
+                "gauge",
+                "How far the local mirror is behind OpenCTI",
+            )
+            if stats["lag_seconds"] is not None:
+                lines.append(f"pycti_mcp_mirror_lag_seconds {stats['lag_seconds']}")
+            header("pycti_mcp_mirror_entities", "gauge", "Entities in the mirror")
+            for kind, n in stats["entities"].items():
+                lines.append(f'pycti_mcp_mirror_entities{{kind="{kind}"}} {n}')
+            header(
+                "pycti_mcp_mirror_events_total",
+                "counter",
+                "OpenCTI stream events applied to the mirror",
+            )
+            lines.append(f"pycti_mcp_mirror_events_total {stats['events']}")
+            header(
+                "pycti_mcp_mirror_lookups_total",
+                "counter",
+                "Lookups answered from the mirror",
+            )
+            lines.append(f"pycti_mcp_mirror_lookups_total {stats['hits']}")
+
+        index = get_pattern_index()
+        if index is not None:
+            stats = index.stats()
+            header(
+                "pycti_mcp_pattern_index_indicators",
+                "gauge",
+                "Indicators in the pattern index",
+            )
+            for pattern_type, n in stats["indicators"].items():
+                lines.append(
+                    f'pycti_mcp_pattern_index_indicators{{pattern_type="{pattern_type}"}} {n}'
+                )
+            header(
+                "pycti_mcp_pattern_index_searches_total",
+                "counter",
+                "Indicator searches narrowed down by the pattern index",
+            )
+            lines.append(f"pycti_mcp_pattern_index_searches_total {stats['searches']}")
+
+        return "\n".join(lines) + "\n"
+
+
+_metrics = Metrics()
+
+
+def get_metrics():
+    return _metrics
+
+
+def instrument_tool(fn):
+    """Wrap a tool function so that its calls, latency, and failures are recorded, and so that
+    the upstream requests it makes are attributed to it"""
+    tool = fn.__name__
+
+    @functools.wraps(fn)
+    async def wrapper(*args, **kwargs):
+        if not MetricsConfig.enabled:
+            return await fn(*args, **kwargs)
+
+        token = current_tool.set(tool)
+        errors = []
+        errors_token = call_errors.set(errors)
+        start = time.perf_counter()
+        failed = True
+        try:
+            result = await fn(*args, **kwargs)
+            failed = bool(errors)
+            return result
+        finally:
+            _metrics.record_call(tool, time.perf_counter() - start, failed)
+            call_errors.reset(errors_token)
+            current_tool.reset(token)
+
+    return wrapper
+
+
+def timed_parse(fn):
+    """Decorator recording the time spent in a parse_* function against the current tool"""
+
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        tool = current_tool.get()
+        if tool is None:
+            return fn(*args, **kwargs)
+
+        start = time.perf_counter()
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            _metrics.record_parse(tool, time.perf_counter() - start)
+
+    return wrapper
+
+
+def record_error():
+    """Note an error handled inside the current tool (e.g. a failed request that the tool
+    reports to the caller instead of raising), so that the call is counted as failed even if it
+    returns. A call is counted once, whether it raises too or handles several errors."""
+    tool = current_tool.get()
+    if tool is None or not MetricsConfig.enabled:
+        return
+    errors = call_errors.get()
+    if errors is None:
+        _metrics.record_error(tool)
+    else:
+        errors.append(tool)
+
+
+def record_coalesced():
+    """Count a call to the current tool which joined an identical call in progress"""
+    tool = current_tool.get()
+    if tool is not None and MetricsConfig.enabled:
+        _metrics.record_coalesced(tool)
+
+
+# requests response hook, installed on the session of each pooled OpenCTI client
+def record_response(response, *args, **kwargs):
+    tool = current_tool.get()
+    if tool is not None:
+        body = response.request.body or b""
+        _metrics.record_round_trip(tool, len(body), len(response.content))
+
+
+def debug_enabled():
+    return logging.getLogger("pycti_mcp").isEnabledFor(logging.DEBUG)
+
+
+async def debug_json(ctx, prefix, obj):
+    """Send obj, JSON-encoded, to the client as a debug message. Encoding large payloads is
+    expensive, so it is only done when debug logging has been turned on."""
+    if debug_enabled():
+        await ctx.debug(f"{prefix} {encoding.dumps_str(obj)}")
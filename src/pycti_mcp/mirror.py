@@ -0,0 +1,676 @@
+import asyncio
+import logging
+import sqlite3
+import threading
+import time
+from datetime import timezone
+
+from pycti_mcp.client_pool import PoolConfig, get_client_pool
+from pycti_mcp import encoding
+from pycti_mcp.metrics import current_tool
+
+
+# Settings for the optional local mirror of OpenCTI. These are overwritten by the command-line
+# handling in mcp_server_octi.main().
+class MirrorConfig:
+    enabled = False
+    # SQLite database file the mirror is kept in. Without one, the mirror is held in memory and
+    # is reloaded from scratch on every restart.
+    path = None
+    # The OpenCTI live stream followed for changes. Without one, the raw stream of every change
+    # to the platform is followed, which requires an administrator's API key.
+    stream_id = None
+    # Lookups are only answered from the mirror while it is at most this many seconds behind
+    max_lag = 60
+    page_size = 200
+    retry_interval = 30
+    # How long to wait for anything (even a heartbeat) from the stream before reconnecting
+    stream_timeout = 120
+    # Max number of entities the indicator search returns, matching the first page pycti lists
+    search_limit = 500
+
+
+# The kinds of entity mirrored: the tools' own names for them
+adversary_kinds = [
+    "campaign",
+    "intrusion_set",
+    "threat_actor_group",
+    "threat_actor_individual",
+]
+mirror_kinds = ["observable", "indicator", "report"] + adversary_kinds
+
+# The STIX types of the entities mirrored, apart from the observables (see below)
+stix_kinds = {
+    "indicator": "indicator",
+    "report": "report",
+    "campaign": "campaign",
+    "intrusion-set": "intrusion_set",
+}
+threat_actor_kinds = {
+    "Threat-Actor-Group": "threat_actor_group",
+    "Threat-Actor-Individual": "threat_actor_individual",
+}
+observable_stix_types = {
+    "artifact",
+    "autonomous-system",
+    "bank-account",
+    "cryptocurrency-wallet",
+    "cryptographic-key",
+    "credential",
+    "directory",
+    "domain-name",
+    "email-addr",
+    "email-message",
+    "email-mime-part-type",
+    "file",
+    "hostname",
+    "ipv4-addr",
+    "ipv6-addr",
+    "mac-addr",
+    "media-content",
+    "mutex",
+    "network-traffic",
+    "payment-card",
+    "persona",
+    "phone-number",
+    "process",
+    "software",
+    "ssh-key",
+    "text",
+    "tracking-number",
+    "url",
+    "user-account",
+    "user-agent",
+    "windows-registry-key",
+    "windows-registry-value-type",
+    "x509-certificate",
+}
+
+# The STIX types of the containers whose contents show up in the mirrored entities (as their
+# reports, notes, opinions, cases, and groupings)
+container_stix_types = {
+    "report",
+    "note",
+    "opinion",
+    "grouping",
+    "case-incident",
+    "case-rfi",
+    "case-rft",
+}
+
+# OpenCTI's STIX extension, which carries the internal Id and type of each entity in the stream
+opencti_extension = "extension-definition--ea279b3e-5c71-4632-ac08-831c66a786ba"
+
+schema = """
+    CREATE TABLE IF NOT EXISTS entities (
+        id TEXT PRIMARY KEY,
+        standard_id TEXT,
+        kind TEXT NOT NULL,
+        updated_at TEXT,
+        published TEXT,
+        subtype TEXT,
+        search TEXT,
+        data TEXT NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS entities_standard_id ON entities (standard_id);
+    CREATE INDEX IF NOT EXISTS entities_published ON entities (kind, published);
+    CREATE TABLE IF NOT EXISTS terms (
+        term TEXT NOT NULL,
+        kind TEXT NOT NULL,
+        id TEXT NOT NULL,
+        PRIMARY KEY (term, kind, id)
+    ) WITHOUT ROWID;
+    CREATE INDEX IF NOT EXISTS terms_id ON terms (id);
+    CREATE TABLE IF NOT EXISTS meta (
+        key TEXT PRIMARY KEY,
+        value TEXT
+    );
+"""
+
+
+# Normalize a timestamp to UTC, in a form which sorts correctly as a string
+def utc_timestamp(ts):
+    if not ts:
+        return None
+    # Imported here, as the mirror's imports are loaded at startup, even when it isn't enabled
+    from dateutil.parser import parse as dateparse
+
+    dt = dateparse(ts)
+    if dt.tzinfo is not None:
+        dt = dt.astimezone(timezone.utc)
+    return dt.strftime("%Y-%m-%dT%H:%M:%S")
+
+
+# The time, in seconds, of an OpenCTI stream event, from its Id ("<milliseconds>-<sequence>")
+def event_time(event_id):
+    try:
+        return int(event_id.partition("-")[0]) / 1000
+    except (AttributeError, ValueError):
+        return None
+
+
+def like_pattern(s):
+    return "%" + s.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%"
+
+
+# The values an entity of the given kind can be looked up by, case-folded
+def entity_terms(kind, e):
+    terms = [e["id"], e.get("standard_id")]
+    if kind == "observable":
+        terms.append(e.get("observable_value"))
+    elif kind == "indicator":
+        terms.append(e.get("name"))
+    elif kind in adversary_kinds:
+        terms += [e.get("name")] + (e.get("aliases") or [])
+    return {t.casefold() for t in terms if t}
+
+
+# The columns, besides the JSON, stored for an entity: those the mirror searches by
+def entity_row(kind, e):
+    published = subtype = search = None
+    if kind == "indicator":
+        subtype = (e.get("pattern_type") or "").lower()
+        search = e.get("pattern")
+    elif kind == "report":
+        published = utc_timestamp(e.get("published"))
+        search = " ".join(filter(None, [e.get("name"), e.get("description")]))
+    return (
+        e["id"],
+        e.get("standard_id"),
+        kind,
+        e.get("updated_at"),
+        published,
+        subtype,
+        search,
+        encoding.dumps_str(e),
+    )
+
+
+# The kind of the entity in a stream event's STIX data, or None if it isn't mirrored
+def stix_kind(data):
+    t = data.get("type")
+    if t in observable_stix_types:
+        return "observable"
+    if t == "threat-actor":
+        ext = data.get("extensions", {}).get(opencti_extension, {})
+        return threat_actor_kinds.get(ext.get("type"))
+    return stix_kinds.get(t)
+
+
+# The STIX Ids of the objects a container event added to or removed from the container
+def changed_refs(event, message):
+    data = message["data"]
+    if event in ("create", "delete"):
+        return list(data.get("object_refs") or [])
+
+    refs = []
+    context = message.get("context") or {}
+    for patch in [context.get("patch"), context.get("reverse_patch")]:
+        for op in patch or []:
+            if not str(op.get("path", "")).startswith("/object_refs"):
+                continue
+            value = op.get("value")
+            refs += value if isinstance(value, list) else [value]
+    return [r for r in refs if isinstance(r, str)]
+
+
+def parse_sse(lines):
+    """Parse the lines of a text/event-stream into (id, event, data) tuples. As in browsers,
+    an event without an id field keeps the id of the one before it."""
+    event_id = None
+    event = None
+    data = []
+    for line in lines:
+        if not line:
+            if data or event:
+                yield event_id, event or "message", "\n".join(data)
+            event = None
+            data = []
+        elif line.startswith(":"):
+            continue
+        else:
+            field, _, value = line.partition(":")
+            if value.startswith(" "):
+                value = value[1:]
+            if field == "id":
+                event_id = value
+            elif field == "event":
+                event = value
+            elif field == "data":
+                data.append(value)
+
+
+class Mirror:
+    """A local copy of the observables, indicators, adversaries, and reports in OpenCTI, kept in
+    SQLite. Each entity is stored as OpenCTI returned it with the tool's full projection, so the
+    tools parse it exactly as they would a live result, at any level of detail. Reports are the
+    exception, as each can contain thousands of objects: they are stored with their own fields
+    and the number of objects of each type (see mirror_projection()), and their objects are read
+    from OpenCTI when they are asked for.
+
+    The mirror is filled by a bulk load, then kept up to date by following the OpenCTI stream:
+    each change to a mirrored entity (or to the contents of a report, note, or other container,
+    which are listed on the entities) is applied by reading the entity again. The Id of the
+    last event applied is kept, so a restarted server resumes the stream where it left off.
+    """
+
+    def __init__(self, path, url):
+        self.path = path or ":memory:"
+        self.url = url
+        self.db = sqlite3.connect(self.path, check_same_thread=False)
+        self.lock = threading.Lock()
+        self.events = 0
+        self.hits = 0
+        with self.lock, self.db:
+            if self.path != ":memory:":
+                self.db.execute("PRAGMA journal_mode = WAL")
+            self.db.executescript(schema)
+
+        # A mirror of some other OpenCTI platform is of no use
+        if self.meta("url") != url:
+            self.clear()
+            self.set_meta(url=url)
+
+    def meta(self, key):
+        with self.lock:
+            row = self.db.execute(
+                "SELECT value FROM meta WHERE key = ?", (key,)
+            ).fetchone()
+        return row[0] if row else None
+
+    def set_meta(self, **values):
+        with self.lock, self.db:
+            self.db.executemany(
+                "INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)",
+                [(k, None if v is None else str(v)) for k, v in values.items()],
+            )
+
+    def clear(self):
+        with self.lock, self.db:
+            for table in ["entities", "terms", "meta"]:
+                self.db.execute(f"DELETE FROM {table}")
+
+    @property
+    def loaded(self):
+        return self.meta("loaded") == "1"
+
+    @property
+    def last_event_id(self):
+        return self.meta("last_event_id")
+
+    def lag(self):
+        """How far behind OpenCTI the mirror is, in seconds, or None before it's loaded"""
+        synced_at = self.meta("synced_at")
+        if synced_at is None or not self.loaded:
+            return None
+        return max(0.0, time.time() - float(synced_at))
+
+    def fresh(self):
+        lag = self.lag()
+        return lag is not None and lag <= MirrorConfig.max_lag
+
+    def upsert(self, kind, entities):
+        with self.lock, self.db:
+            for e in entities:
+                self._delete(e["id"])
+                self.db.execute(
+                    "INSERT INTO entities VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                    entity_row(kind, e),
+                )
+                self.db.executemany(
+                    "INSERT OR IGNORE INTO terms VALUES (?, ?, ?)",
+                    [(t, kind, e["id"]) for t in entity_terms(kind, e)],
+                )
+
+    def delete(self, entity_id):
+        with self.lock, self.db:
+            self._delete(entity_id)
+
+    def _delete(self, entity_id):
+        # The entity can be given by either its OpenCTI Id or its STIX Id
+        for (id_,) in self.db.execute(
+            "SELECT id FROM entities WHERE id = ? OR standard_id = ?",
+            (entity_id, entity_id),
+        ).fetchall():
+            self.db.execute("DELETE FROM entities WHERE id = ?", (id_,))
+            self.db.execute("DELETE FROM terms WHERE id = ?", (id_,))
+
+    def stored(self, stix_ids):
+        """The (kind, OpenCTI Id) of each of the entities with the given STIX Ids which are in
+        the mirror"""
+        found = []
+        with self.lock:
+            for i in range(0, len(stix_ids), 500):
+                chunk = stix_ids[i : i + 500]
+                found += self.db.execute(
+                    "SELECT kind, id FROM entities WHERE standard_id IN "
+                    f"({','.join('?' * len(chunk))})",
+                    chunk,
+                ).fetchall()
+        return found
+
+    def find(self, kind, terms):
+        """The entities of the given kind with any of the terms as an Id, value, name, or
+        alias, as OpenCTI returned them"""
+        terms = list({t.casefold() for t in terms if t})
+        rows = []
+        with self.lock:
+            self.hits += 1
+            for i in range(0, len(terms), 500):
+                chunk = terms[i : i + 500]
+                rows += self.db.execute(
+                    "SELECT DISTINCT e.id, e.data FROM terms t JOIN entities e ON e.id = t.id "
+                    f"WHERE t.kind = ? AND t.term IN ({','.join('?' * len(chunk))})",
+                    [kind] + chunk,
+                ).fetchall()
+        return [encoding.loads(data) for _, data in dict(rows).items()]
+
+    def search_indicators(self, strings, pattern_types):
+        """The indicators whose patterns contain all of the strings, of any of the pattern types
+        (or all of them, if none are given)"""
+        sql = "SELECT data FROM entities WHERE kind = 'indicator'"
+        params = []
+        for s in strings:
+            sql += " AND search LIKE ? ESCAPE '\\'"
+            params.append(like_pattern(s))
+        if pattern_types:
+            sql += f" AND subtype IN ({','.join('?' * len(pattern_types))})"
+            params += [t.lower() for t in pattern_types]
+        sql += " ORDER BY updated_at DESC LIMIT ?"
+        params.append(MirrorConfig.search_limit)
+
+        with self.lock:
+            self.hits += 1
+            rows = self.db.execute(sql, params).fetchall()
+        return [encoding.loads(data) for (data,) in rows]
+
+    def search_reports(self, earliest, latest, search, first, offset):
+        """A page of the reports published in the date range, matching all of the words of the
+        search, newest first. Returns them as pycti's list(withPagination=True) would, with a
+        cursor which is the offset of the next page, and the cursor of each report."""
+        sql = "SELECT data FROM entities WHERE kind = 'report'"
+        params = []
+        if earliest:
+            sql += " AND published >= ?"
+            params.append(utc_timestamp(earliest))
+        if latest:
+            sql += " AND published <= ?"
+            params.append(utc_timestamp(latest))
+        for word in (search or "").split():
+            sql += " AND search LIKE ? ESCAPE '\\'"
+            params.append(like_pattern(word))
+        sql += " ORDER BY published DESC, id LIMIT ? OFFSET ?"
+        params += [first + 1, offset]
+
+        with self.lock:
+            self.hits += 1
+            rows = self.db.execute(sql, params).fetchall()
+        has_more = len(rows) > first
+        entities = [encoding.loads(data) for (data,) in rows[:first]]
+        return {
+            "entities": entities,
+            "pagination": {
+                "hasNextPage": has_more,
+                "endCursor": mirror_cursor(offset + first) if has_more else None,
+            },
+            "cursors": [mirror_cursor(offset + n + 1) for n in range(len(entities))],
+        }
+
+    def apply(self, event_id, event, payload, fetch):
+        """Apply an event from the OpenCTI stream, using fetch(kind, id) to read the current
+        state of each entity it changed (None if it's gone)"""
+        if event == "heartbeat":
+            # The stream has sent everything up to now
+            self.set_meta(synced_at=time.time())
+            return
+        if event not in ("create", "update", "merge", "delete"):
+            return
+
+        message = encoding.loads(payload)
+        data = message["data"]
+        kind = stix_kind(data)
+        ext = data.get("extensions", {}).get(opencti_extension, {})
+        entity_id = ext.get("id") or data["id"]
+
+        targets = []
+        if kind is not None:
+            if event == "delete":
+                self.delete(entity_id)
+                self.delete(data["id"])
+            else:
+                targets.append((kind, entity_id))
+
+        if event == "merge":
+            # The merged entities are deleted, and their Ids now belong to the one kept
+            for source in (message.get("context") or {}).get("sources") or []:
+                if source.get("id"):
+                    self.delete(source["id"])
+
+        # Entities added to or removed from a container now list it (or not)
+        if data.get("type") in container_stix_types:
+            targets += self.stored(changed_refs(event, message))
+
+        for target_kind, target_id in dict.fromkeys(targets):
+            entity = fetch(target_kind, target_id)
+            if entity is None:
+                self.delete(target_id)
+            else:
+                self.upsert(target_kind, [entity])
+
+        self.events += 1
+        synced_at = event_time(event_id) or time.time()
+        self.set_meta(last_event_id=event_id, synced_at=synced_at)
+
+    async def bulk_load(self, pool):
+        """Replace the mirror's contents with every mirrored entity in OpenCTI"""
+        log = logging.getLogger(__name__)
+        started = time.time()
+        self.clear()
+        self.set_meta(url=self.url)
+
+        for kind in mirror_kinds:
+            after = None
+            count = 0
+            while True:
+                page = await pool.run(list_entities, kind, after)
+                self.upsert(kind, page["entities"])
+                count += len(page["entities"])
+                if not page["pagination"].get("hasNextPage"):
+                    break
+                after = page["pagination"]["endCursor"]
+            log.info(f"Loaded {count} {kind} entities into the mirror")
+
+        # Follow the stream from when the load started, so nothing changed during it is missed
+        self.set_meta(
+            loaded=1,
+            last_event_id=f"{int(started * 1000)}-0",
+            synced_at=started,
+        )
+
+    def follow(self, url, key, fetch):
+        """Apply the events from the OpenCTI stream, from the last one applied, until the
+        connection drops"""
+        import requests
+
+        stream_url = f"{url.rstrip('/')}/stream"
+        if MirrorConfig.stream_id:
+            stream_url += f"/{MirrorConfig.stream_id}"
+
+        with requests.get(
+            stream_url,
+            headers={
+                "Authorization": f"Bearer {key}",
+                "Accept": "text/event-stream",
+                "Last-Event-ID": self.last_event_id,
+            },
+            stream=True,
+            timeout=(10, MirrorConfig.stream_timeout),
+            verify=PoolConfig.ssl_verify,
+        ) as response:
+            response.raise_for_status()
+            lines = response.iter_lines(chunk_size=None, decode_unicode=True)
+            for event_id, event, payload in parse_sse(lines):
+                self.apply(event_id, event, payload, fetch)
+
+    def stats(self):
+        with self.lock:
+            counts = dict(
+                self.db.execute(
+                    "SELECT kind, COUNT(*) FROM entities GROUP BY kind"
+                ).fetchall()
+            )
+        return {
+            "loaded": self.loaded,
+            "lag_seconds": self.lag(),
+            "entities": {kind: counts.get(kind, 0) for kind in mirror_kinds},
+            "events": self.events,
+            "hits": self.hits,
+            "last_event_id": self.last_event_id,
+        }
+
+
+def mirror_cursor(offset):
+    return f"mirror:{offset}"
+
+
+def parse_mirror_cursor(cursor):
+    """The offset in a cursor returned from the mirror, or None if it came from OpenCTI"""
+    if cursor and cursor.startswith("mirror:"):
+        return int(cursor[len("mirror:") :])
+    return None
+
+
+# The tool modules import this one, so they are only imported once the mirror is used
+def tool_projections():
+    from pycti_mcp.pycti_tools import (
+        lookup_adversary,
+        lookup_indicators,
+        lookup_observables,
+        lookup_reports,
+    )
+
+    return lookup_adversary, lookup_indicators, lookup_observables, lookup_reports
+
+
+def id_filter(*entity_ids):
+    return {
+        "mode": "or",
+        "filters": [
+            {"key": "id", "values": list(entity_ids)},
+            {"key": "standard_id", "values": list(entity_ids)},
+        ],
+        "filterGroups": [],
+    }
+
+
+# The API and projection the entities of a kind (other than adversaries) are mirrored with: the
+# tool's full projection, but for reports, whose objects aren't mirrored
+def mirror_projection(octi, kind):
+    adv, ind, obs, rpt = tool_projections()
+    return {
+        "observable": (octi.stix_cyber_observable, obs.obs_projections["full"]),
+        "indicator": (octi.indicator, ind.ind_projections["full"]),
+        "report": (octi.report, rpt.rpt_projections["standard"]),
+    }[kind]
+
+
+# Read a single entity with its mirrored projection, or None if it doesn't exist
+def read_entity(octi, kind, entity_id):
+    adv = tool_projections()[0]
+    if kind in adversary_kinds:
+        return adv.read_enriched_adv(octi, kind, id_filter(entity_id), "full")
+
+    api, projection = mirror_projection(octi, kind)
+    return api.read(id=entity_id, customAttributes=projection)
+
+
+# Fetch a page of the entities of the given kind, with their mirrored projection
+def list_entities(octi, kind, after):
+    adv = tool_projections()[0]
+    if kind in adversary_kinds:
+        result = octi.query(
+            adv.build_adversary_list_query(kind, "full"),
+            {"first": MirrorConfig.page_size, "after": after},
+        )
+        page = octi.process_multiple(
+            result["data"]["adversaries"], with_pagination=True
+        )
+        for ta in page["entities"]:
+            adv.order_reports(ta)
+        return page
+
+    api, projection = mirror_projection(octi, kind)
+    return api.list(
+        first=MirrorConfig.page_size,
+        after=after,
+        orderBy="created_at",
+        orderMode="asc",
+        withPagination=True,
+        customAttributes=projection,
+    )
+
+
+_mirror = None
+
+
+def get_mirror():
+    """Return the mirror, or None if it hasn't been enabled"""
+    return _mirror
+
+
+def fresh_mirror():
+    """Return the mirror if it is enabled and up to date enough to answer lookups, else None"""
+    if _mirror is not None and _mirror.fresh():
+        return _mirror
+    return None
+
+
+def follow_stream(mirror, url, key, pool, loop):
+    log = logging.getLogger(__name__)
+    # Report the requests made for the stream's changes as if they came from a tool
+    current_tool.set("mirror_stream")
+
+    # The changed entities are read through the pool on the server's event loop, so that the
+    # reads share the upstream thread pool's bound and the governor's limits with the tools
+    def fetch(kind, entity_id):
+        read = pool.run(read_entity, kind, entity_id)
+        return asyncio.run_coroutine_threadsafe(read, loop).result()
+
+    while True:
+        try:
+            log.info(f"Following the OpenCTI stream from {mirror.last_event_id}")
+            mirror.follow(url, key, fetch)
+        except Exception as e:
+            log.warning(f"OpenCTI stream disconnected: {e}")
+        time.sleep(MirrorConfig.retry_interval)
+
+
+async def run_mirror(url, key, follower=False):
+    """Background task which loads the mirror, unless a loaded one was kept from an earlier run,
+    then keeps it up to date from the OpenCTI stream on a thread of its own. A follower (one of
+    several HTTP workers, other than the first) only opens the mirror, which the first keeps
+    up to date."""
+    global _mirror
+    log = logging.getLogger(__name__)
+    current_tool.set("mirror_load")
+    mirror = Mirror(MirrorConfig.path, url)
+    _mirror = mirror
+    if follower:
+        return
+    pool = get_client_pool(url, key)
+
+    while not mirror.loaded:
+        try:
+            await mirror.bulk_load(pool)
+            log.info(f"Loaded the mirror: {mirror.stats()}")
+        except Exception as e:
+            log.error(f"Failed to load the mirror: {e}")
+            await asyncio.sleep(MirrorConfig.retry_interval)
+
+    # The stream is read with blocking requests, for as long as the server runs
+    threading.Thread(
+        target=follow_stream,
+        args=(mirror, url, key, pool, asyncio.get_running_loop()),
+        name="opencti-stream",
+        daemon=True,
+    ).start()
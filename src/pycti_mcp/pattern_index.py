@@ -0,0 +1,333 @@
+import asyncio
+import logging
+import sqlite3
+import threading
+import time
+
+from pycti_mcp.client_pool import get_client_pool
+from pycti_mcp.metrics import current_tool
+
+
+# Settings for the optional local index of indicator patterns. These are overwritten by the
+# command-line handling in mcp_server_octi.main().
+class PatternIndexConfig:
+    enabled = False
+    # SQLite database file the index is kept in. Without one, the index is held in memory and
+    # is rebuilt from scratch on every restart.
+    path = None
+    # How often, in seconds, new and changed indicators are added to the index in the background
+    refresh_interval = 300
+    # Before a search, the index is caught up with OpenCTI if it was last refreshed longer ago
+    # than this many seconds, so searches see indicators created since then
+    max_lag = 5
+    page_size = 500
+    # Searches with more candidates than this aren't narrowed enough to be worth it, and are
+    # left to OpenCTI. This is also the number of indicators a pycti search returns.
+    max_candidates = 500
+
+
+schema = """
+    CREATE TABLE IF NOT EXISTS indicators (
+        rowid INTEGER PRIMARY KEY,
+        id TEXT NOT NULL UNIQUE,
+        partition INTEGER NOT NULL,
+        updated_at TEXT
+    );
+    CREATE TABLE IF NOT EXISTS partitions (
+        partition INTEGER PRIMARY KEY,
+        pattern_type TEXT NOT NULL UNIQUE
+    );
+    CREATE TABLE IF NOT EXISTS meta (
+        key TEXT PRIMARY KEY,
+        value TEXT
+    );
+"""
+
+# FTS5's trigram tokenizer only indexes substrings of three characters or more
+min_search_length = 3
+
+
+# An FTS5 query matching patterns which contain all of the strings. Each string is a phrase,
+# which the trigram tokenizer matches as a case-insensitive substring.
+def match_query(strings):
+    return " AND ".join('"' + s.replace('"', '""') + '"' for s in strings)
+
+
+class PatternIndex:
+    """A trigram index of the patterns of the indicators in OpenCTI, kept in SQLite (FTS5), with
+    a table per pattern type. Searches find the indicators whose patterns might contain the
+    search strings locally, so OpenCTI only has to be asked for those, by Id, rather than scan
+    every pattern.
+
+    The index is built by paging through every indicator, then kept up to date with those
+    created or changed since (by updated_at). Deleted indicators are left in the index, which
+    is harmless: they are simply not found when the candidates are read from OpenCTI.
+    """
+
+    def __init__(self, path, url):
+        self.path = path or ":memory:"
+        self.url = url
+        self.db = sqlite3.connect(self.path, check_same_thread=False)
+        self.lock = threading.Lock()
+        self.refresh_lock = None
+        self.searches = 0
+        # Fails early on SQLite builds without FTS5's trigram tokenizer, which can't hold the index
+        self.db.execute(
+            "CREATE VIRTUAL TABLE temp.probe USING fts5(pattern, tokenize = 'trigram')"
+        )
+        with self.lock, self.db:
+            if self.path != ":memory:":
+                self.db.execute("PRAGMA journal_mode = WAL")
+            self.db.executescript(schema)
+
+        # An index of some other OpenCTI platform is of no use
+        if self.meta("url") != url:
+            self.clear()
+            self.set_meta(url=url)
+
+    def meta(self, key):
+        with self.lock:
+            row = self.db.execute(
+                "SELECT value FROM meta WHERE key = ?", (key,)
+            ).fetchone()
+        return row[0] if row else None
+
+    def set_meta(self, **values):
+        with self.lock, self.db:
+            self.db.executemany(
+                "INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)",
+                [(k, None if v is None else str(v)) for k, v in values.items()],
+            )
+
+    def clear(self):
+        with self.lock, self.db:
+            for (partition,) in self.db.execute(
+                "SELECT partition FROM partitions"
+            ).fetchall():
+                self.db.execute(f"DROP TABLE IF EXISTS patterns_{partition}")
+            for table in ["indicators", "partitions", "meta"]:
+                self.db.execute(f"DELETE FROM {table}")
+
+    @property
+    def loaded(self):
+        return self.meta("loaded") == "1"
+
+    @property
+    def last_updated(self):
+        return self.meta("last_updated")
+
+    @property
+    def last_refresh(self):
+        # Kept in the database, so that HTTP workers sharing the index share its catch-ups too
+        refreshed_at = self.meta("refreshed_at")
+        return None if refreshed_at is None else float(refreshed_at)
+
+    def _partitions(self, pattern_types=()):
+        """The partition of each of the pattern types (all of them, if none are given) which
+        has been indexed"""
+        sql = "SELECT partition FROM partitions"
+        params = [t.lower() for t in pattern_types]
+        if params:
+            sql += f" WHERE pattern_type IN ({','.join('?' * len(params))})"
+        return [p for (p,) in self.db.execute(sql, params).fetchall()]
+
+    def _partition(self, pattern_type):
+        pattern_type = (pattern_type or "").lower()
+        row = self.db.execute(
+            "SELECT partition FROM partitions WHERE pattern_type = ?", (pattern_type,)
+        ).fetchone()
+        if row:
+            return row[0]
+        partition = self.db.execute(
+            "INSERT INTO partitions (pattern_type) VALUES (?)", (pattern_type,)
+        ).lastrowid
+        self.db.execute(
+            f"CREATE VIRTUAL TABLE patterns_{partition} "
+            "USING fts5(pattern, tokenize = 'trigram')"
+        )
+        return partition
+
+    def upsert(self, indicators):
+        with self.lock, self.db:
+            for i in indicators:
+                row = self.db.execute(
+                    "SELECT rowid, partition FROM indicators WHERE id = ?", (i["id"],)
+                ).fetchone()
+                partition = self._partition(i.get("pattern_type"))
+                if row:
+                    rowid, old_partition = row
+                    self.db.execute(
+                        f"DELETE FROM patterns_{old_partition} WHERE rowid = ?",
+                        (rowid,),
+                    )
+                    self.db.execute(
+                        "UPDATE indicators SET partition = ?, updated_at = ? WHERE rowid = ?",
+                        (partition, i.get("updated_at"), rowid),
+                    )
+                else:
+                    rowid = self.db.execute(
+                        "INSERT INTO indicators (id, partition, updated_at) VALUES (?, ?, ?)",
+                        (i["id"], partition, i.get("updated_at")),
+                    ).lastrowid
+                self.db.execute(
+                    f"INSERT INTO patterns_{partition} (rowid, pattern) VALUES (?, ?)",
+                    (rowid, i.get("pattern") or ""),
+                )
+
+    def candidates(self, strings, pattern_types):
+        """The OpenCTI Ids of the indicators whose patterns contain all of the strings (case
+        insensitively), of any of the pattern types (or all of them, if none are given).
+        Strings too short to be indexed aren't checked, so the candidates still need to be
+        verified. Returns None if the search can't be narrowed down to at most
+        max_candidates indicators."""
+        searchable = [s for s in strings if len(s) >= min_search_length]
+        if not searchable:
+            return None
+
+        limit = PatternIndexConfig.max_candidates
+        found = []
+        with self.lock:
+            self.searches += 1
+            for partition in self._partitions(pattern_types):
+                found += self.db.execute(
+                    f"SELECT i.id FROM patterns_{partition} p "
+                    "JOIN indicators i ON i.rowid = p.rowid "
+                    f"WHERE patterns_{partition} MATCH ? LIMIT ?",
+                    (match_query(searchable), limit + 1 - len(found)),
+                ).fetchall()
+                if len(found) > limit:
+                    return None
+        return [id_ for (id_,) in found]
+
+    async def refresh(self, pool):
+        """Page through the indicators created or changed since the last refresh (every one, the
+        first time), adding them to the index"""
+        if self.refresh_lock is None:
+            self.refresh_lock = asyncio.Lock()
+
+        # Concurrent searches share a single catch-up
+        async with self.refresh_lock:
+            started = time.time()
+            since = self.last_updated
+            last_updated = since
+            after = None
+            while True:
+                page = await pool.run(list_indicator_patterns, since, after)
+                await asyncio.to_thread(self.upsert, page["entities"])
+                for i in page["entities"]:
+                    if i["updated_at"] and (
+                        not last_updated or i["updated_at"] > last_updated
+                    ):
+                        last_updated = i["updated_at"]
+                # The pages are in updated_at order, so an interrupted refresh can be resumed
+                self.set_meta(last_updated=last_updated)
+
+                if not page["pagination"].get("hasNextPage"):
+                    break
+                after = page["pagination"]["endCursor"]
+
+            self.set_meta(loaded=1, refreshed_at=started)
+
+    async def catch_up(self, pool):
+        if (
+            self.last_refresh is None
+            or time.time() - self.last_refresh > PatternIndexConfig.max_lag
+        ):
+            await self.refresh(pool)
+
+    def stats(self):
+        with self.lock:
+            counts = dict(
+                self.db.execute(
+                    "SELECT p.pattern_type, COUNT(*) FROM indicators i "
+                    "JOIN partitions p ON p.partition = i.partition "
+                    "GROUP BY p.pattern_type"
+                ).fetchall()
+            )
+        return {
+            "loaded": self.loaded,
+            "indicators": counts,
+            "searches": self.searches,
+            "last_updated": self.last_updated,
+            "last_refresh": self.last_refresh,
+        }
+
+
+# Fetch one page of indicator patterns, optionally only those updated since then
+def list_indicator_patterns(octi, since, after):
+    filters = None
+    if since:
+        filters = {
+            "mode": "and",
+            "filters": [{"key": "updated_at", "values": [since], "operator": "gte"}],
+            "filterGroups": [],
+        }
+
+    return octi.indicator.list(
+        filters=filters,
+        first=PatternIndexConfig.page_size,
+        after=after,
+        orderBy="updated_at",
+        orderMode="asc",
+        withPagination=True,
+        customAttributes="""
+            id
+            pattern
+            pattern_type
+            updated_at
+        """,
+    )
+
+
+_index = None
+_pool = None
+
+
+def get_pattern_index():
+    """Return the indicator pattern index, or None if it hasn't been enabled"""
+    return _index
+
+
+async def find_candidates(strings, pattern_types):
+    """The OpenCTI Ids of the indicators which might match a pattern search, from the index
+    after catching it up with OpenCTI, or None if the index can't narrow the search down (or
+    isn't ready)"""
+    if _index is None or not _index.loaded:
+        return None
+    try:
+        await _index.catch_up(_pool)
+    except Exception as e:
+        logging.getLogger(__name__).warning(
+            f"Failed to catch up the pattern index: {e}"
+        )
+        return None
+    return await asyncio.to_thread(_index.candidates, strings, pattern_types)
+
+
+async def run_pattern_index(url, key, follower=False):
+    """Background task which builds the indicator pattern index (or resumes the one kept from an
+    earlier run), then keeps it up to date. A follower (one of several HTTP workers, other than
+    the first) only opens the index, which the first keeps up to date, and searches catch up.
+    """
+    global _index, _pool
+    log = logging.getLogger(__name__)
+    # Report the refresh requests in the metrics as if they came from a tool of this name
+    current_tool.set("pattern_index_refresh")
+    try:
+        index = PatternIndex(PatternIndexConfig.path, url)
+    except sqlite3.OperationalError as e:
+        log.error(f"Failed to open the pattern index: {e}")
+        return
+    _pool = get_client_pool(url, key)
+    _index = index
+    if follower:
+        return
+
+    while True:
+        try:
+            await index.refresh(_pool)
+            log.info(f"Refreshed the indicator pattern index: {index.stats()}")
+        except Exception as e:
+            log.error(f"Failed to refresh the indicator pattern index: {e}")
+
+        await asyncio.sleep(PatternIndexConfig.refresh_interval)
@@ -0,0 +1,153 @@
+# Helpers for building GraphQL projections (the customAttributes given to pycti) from the fields
+# each parser actually reads.
+#
+# A tool describes every field of its output with the GraphQL fields that field is parsed
+# from (its "needs"), and how to parse it. Named profiles (such as "summary", "standard", and
+# "full") are lists of output fields, and the projection for a profile requests only the
+# GraphQL fields needed by the output fields in that profile.
+#
+# Needs are given as lists whose entries are either a plain GraphQL field name, or a Nested
+# field with a selection of its own.
+from typing import Literal
+
+# The detail profiles offered by the lookup tools
+Detail = Literal["summary", "standard", "full"]
+
+
+class Nested:
+    """A GraphQL field with its own selection of sub-fields. Connections (which pycti flattens
+    from edges/node into a list) are wrapped in "edges { node { ... } }". Fragment nodes are
+    rendered as "... on <name>" inline fragments, and are merged into the enclosing object.
+    Fields which are plain lists of objects are marked with many, which doesn't change how they
+    are rendered, but records the shape the parser should expect. A field given an alias is
+    returned under the alias, so the same field can be selected more than once with different
+    arguments.
+    """
+
+    def __init__(
+        self,
+        name,
+        fields,
+        connection=False,
+        args="",
+        fragment=False,
+        many=False,
+        alias=None,
+    ):
+        self.name = name
+        self.fields = fields
+        self.connection = connection
+        self.args = args
+        self.fragment = fragment
+        self.many = many or connection
+        self.alias = alias
+
+    def key(self):
+        return ("...", self.name) if self.fragment else self.alias or self.name
+
+
+def Connection(name, fields, args=""):
+    return Nested(name, fields, connection=True, args=args)
+
+
+def Fragment(type_name, fields):
+    return Nested(type_name, fields, fragment=True)
+
+
+# Merge lists of needs into one, combining the sub-fields of nested fields which appear more
+# than once. The order in which fields are first needed is kept.
+def merge(*needs_lists):
+    merged = {}
+    for needs in needs_lists:
+        for f in needs:
+            if isinstance(f, str):
+                merged.setdefault(f, f)
+                continue
+
+            existing = merged.get(f.key())
+            if existing is None:
+                merged[f.key()] = f
+            else:
+                merged[f.key()] = Nested(
+                    f.name,
+                    merge(existing.fields, f.fields),
+                    connection=f.connection,
+                    args=f.args,
+                    fragment=f.fragment,
+                    many=f.many,
+                    alias=f.alias,
+                )
+    return list(merged.values())
+
+
+def render(needs, indent=4):
+    pad = " " * indent
+    lines = []
+    for f in needs:
+        if isinstance(f, str):
+            lines.append(f"{pad}{f}")
+            continue
+
+        if f.fragment:
+            lines.append(f"{pad}... on {f.name} {{")
+        else:
+            field = f"{f.alias}: {f.name}" if f.alias else f.name
+            if f.args:
+                field += f"({f.args})"
+            lines.append(f"{pad}{field} {{")
+
+        if f.connection:
+            lines.append(f"{pad}  edges {{")
+            lines.append(f"{pad}    node {{")
+            lines.append(render(f.fields, indent + 6))
+            lines.append(f"{pad}    }}")
+            lines.append(f"{pad}  }}")
+        else:
+            lines.append(render(f.fields, indent + 2))
+        lines.append(f"{pad}}}")
+    return "\n".join(lines)
+
+
+def profile_needs(outputs, profile, base=()):
+    return merge(list(base), *[outputs[field][0] for field in profile])
+
+
+def build_projections(outputs, profiles, base=()):
+    """Render the projection for each of the named profiles. outputs maps each output field
+    to a (needs, parse function) tuple, and base lists fields which are always requested.
+    """
+    return {
+        name: render(profile_needs(outputs, profile, base))
+        for name, profile in profiles.items()
+    }
+
+
+def parse_profile(outputs, profile, obj):
+    """Parse obj, as fetched with the profile's projection, into the profile's output fields"""
+    return {field: outputs[field][1](obj) for field in profile}
+
+
+# Needs and parsers shared by the tools: the URLs of an object's external references, and the
+# reports, cases, or groupings an object is contained in, named along with their URLs
+urls_needs = [Connection("externalReferences", ["url"])]
+containers_needs = ["name"] + urls_needs
+
+
+# pycti turns only some connections (such as reports and notes) into lists of their nodes. The
+# others (such as cases and groupings, and the connections nested in their nodes) are left as
+# they came from OpenCTI.
+def connection_nodes(conn):
+    if isinstance(conn, dict):
+        return [edge["node"] for edge in conn.get("edges") or []]
+    return conn or []
+
+
+def external_urls(obj):
+    return [e["url"] for e in connection_nodes(obj["externalReferences"])]
+
+
+def container_refs(containers):
+    return [
+        {"name": c["name"], "urls": external_urls(c)}
+        for c in connection_nodes(containers)
+    ]
@@ -1,6 +1,9 @@
 __all__ = [
+    "lookup_adversaries_bulk",
     "lookup_adversary",
     "lookup_indicators",
     "lookup_observables",
+    "lookup_observables_bulk",
+    "lookup_report_contents",
     "lookup_reports",
 ]
@@ -0,0 +1,355 @@
+import asyncio
+from typing import Annotated, List
+from fastmcp import Context
+
+from pycti_mcp.alias_index import match_fields, resolve_adversary
+from pycti_mcp.budget import fit_list
+from pycti_mcp.cache import cache_lookup, cache_store, forget_misses, make_key
+from pycti_mcp.client_pool import get_client_pool
+from pycti_mcp.executor import ExecutorConfig
+from pycti_mcp.metrics import debug_json, record_error
+from pycti_mcp.mirror import fresh_mirror, id_filter
+from pycti_mcp.projection import Detail, Nested, render
+from pycti_mcp.pycti_tools import lookup_adversary
+from pycti_mcp.pycti_tools.lookup_adversary import (
+    adv_lists,
+    adv_needs,
+    adversary_types,
+    build_adversary_list_query,
+    enrichment_args,
+    name_filter,
+    objects_filter,
+    order_reports,
+    parse_adv,
+    split_enrichments,
+)
+
+
+class OpenCTIConfig:
+    opencti_url = ""
+    opencti_key = ""
+
+
+# List every adversary of type adv_type matching the filters (by name or alias, or by Id), along
+# with its reports, notes, and opinions, walking through all of the result pages
+def list_enriched_advs(octi, adv_type, filters, first, detail):
+    found = []
+    after = None
+    while True:
+        result = octi.query(
+            build_adversary_list_query(adv_type, detail),
+            {"filters": filters, "first": first, "after": after},
+        )
+        page = octi.process_multiple(
+            result["data"]["adversaries"], with_pagination=True
+        )
+        found += [order_reports(ta) for ta in page["entities"]]
+        if not page["pagination"].get("hasNextPage"):
+            return found
+        after = page["pagination"]["endCursor"]
+
+
+# List the adversaries of type adv_type matching the filters, with only their own fields
+def list_advs(octi, adv_type, filters, own):
+    return getattr(octi, adv_type).list(
+        filters=filters,
+        getAll=True,
+        customAttributes=render(own),
+    )
+
+
+# Build a GraphQL document listing the reports, notes, or opinions (the enrichment field) which
+# contain each of the adversaries with the given Ids, as a connection for each of them, so that
+# at most enrichment_limit are fetched for each, as they would be for a single adversary
+def build_containers_query(field, ids, fields):
+    order = ", orderBy: published, orderMode: asc" if field == "reports" else ""
+    needs = [
+        Nested(
+            field,
+            fields,
+            connection=True,
+            args=f"filters: $f{n}, {enrichment_args}{order}",
+            alias=f"c{n}",
+        )
+        for n in range(len(ids))
+    ]
+    params = ", ".join(f"$f{n}: FilterGroup" for n in range(len(ids)))
+    return f"""
+        query AdversaryContainers({params}) {{
+{render(needs, indent=10)}
+        }}
+    """
+
+
+# List the reports, notes, or opinions which contain each of the adversaries with the given Ids,
+# in the order of the Ids
+def list_containers(octi, field, ids, fields):
+    result = octi.query(
+        build_containers_query(field, ids, fields),
+        {f"f{n}": objects_filter(opencti_id) for n, opencti_id in enumerate(ids)},
+    )
+    return [octi.process_multiple(result["data"][f"c{n}"]) for n in range(len(ids))]
+
+
+# Attach the reports, notes, and opinions related to each of the adversaries to it, listing
+# them for all of the adversaries at once, a batch of Ids at a time. As with enrich_adv(), an
+# enrichment which fails is left empty.
+async def enrich_advs(pool, ctx, advs, extra):
+    if not advs or not extra:
+        return
+
+    by_id = {ta["id"]: ta for ta in advs}
+    ids = list(by_id)
+    size = max(1, ExecutorConfig.batch_size)
+    chunks = [ids[i : i + size] for i in range(0, len(ids), size)]
+    fields = [field for field in lookup_adversary.enrichments if field in extra]
+    calls = [(field, chunk) for field in fields for chunk in chunks]
+    results = await asyncio.gather(
+        *[
+            pool.run(list_containers, field, chunk, extra[field])
+            for field, chunk in calls
+        ],
+        return_exceptions=True,
+    )
+
+    for ta in advs:
+        for field in fields:
+            ta[field] = []
+    for (field, chunk), result in zip(calls, results):
+        if isinstance(result, Exception):
+            await ctx.warning(f"Failed to fetch {field} for the adversaries: {result}")
+            continue
+        for opencti_id, containers in zip(chunk, result):
+            by_id[opencti_id][field] = containers
+
+    for ta in advs:
+        order_reports(ta)
+
+
+# Look up the adversaries of a single type with any of the names, or with any of the OpenCTI Ids
+# the names have been resolved to, returning them unparsed
+async def lookup_adv_type(pool, ctx, adv_type, names, detail, ids=None):
+    terms = ids or names
+    filters = id_filter(*ids) if ids else name_filter(*names)
+
+    mirror = fresh_mirror()
+    if mirror is not None:
+        # The mirror holds each adversary along with its reports, notes, and opinions
+        return mirror.find(adv_type, terms)
+
+    if lookup_adversary.OpenCTIConfig.combined_query:
+        try:
+            return await pool.run(
+                list_enriched_advs, adv_type, filters, len(terms), detail
+            )
+        except ValueError as e:
+            # As in lookup_adversary.lookup_adv_type(), fall back to separate list calls
+            await ctx.warning(f"Combined adversary query failed, falling back: {e}")
+            if "GRAPHQL_VALIDATION_FAILED" in str(e):
+                lookup_adversary.OpenCTIConfig.combined_query = False
+
+    own, extra = split_enrichments(adv_needs(adv_type, detail))
+    advs = await pool.run(list_advs, adv_type, filters, own)
+    await enrich_advs(pool, ctx, advs, extra)
+    return advs
+
+
+# The requested names matched by the adversary: its name and aliases, compared as OpenCTI's
+# filters compare them, ignoring case
+def matched_names(ta, names_by_casefold):
+    matched = []
+    for term in [ta.get("name")] + (ta.get("aliases") or []):
+        if term:
+            for name in names_by_casefold.get(term.casefold(), []):
+                if name not in matched:
+                    matched.append(name)
+    return matched
+
+
+async def opencti_adversary_bulk_lookup(
+    names: Annotated[
+        List[str],
+        "The adversary or threat names or aliases to look up in OpenCTI",
+    ],
+    ctx: Context,
+    detail: Annotated[
+        Detail,
+        "How much detail to return for each adversary: summary, standard, or full (see the single adversary lookup tool)",
+    ] = "standard",
+    max_bytes: Annotated[
+        int | None,
+        'Approximate max size of the response, in bytes. Lists in the response are cut short to fit, with the number of entries left out given in "truncated" fields. Defaults to the server\'s limit, 0 for no limit',
+    ] = None,
+    bypass_cache: Annotated[
+        bool, "Set to True to skip cached results and always query OpenCTI"
+    ] = False,
+) -> Annotated[list[dict], "List of results, one per requested name"] | None:
+    """Given a list of names or aliases of threat adversaries, look all of them up in OpenCTI at once. This is
+    much faster than looking up many adversaries one at a time, such as the adversaries named in a report.
+    Returns a list with one entry for each distinct requested name, in the order they were requested, with the
+    following fields: "name" (the requested name), "found" (whether any adversary has that name or alias), and
+    "result" (the list of matching adversaries, as returned by the single adversary lookup tool, or None if
+    not found). If the list had to be cut short to fit max_bytes, its last entry is {"truncated": {"names":
+    N}}, giving the number of names left out; look them up in another call.
+    """
+    if not OpenCTIConfig.opencti_url:
+        await ctx.error("OpenCTI URL was not set. Tool will not work")
+        return None
+
+    pool = get_client_pool(OpenCTIConfig.opencti_url, OpenCTIConfig.opencti_key)
+
+    # Drop duplicates, but keep the order the names were requested in
+    names = list(dict.fromkeys(n for n in names if n))
+
+    # Answer what we can from the cache shared with opencti_adversary_lookup, including the
+    # names it recently found no adversary for, and only query OpenCTI for the rest
+    known = {}
+    for name in names:
+        hit, result = await cache_lookup(
+            ctx,
+            make_key("opencti_adversary_lookup", name, detail),
+            bypass_cache,
+            make_key("opencti_adversary_lookup", name),
+        )
+        if hit:
+            known[name] = result
+
+    bulk_results = await query_adversaries(
+        pool, ctx, [n for n in names if n not in known], detail, bypass_cache
+    )
+    for name, result in known.items():
+        bulk_results[name] = {"name": name, "found": bool(result), "result": result}
+
+    bulk_results = [bulk_results[name] for name in names]
+    await debug_json(ctx, "Made", bulk_results)
+
+    # Every name's status is kept ahead of the details of any of the adversaries
+    return fit_list(
+        bulk_results,
+        len(bulk_results),
+        max_bytes,
+        "names",
+        adv_lists,
+        within="result",
+    )[0]
+
+
+# Look up the names in OpenCTI, returning a dict mapping each name to its result entry
+async def query_adversaries(pool, ctx, names, detail, bypass=False):
+    if not names:
+        return {}
+
+    # With the alias index, the names it resolves are looked up by the Ids of the adversaries
+    # they refer to, only for those adversaries' types, and names no adversary has are answered
+    # without any request. The rest (or all of them, if asked to bypass the cache) are looked up
+    # by name, for every adversary type.
+    resolved = {name: resolve_adversary(name, bypass) for name in names}
+    by_name = [name for name in names if resolved[name] is None]
+    requested = {}
+    for name in names:
+        for adv_type, (opencti_id, _, _) in (resolved[name] or {}).items():
+            requested.setdefault((adv_type, opencti_id), []).append(name)
+
+    # Split large batches into several requests for each adversary type, which all run
+    # concurrently. Each call is of an adversary type, and either names or Ids.
+    size = max(1, ExecutorConfig.batch_size)
+    calls = [
+        (adv_type, by_name[i : i + size], None)
+        for i in range(0, len(by_name), size)
+        for adv_type in adversary_types
+    ]
+    for adv_type in adversary_types:
+        ids = [i for t, i in requested if t == adv_type]
+        calls += [(adv_type, None, ids[i : i + size]) for i in range(0, len(ids), size)]
+    results = await asyncio.gather(
+        *[
+            lookup_adv_type(pool, ctx, adv_type, chunk, detail, ids)
+            for adv_type, chunk, ids in calls
+        ],
+        return_exceptions=True,
+    )
+
+    # Adversaries are kept in adversary_types order, and each is parsed once, however many of
+    # the names it matched. As with opencti_adversary_lookup (whose cached results these are
+    # shared with), each name is given the first adversary of each type which matches it.
+    names_by_casefold = {}
+    for name in by_name:
+        names_by_casefold.setdefault(name.casefold(), []).append(name)
+    matches = {name: [] for name in names}
+    matched_types = set()
+    parsed = {}
+    # The number of calls each name was looked up in, and the errors of those which failed
+    looked_up = dict.fromkeys(names, 0)
+    failed = {}
+    for (adv_type, chunk, ids), result in zip(calls, results):
+        covered = chunk or [n for i in ids for n in requested[(adv_type, i)]]
+        for name in covered:
+            looked_up[name] += 1
+        if isinstance(result, Exception):
+            record_error()
+            await ctx.error(f"Failed looking up {adv_type}: {result}\n")
+            for name in covered:
+                failed.setdefault(name, []).append(result)
+            continue
+
+        for ta in result:
+            if ids:
+                matched = requested.get((adv_type, ta["id"]), [])
+            else:
+                matched = matched_names(ta, names_by_casefold)
+            for name in matched:
+                if (name, adv_type) in matched_types:
+                    continue
+                matched_types.add((name, adv_type))
+                if ta["id"] not in parsed:
+                    parsed[ta["id"]] = parse_adv(ta, detail)
+                found = parsed[ta["id"]]
+                if ids:
+                    # As the single lookup does, say which name or alias it was matched to
+                    fields = match_fields(name, resolved[name][adv_type][2])
+                    found = {**found, **fields} if fields else found
+                matches[name].append(found)
+
+    # Only fail the tool call if every one of the requests failed
+    if failed and all(
+        len(failed.get(name, [])) == looked_up[name]
+        for name in names
+        if looked_up[name]
+    ):
+        raise next(r for r in results if isinstance(r, Exception))
+
+    forget_misses(
+        *[
+            term
+            for ta in parsed.values()
+            for term in [ta["name"], ta["opencti_id"], ta["stix_id"]]
+            + (ta.get("aliases") or [])
+        ]
+    )
+
+    bulk_results = {}
+    for name in names:
+        ta_list = matches[name] or None
+        entry = {"name": name, "found": bool(ta_list), "result": ta_list}
+        errors = failed.get(name)
+        if errors and len(errors) == looked_up[name]:
+            entry["error"] = str(errors[0])
+        elif not errors and looked_up[name]:
+            # Partial results (some adversary types failed) are not cached, nor are the names
+            # the alias index has no adversary for, as a single lookup of them isn't either
+            cache_store(
+                "opencti_adversary_lookup",
+                make_key("opencti_adversary_lookup", name, detail),
+                ta_list,
+                make_key("opencti_adversary_lookup", name),
+            )
+        bulk_results[name] = entry
+
+    await ctx.info(f"Found {len(parsed)} adversaries in OpenCTI for {len(names)} names")
+    return bulk_results
+
+
+def tool_init(url, key):
+    OpenCTIConfig.opencti_url = url
+    OpenCTIConfig.opencti_key = key
+    return opencti_adversary_bulk_lookup
@@ -1,253 +1,462 @@
-import json
+import asyncio
 from typing import Annotated
-from pycti import OpenCTIApiClient
 from fastmcp import Context
 
+from pycti_mcp.alias_index import match_fields, resolve_adversary
+from pycti_mcp.budget import fit_list
+from pycti_mcp.cache import cache_lookup, cache_store, forget_misses, make_key
+from pycti_mcp.client_pool import get_client_pool
+from pycti_mcp.metrics import debug_json, record_error, timed_parse
+from pycti_mcp.mirror import fresh_mirror, id_filter
+from pycti_mcp.projection import (
+    Detail,
+    Connection,
+    Nested,
+    container_refs,
+    containers_needs,
+    external_urls,
+    parse_profile,
+    profile_needs,
+    render,
+    urls_needs,
+)
+
 
 class OpenCTIConfig:
     opencti_url = ""
     opencti_key = ""
+    # Cleared if the server rejects the combined adversary+enrichment GraphQL document
+    combined_query = True
 
 
-# Parse a "Threat Adversary" when fetched from the system
-def parse_adv(ta):
-    parsed_ta = {
-        "stix_id": ta["standard_id"],
-        "opencti_id": ta["id"],
-        "name": ta["name"],
-        "data_type": ta["entity_type"],
-        "description": ta["description"],
-        "created": ta["created_at"],
-        "last_updated": ta["updated_at"],
-        "labels": [label["value"] for label in ta["objectLabel"]],
-        "first_seen": ta["first_seen"],
-        "last_seen": ta["last_seen"],
-        "external_reports": [
-            {"name": r["name"], "urls": [e["url"] for e in r["externalReferences"]]}
-            for r in ta["reports"]
-        ]
-        + [{"name": "Self", "urls": [e["url"] for e in ta["externalReferences"]]}],
-        "notes": [note["content"] for note in ta["notes"]],
-        "opinions": [
+# Names of the pycti client attributes for each of the adversary entity types
+adversary_types = [
+    "campaign",
+    "intrusion_set",
+    "threat_actor_group",
+    "threat_actor_individual",
+]
+
+# GraphQL query field listing each adversary type
+adversary_queries = {
+    "campaign": "campaigns",
+    "intrusion_set": "intrusionSets",
+    "threat_actor_group": "threatActorsGroup",
+    "threat_actor_individual": "threatActorsIndividuals",
+}
+
+# Max number of reports, notes, and opinions fetched for an adversary (pycti's list default)
+enrichment_limit = 100
+enrichment_args = f"first: {enrichment_limit}"
+
+# The connections listing the reports, notes, and opinions containing the adversary. These are
+# fetched with separate list calls when the combined query can't be used.
+enrichments = ["reports", "notes", "opinions"]
+
+# Each field of the parsed adversary, with the GraphQL fields it is parsed from and how. The
+# reports also need "published", which they are ordered by.
+adv_outputs = {
+    "stix_id": (["standard_id"], lambda ta: ta["standard_id"]),
+    "opencti_id": (["id"], lambda ta: ta["id"]),
+    "name": (["name"], lambda ta: ta["name"]),
+    "data_type": (["entity_type"], lambda ta: ta["entity_type"]),
+    "description": (["description"], lambda ta: ta["description"]),
+    "created": (["created_at"], lambda ta: ta["created_at"]),
+    "last_updated": (["updated_at"], lambda ta: ta["updated_at"]),
+    "labels": (
+        [Nested("objectLabel", ["value"], many=True)],
+        lambda ta: [label["value"] for label in ta["objectLabel"]],
+    ),
+    "first_seen": (["first_seen"], lambda ta: ta["first_seen"]),
+    "last_seen": (["last_seen"], lambda ta: ta["last_seen"]),
+    "external_reports": (
+        [Connection("reports", containers_needs + ["published"], args=enrichment_args)]
+        + urls_needs,
+        lambda ta: container_refs(ta["reports"])
+        + [{"name": "Self", "urls": external_urls(ta)}],
+    ),
+    "notes": (
+        [Connection("notes", ["content"], args=enrichment_args)],
+        lambda ta: [note["content"] for note in ta["notes"]],
+    ),
+    "opinions": (
+        [Connection("opinions", ["opinion", "explanation"], args=enrichment_args)],
+        lambda ta: [
             {"sentiment": op["opinion"], "explanation": op["explanation"]}
             for op in ta["opinions"]
         ],
-    }
+    ),
+    "cases": (
+        [Connection("cases", containers_needs)],
+        lambda ta: container_refs(ta["cases"]),
+    ),
+    "groupings": (
+        [Connection("groupings", containers_needs)],
+        lambda ta: container_refs(ta["groupings"]),
+    ),
+}
 
-    # Safely populate optional keys if they exist in the source object
-    for optkey in [
+adv_profiles = {
+    "summary": [
+        "stix_id",
+        "opencti_id",
+        "name",
+        "data_type",
+        "description",
+        "created",
+        "last_updated",
+        "labels",
+        "first_seen",
+        "last_seen",
+    ],
+    "standard": [
+        "stix_id",
+        "opencti_id",
+        "name",
+        "data_type",
+        "description",
+        "created",
+        "last_updated",
+        "labels",
+        "first_seen",
+        "last_seen",
+        "external_reports",
+        "notes",
+        "opinions",
+    ],
+    "full": list(adv_outputs),
+}
+
+# Fields which only some of the adversary types have. They are copied into the parsed
+# adversary as-is when present. Only the aliases are fetched unless the full detail is asked for.
+adv_optional_fields = {
+    "campaign": ["aliases", "objective"],
+    "intrusion_set": [
+        "aliases",
+        "goals",
+        "resource_level",
+        "primary_motivation",
+        "secondary_motivations",
+    ],
+    "threat_actor_group": [
         "aliases",
         "goals",
         "roles",
         "sophistication",
+        "resource_level",
         "primary_motivation",
         "secondary_motivations",
-        "objective",
-        "resource_level",
-    ]:
+    ],
+}
+adv_optional_fields["threat_actor_individual"] = adv_optional_fields[
+    "threat_actor_group"
+]
+
+# The lists in a parsed adversary, in the order they are filled when fitting it into a size
+# budget
+adv_lists = ["external_reports", "notes", "opinions", "cases", "groupings"]
+
+
+def fit_advs(ta_list, max_bytes):
+    if not ta_list:
+        return ta_list
+    return fit_list(ta_list, len(ta_list), max_bytes, "adversaries", adv_lists)[0]
+
+
+# The GraphQL fields to fetch for an adversary of type adv_type, including its enrichments
+def adv_needs(adv_type, detail):
+    optional = adv_optional_fields[adv_type]
+    return profile_needs(
+        adv_outputs,
+        adv_profiles[detail],
+        base=optional if detail == "full" else optional[:1],
+    )
+
+
+# Split the needs into the adversary's own fields and the enrichment connections
+def split_enrichments(needs):
+    own = [f for f in needs if isinstance(f, str) or f.name not in enrichments]
+    extra = {
+        f.name: f.fields
+        for f in needs
+        if not isinstance(f, str) and f.name in enrichments
+    }
+    return own, extra
+
+
+# Parse a "Threat Adversary" when fetched from the system
+@timed_parse
+def parse_adv(ta, detail="standard"):
+    parsed_ta = parse_profile(adv_outputs, adv_profiles[detail], ta)
+
+    # Safely populate optional keys if they exist in the source object (which, when it comes
+    # from the mirror, has all of them, whatever the detail)
+    optional = adv_optional_fields["threat_actor_group"] + ["objective"]
+    for optkey in optional if detail == "full" else optional[:1]:
         if optkey in ta:
             parsed_ta[optkey] = ta[optkey]
 
     return parsed_ta
 
 
-notes_projection = """
-    id
-    content
-    authors
-"""
-
-opinions_projection = """
-    id
-    opinion
-    explanation
-    authors
-"""
-
-reports_projection = """
-    id
-    standard_id
-    name
-    published
-    entity_type
-    created_at
-    updated_at
-    created
-    modified
-    description
-    report_types
-    objectLabel {
-      id
-      value
-    }
-    externalReferences {
-      edges {
-        node {
-          url
-        }
-      }
-    }
-"""
-
-ta_projection = """
-    id
-    standard_id
-    name
-    aliases
-    entity_type
-    description
-    created_at
-    updated_at
-    externalReferences {
-      edges {
-        node {
-          url
-        }
-      }
-    }
-    objectLabel {
-      id
-      value
+# Build a single GraphQL document which reads an adversary of type adv_type along with the
+# reports, notes, and opinions that contain it, as connections on the adversary node. This
+# replaces the read plus three list calls that enrich_adv() would otherwise make.
+def build_adversary_query(adv_type, detail="standard"):
+    return f"""
+        query AdversaryLookup($filters: FilterGroup) {{
+          adversary: {adversary_queries[adv_type]}(filters: $filters, first: 1) {{
+            edges {{
+              node {{
+{render(adv_needs(adv_type, detail), indent=16)}
+              }}
+            }}
+          }}
+        }}
+    """
+
+
+# Build a GraphQL document listing a page of the adversaries of type adv_type (those matching the
+# filters, if given), along with their reports, notes, and opinions
+def build_adversary_list_query(adv_type, detail="standard"):
+    return f"""
+        query AdversaryList($filters: FilterGroup, $first: Int, $after: ID) {{
+          adversaries: {adversary_queries[adv_type]}(filters: $filters, first: $first, after: $after) {{
+            edges {{
+              node {{
+{render(adv_needs(adv_type, detail), indent=16)}
+              }}
+            }}
+            pageInfo {{
+              endCursor
+              hasNextPage
+              globalCount
+            }}
+          }}
+        }}
+    """
+
+
+# Filter matching the adversaries with any of the names as their name or one of their aliases
+def name_filter(*names):
+    return {
+        "mode": "or",
+        "filters": [
+            {"key": "name", "values": list(names)},
+            {"key": "aliases", "values": list(names)},
+        ],
+        "filterGroups": [],
     }
-    cases {
-      edges {
-        node {
-          id
-          name
-          externalReferences {
-            edges {
-              node {
-                url
-              }
-            }
-          }
-        }
-      }
+
+
+# Filter matching the reports, notes, or opinions which contain any of the given objects
+def objects_filter(*obj_ids):
+    return {
+        "mode": "and",
+        "filters": [{"key": "objects", "values": list(obj_ids)}],
+        "filterGroups": [],
     }
-    groupings {
-      edges {
-        node {
-          id
-          name
-          externalReferences {
-            edges {
-              node {
-                url
-              }
-            }
-          }
-        }
-      }
+
+
+# Attach the reports, notes, and opinions related to the adversary to it, fetching the fields
+# of each given by extra. The queries run concurrently, and if one of them fails, the adversary
+# is still returned without it.
+async def enrich_adv(pool, ctx, ta, extra):
+    list_calls = {
+        "reports": lambda octi: octi.report.list(
+            filters=objects_filter(ta["id"]),
+            orderBy="published",
+            orderMode="asc",
+            customAttributes=render(extra["reports"]),
+        ),
+        "notes": lambda octi: octi.note.list(
+            filters=objects_filter(ta["id"]),
+            customAttributes=render(extra["notes"]),
+        ),
+        "opinions": lambda octi: octi.opinion.list(
+            filters=objects_filter(ta["id"]),
+            customAttributes=render(extra["opinions"]),
+        ),
     }
-"""
+    fields = [field for field in enrichments if field in extra]
+    results = await asyncio.gather(
+        *[pool.run(list_calls[field]) for field in fields],
+        return_exceptions=True,
+    )
+
+    for field, result in zip(fields, results):
+        if isinstance(result, Exception):
+            await ctx.warning(f"Failed to fetch {field} for {ta['name']}: {result}")
+            result = None
+
+        # Add the results to the Threat Adversary data structure, if any relate
+        ta[field] = result if result else []
+
+
+# The nested reports connection can't be ordered server-side, so order it here instead
+def order_reports(ta):
+    if "reports" in ta:
+        ta["reports"] = sorted(ta["reports"], key=lambda r: r["published"] or "")
+    return ta
+
+
+# Read the adversary matching the filters, and its reports, notes, and opinions, with one
+# request. Returns None if the adversary doesn't exist.
+def read_enriched_adv(octi, adv_type, filters, detail):
+    result = octi.query(build_adversary_query(adv_type, detail), {"filters": filters})
+    found = octi.process_multiple(result["data"]["adversary"])
+    if not found:
+        return None
+    return order_reports(found[0])
+
+
+# Look up a single adversary type by name or alias, or by its OpenCTI Id when the name has been
+# resolved to it, returning the parsed adversary or None
+async def lookup_adv_type(
+    pool, ctx, adv_type, name, detail="standard", opencti_id=None
+):
+    ta = None
+    enriched = False
+    filters = id_filter(opencti_id) if opencti_id else name_filter(name)
+
+    mirror = fresh_mirror()
+    if mirror is not None:
+        # The mirror holds each adversary along with its reports, notes, and opinions
+        found = mirror.find(adv_type, [opencti_id or name])
+        ta = found[0] if found else None
+        enriched = True
+    elif OpenCTIConfig.combined_query:
+        try:
+            ta = await pool.run(read_enriched_adv, adv_type, filters, detail)
+            enriched = True
+        except ValueError as e:
+            # pycti raises ValueError for GraphQL errors. Fall back to the separate read and
+            # list calls, and stop trying the combined document if the server rejected it.
+            await ctx.warning(f"Combined adversary query failed, falling back: {e}")
+            if "GRAPHQL_VALIDATION_FAILED" in str(e):
+                OpenCTIConfig.combined_query = False
+
+    own, extra = split_enrichments(adv_needs(adv_type, detail))
+    if not enriched:
+        ta = await pool.run(
+            lambda octi: getattr(octi, adv_type).read(
+                filters=filters,
+                customAttributes=render(own),
+            )
+        )
+    await debug_json(ctx, "Got", ta)
+
+    if ta is None:
+        await ctx.info(f"Result from OpenCTI for {adv_type}={name} was None")
+        return None
+
+    if not enriched and extra:
+        await enrich_adv(pool, ctx, ta, extra)
+
+    parsed_ta = parse_adv(ta, detail)
+    await debug_json(ctx, "Made", parsed_ta)
+    return parsed_ta
 
 
 # Should look up campaign, intrusion_set, threat_actor_group, and threat_actor_individual
 async def opencti_adversary_lookup(
     name: Annotated[str, "The adversary or threat name or alias to look up in OpenCTI"],
     ctx: Context,
+    detail: Annotated[
+        Detail,
+        "How much detail to return: summary (the adversary's own fields), standard (adds related reports, notes, and opinions), or full (adds cases, groupings, goals, motivations, and other type-specific fields)",
+    ] = "standard",
+    max_bytes: Annotated[
+        int | None,
+        'Approximate max size of the response, in bytes. Lists in the response are cut short to fit, with the number of entries left out given in "truncated" fields. Defaults to the server\'s limit, 0 for no limit',
+    ] = None,
+    bypass_cache: Annotated[
+        bool, "Set to True to skip cached results and always query OpenCTI"
+    ] = False,
 ) -> (
     Annotated[list[dict], "List of Data structures representing matching adversaries"]
     | None
 ):
     """Given a name or alias of a threat adversary, look it up in OpenCTI. If it is stored in OpenCTI return a JSON
     data structure with information about it. Can be used to look up Threat Actors, Threat Actor Groups, Campaigns, Individuals,
-    and Intrusion Sets. If it isn't found, None will be returned."""
+    and Intrusion Sets. If it isn't found, None will be returned. Lists cut short to fit max_bytes are counted in a
+    "truncated" field of the adversary. An adversary found under a name which is not quite its name or one of its
+    aliases (such as a misspelling) has the one it was matched to in a "matched_name" field, and "fuzzy" set to
+    whether the two are only similar, rather than the same ignoring case, accents, spaces, and punctuation. With detail
+    set to full, each adversary also has "cases" and "groupings" fields, and those of "goals", "roles", "sophistication",
+    "resource_level", "primary_motivation", "secondary_motivations", and "objective" its type has.
+    """
     if not OpenCTIConfig.opencti_url:
         await ctx.error("OpenCTI URL was not set. Tool will not work")
         return None
 
-    octi = OpenCTIApiClient(
-        url=OpenCTIConfig.opencti_url, token=OpenCTIConfig.opencti_key, ssl_verify=True
-    )
+    key = make_key("opencti_adversary_lookup", name, detail)
+    miss_key = make_key("opencti_adversary_lookup", name)
+    hit, cached = await cache_lookup(ctx, key, bypass_cache, miss_key)
+    if hit:
+        return fit_advs(cached, max_bytes)
 
-    adversary_types = [
-        octi.campaign,
-        octi.intrusion_set,
-        octi.threat_actor_group,
-        octi.threat_actor_individual,
-    ]
+    # With the alias index, only the adversaries the name resolves to are read, by their Ids,
+    # and names no adversary has are answered without any request, unless asked not to
+    resolved = resolve_adversary(name, bypass_cache)
+    if resolved is not None and not resolved:
+        await ctx.info("No adversary has this name or alias in the alias index")
+        return None
+    if resolved:
+        await debug_json(ctx, "Resolved", resolved)
+    types = [t for t in adversary_types if resolved is None or t in resolved]
 
-    ta_list = []
+    pool = get_client_pool(OpenCTIConfig.opencti_url, OpenCTIConfig.opencti_key)
 
-    for adv_type in adversary_types:
-        try:
-            ta = adv_type.read(
-                filters={
-                    "mode": "or",
-                    "filters": [
-                        {"key": "name", "values": [name]},
-                        {"key": "aliases", "values": [name]},
-                    ],
-                    "filterGroups": [],
-                },
-                customAttributes=ta_projection,
-            )
-            await ctx.debug(f"Got {json.dumps(ta)}")
-
-            if ta is None:
-                await ctx.info(f"Result from OpenCTI for {adv_type}={name} was None")
-                continue
-
-            # Look up the reports associated with the Adversary
-            ta_rpts = octi.report.list(
-                filters={
-                    "mode": "and",
-                    "filters": [{"key": "objects", "values": [ta["id"]]}],
-                    "filterGroups": [],
-                },
-                orderBy="published",
-                orderMode="asc",
-                customAttributes=reports_projection,
+    # Query all of the adversary types at once. Results are kept in adversary_types order.
+    results = await asyncio.gather(
+        *[
+            lookup_adv_type(
+                pool,
+                ctx,
+                adv_type,
+                name,
+                detail,
+                resolved[adv_type][0] if resolved else None,
             )
+            for adv_type in types
+        ],
+        return_exceptions=True,
+    )
 
-            # Add reports to the Threat Adversary data structure, if any relate
-            if not ta_rpts:
-                ta["reports"] = []
-            else:
-                ta["reports"] = ta_rpts
-
-            # Look up the notes associated with the Adversary
-            ta_notes = octi.note.list(
-                filters={
-                    "mode": "and",
-                    "filters": [{"key": "objects", "values": [ta["id"]]}],
-                    "filterGroups": [],
-                },
-                customAttributes=notes_projection,
-            )
+    ta_list = []
+    errors = []
 
-            # Add reports to the Threat Adversary data structure, if any relate
-            if not ta_notes:
-                ta["notes"] = []
-            else:
-                ta["notes"] = ta_notes
-
-            # Look up the opinions associated with the Adversary
-            ta_opinions = octi.opinion.list(
-                filters={
-                    "mode": "and",
-                    "filters": [{"key": "objects", "values": [ta["id"]]}],
-                    "filterGroups": [],
-                },
-                customAttributes=opinions_projection,
-            )
+    for adv_type, result in zip(types, results):
+        if isinstance(result, Exception):
+            record_error()
+            await ctx.error(f"Failed looking up {adv_type}: {result}\n")
+            errors.append(result)
+        elif result is not None:
+            if resolved:
+                result.update(match_fields(name, resolved[adv_type][2]))
+            ta_list.append(result)
 
-            # Add reports to the Threat Adversary data structure, if any relate
-            if not ta_opinions:
-                ta["opinions"] = []
-            else:
-                ta["opinions"] = ta_opinions
+    # Only fail the tool call if none of the adversary types could be queried
+    if len(errors) == len(types):
+        raise errors[0]
 
-            parsed_ta = parse_adv(ta)
-            await ctx.debug(f"Made {json.dumps(parsed_ta)}")
+    forget_misses(
+        *[
+            term
+            for ta in ta_list
+            for term in [ta["name"], ta["opencti_id"], ta["stix_id"]]
+            + (ta.get("aliases") or [])
+        ]
+    )
 
-            ta_list.append(parsed_ta)
-        except Exception as e:
-            await ctx.error("Failed: {e}\n".format(e=e))
-            raise e
+    # Partial results (some adversary types failed) are not cached
+    if not errors:
+        cache_store(
+            "opencti_adversary_lookup", key, ta_list if ta_list else None, miss_key
+        )
 
-    return ta_list if ta_list else None
+    return fit_advs(ta_list, max_bytes) if ta_list else None
 
 
 def tool_init(url, key):
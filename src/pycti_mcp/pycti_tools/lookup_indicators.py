@@ -1,81 +1,146 @@
-import json
 from typing import Annotated, List, Literal
-from pycti import OpenCTIApiClient
 from fastmcp import Context
 
+from pycti_mcp.budget import fit_list
+from pycti_mcp.cache import cache_lookup, cache_store, forget_misses, make_key
+from pycti_mcp.client_pool import get_client_pool
+from pycti_mcp.entity_store import remember, stored_entity
+from pycti_mcp.metrics import debug_json, record_error, timed_parse
+from pycti_mcp.mirror import fresh_mirror
+from pycti_mcp.pattern_index import find_candidates
+from pycti_mcp.projection import (
+    Detail,
+    Connection,
+    Nested,
+    build_projections,
+    parse_profile,
+)
+
 
 class OpenCTIConfig:
     opencti_url = ""
     opencti_key = ""
 
 
-def parse_indicator(i):
-    parsed_i = {
-        "signature": i["pattern"],
-        "stix_id": i["standard_id"],
-        "opencti_id": i["id"],
-        "signature_type": i["pattern_type"],
-        "description": i["description"],
-        "created": i["created_at"],
-        "last_updated": i["updated_at"],
-        "labels": [label["value"] for label in i["objectLabel"]],
-        "external_reports": [
+# Each field of the parsed indicator, with the GraphQL fields it is parsed from and how
+ind_outputs = {
+    "name": (["name"], lambda i: i["name"]),
+    "signature": (["pattern"], lambda i: i["pattern"]),
+    "stix_id": (["standard_id"], lambda i: i["standard_id"]),
+    "opencti_id": (["id"], lambda i: i["id"]),
+    "signature_type": (["pattern_type"], lambda i: i["pattern_type"]),
+    "signature_version": (["pattern_version"], lambda i: i["pattern_version"]),
+    "description": (["description"], lambda i: i["description"]),
+    "created": (["created_at"], lambda i: i["created_at"]),
+    "last_updated": (["updated_at"], lambda i: i["updated_at"]),
+    "labels": (
+        [Nested("objectLabel", ["value"], many=True)],
+        lambda i: [label["value"] for label in i["objectLabel"]],
+    ),
+    "external_reports": (
+        [Connection("externalReferences", ["url"])],
+        lambda i: [
             {"name": "Self", "urls": [e["url"] for e in i["externalReferences"]]}
         ],
-        "confidence": i["confidence"],
-        "score": i["x_opencti_score"],
-        "revoked": i["revoked"],
-        "deploy": i["x_opencti_detection"],
-        "mitre_platforms": i["x_mitre_platforms"],
-        "observables": [
+    ),
+    "confidence": (["confidence"], lambda i: i["confidence"]),
+    "score": (["x_opencti_score"], lambda i: i["x_opencti_score"]),
+    "revoked": (["revoked"], lambda i: i["revoked"]),
+    "deploy": (["x_opencti_detection"], lambda i: i["x_opencti_detection"]),
+    "mitre_platforms": (["x_mitre_platforms"], lambda i: i["x_mitre_platforms"]),
+    "main_observable_type": (
+        ["x_opencti_main_observable_type"],
+        lambda i: i["x_opencti_main_observable_type"],
+    ),
+    "observables": (
+        [Nested("x_opencti_observable_values", ["type", "value"], many=True)],
+        lambda i: [
             {"value": x["value"], "type": x["type"]}
             for x in i["x_opencti_observable_values"]
         ],
-        # TODO: Walk through the list of "killChainPhases" and extract the MITRE TTPs
-    }
-    return parsed_i
-
-
-ind_projection = """
-    id
-    standard_id
-    pattern
-    pattern_type
-    pattern_version
-    entity_type
-    confidence
-    revoked
-    name
-    x_opencti_main_observable_type
-    x_opencti_observable_values {
-      type
-      value
-    }
-    description
-    x_opencti_detection
-    x_opencti_score
-    x_mitre_platforms
-    created_at
-    updated_at
-    externalReferences {
-      edges {
-        node {
-          url
-        }
-      }
-    }
-    objectLabel {
-      id
-      value
-    }
-    killChainPhases {
-      id
-      standard_id
-      entity_type
-      kill_chain_name
-      phase_name
-    }
-"""
+    ),
+    "kill_chain_phases": (
+        [Nested("killChainPhases", ["kill_chain_name", "phase_name"], many=True)],
+        lambda i: [
+            {"kill_chain": k["kill_chain_name"], "phase": k["phase_name"]}
+            for k in i["killChainPhases"]
+        ],
+    ),
+}
+
+ind_profiles = {
+    "summary": [
+        "signature",
+        "stix_id",
+        "opencti_id",
+        "signature_type",
+        "description",
+        "created",
+        "last_updated",
+        "labels",
+        "score",
+        "revoked",
+    ],
+    "standard": [
+        "signature",
+        "stix_id",
+        "opencti_id",
+        "signature_type",
+        "description",
+        "created",
+        "last_updated",
+        "labels",
+        "external_reports",
+        "confidence",
+        "score",
+        "revoked",
+        "deploy",
+        "mitre_platforms",
+        "observables",
+    ],
+    "full": list(ind_outputs),
+}
+
+# The indicator name is always fetched, as found names are used to invalidate cached misses
+ind_base = ["name"]
+ind_projections = build_projections(ind_outputs, ind_profiles, ind_base)
+ind_projection = ind_projections["standard"]
+
+# The lists in a parsed indicator, in the order they are filled when fitting it into a size
+# budget
+ind_lists = ["observables", "external_reports", "kill_chain_phases", "mitre_platforms"]
+
+
+# Whether an indicator matches a pattern search, as OpenCTI's filters would match it: its pattern
+# contains all of the strings (case insensitively), and it is of one of the pattern types
+def pattern_matches(i, strings, pattern_types):
+    pattern = (i.get("pattern") or "").casefold()
+    if not all(s.casefold() in pattern for s in strings):
+        return False
+    types = {t.lower() for t in pattern_types}
+    return not types or (i.get("pattern_type") or "").lower() in types
+
+
+# Read the indicators with the given OpenCTI Ids, and keep those which match the search, as some
+# of the candidates found by the pattern index may not (see pattern_index.PatternIndex)
+def read_candidates(octi, ids, strings, pattern_types, detail):
+    if not ids:
+        return []
+    ind = octi.indicator.list(
+        filters={
+            "mode": "and",
+            "filters": [{"key": "id", "values": ids}],
+            "filterGroups": [],
+        },
+        first=len(ids),
+        customAttributes=ind_projections[detail],
+    )
+    return [i for i in ind if pattern_matches(i, strings, pattern_types)]
+
+
+@timed_parse
+def parse_indicator(i, detail="standard"):
+    return parse_profile(ind_outputs, ind_profiles[detail], i)
 
 
 async def opencti_indicator_lookup(
@@ -107,6 +172,17 @@ async def opencti_indicator_lookup(
         str | None,
         "Id of the indicator to look up. If specified, pattern_types and pattern_search_strings will be ignored. Can be a STIX or OpenCTI Id value.",
     ] = None,
+    detail: Annotated[
+        Detail,
+        "How much detail to return: summary (the signature and its key properties), standard (adds references, observables, platforms, and deployment info), or full (adds the name, kill chain phases, signature version, and main observable type)",
+    ] = "standard",
+    max_bytes: Annotated[
+        int | None,
+        'Approximate max size of the response, in bytes. Lists in the response are cut short to fit, with the number of entries left out given in "truncated" fields. Defaults to the server\'s limit, 0 for no limit',
+    ] = None,
+    bypass_cache: Annotated[
+        bool, "Set to True to skip cached results and always query OpenCTI"
+    ] = False,
 ) -> Annotated[list[dict], "Data structure representing the observable"] | None:
     """This tool can be used to search for one or more indicators (also called a signature or IOC) given a list of strings,
     which will be used to perform a search within the indicator's pattern field (also known as the signature content or body).
@@ -121,18 +197,38 @@ async def opencti_indicator_lookup(
     input parameters. The name of the indicator, such as its filename or signature name, can also be provided as the indicator_id.
 
     This tool will return a list of the indicators (also known as signatures, IOCs, or patterns) that match the provided input.
+    If the list had to be cut short to fit max_bytes, its last entry is {"truncated": {"indicators": N}}, giving the number
+    of matching indicators left out; narrow the search to see them. With detail set to full, each indicator also has
+    "name", "signature_version", "main_observable_type", and "kill_chain_phases" fields.
     """
     if not OpenCTIConfig.opencti_url:
         await ctx.error("OpenCTI URL was not set. Tool will not work")
         return None
 
-    octi = OpenCTIApiClient(
-        url=OpenCTIConfig.opencti_url, token=OpenCTIConfig.opencti_key, ssl_verify=True
-    )
+    # The search strings and pattern types are order-insensitive, so sort them for the cache key
+    if indicator_id:
+        lookup = [indicator_id]
+    else:
+        lookup = [sorted(set(pattern_search_strings)), sorted(set(pattern_types))]
+    key = make_key("opencti_indicator_lookup", *lookup, detail)
+    miss_key = make_key("opencti_indicator_lookup", *lookup)
+    hit, cached = await cache_lookup(ctx, key, bypass_cache, miss_key)
+    if hit:
+        return fit_list(cached, len(cached), max_bytes, "indicators", ind_lists)[0]
 
-    found_indicators = []
+    pool = get_client_pool(OpenCTIConfig.opencti_url, OpenCTIConfig.opencti_key)
 
     try:
+        # An indicator looked up by Id may have already been seen in another response, such
+        # as a pattern search
+        if indicator_id and not bypass_cache:
+            stored = await stored_entity(
+                pool, "indicator", indicator_id, ind_profiles[detail]
+            )
+            if stored is not None:
+                await ctx.debug(f"Returning stored indicator {indicator_id}")
+                return fit_list([stored], 1, max_bytes, "indicators", ind_lists)[0]
+
         filter_block = {}
         if indicator_id:
             # If indicator_id is specified, then do a lookup for the Id value as either an OpenCTI
@@ -188,24 +284,59 @@ async def opencti_indicator_lookup(
                     }
                 )
 
-        ind = octi.indicator.list(
-            filters=filter_block,
-            customAttributes=ind_projection,
-        )
-        await ctx.debug(f"Got {json.dumps(ind)}")
+        mirror = fresh_mirror()
+        candidates = None
+        if mirror is None and not indicator_id:
+            # The pattern index narrows the search down to a few candidates, which are read
+            # by Id, rather than having OpenCTI scan every pattern
+            candidates = await find_candidates(pattern_search_strings, pattern_types)
+
+        if mirror is not None and indicator_id:
+            ind = mirror.find("indicator", [indicator_id])
+        elif mirror is not None:
+            ind = mirror.search_indicators(pattern_search_strings, pattern_types)
+        elif candidates is not None:
+            ind = await pool.run(
+                read_candidates,
+                candidates,
+                pattern_search_strings,
+                pattern_types,
+                detail,
+            )
+        else:
+            ind = await pool.run(
+                lambda octi: octi.indicator.list(
+                    filters=filter_block,
+                    customAttributes=ind_projections[detail],
+                )
+            )
+        await debug_json(ctx, "Got", ind)
 
         if ind is None:
             await ctx.info("Result from OpenCTI was None")
+            cache_store("opencti_indicator_lookup", key, None, miss_key)
             return None
 
-        for i in ind:
-            parsed_ind = parse_indicator(i)
-            await ctx.debug(f"Made {json.dumps(parsed_ind)}")
+        forget_misses(
+            *[term for i in ind for term in (i["id"], i["standard_id"], i["name"])]
+        )
 
-            found_indicators.append(parsed_ind)
+        # Indicators are only parsed until the size budget runs out
+        found_indicators, truncated = fit_list(
+            (remember("indicator", parse_indicator(i, detail)) for i in ind),
+            len(ind),
+            max_bytes,
+            "indicators",
+            ind_lists,
+        )
+        await debug_json(ctx, "Made", found_indicators)
 
+        # Truncated results are not cached, as they depend on the budget
+        if not truncated:
+            cache_store("opencti_indicator_lookup", key, found_indicators, miss_key)
         return found_indicators
     except Exception as e:
+        record_error()
         await ctx.error("Failed: {e}\n".format(e=e))
         raise e
 
@@ -1,164 +1,204 @@
-import json
 from typing import Annotated
-from pycti import OpenCTIApiClient
 from fastmcp import Context
 
+from pycti_mcp.budget import Budget
+from pycti_mcp.cache import cache_lookup, cache_store, forget_misses, make_key
+from pycti_mcp.client_pool import get_client_pool
+from pycti_mcp.entity_store import remember, stored_entity
+from pycti_mcp.membership import might_exist
+from pycti_mcp.metrics import debug_json, record_error, timed_parse
+from pycti_mcp.mirror import fresh_mirror
+from pycti_mcp.projection import (
+    Detail,
+    Connection,
+    Nested,
+    build_projections,
+    container_refs,
+    containers_needs,
+    external_urls,
+    parse_profile,
+    urls_needs,
+)
+
 
 class OpenCTIConfig:
     opencti_url = ""
     opencti_key = ""
 
 
-def parse_obs(o):
-    parsed_o = {
-        "observable_value": o["observable_value"],
-        "stix_id": o["standard_id"],
-        "opencti_id": o["id"],
-        "data_type": o["entity_type"],
-        "description": o["x_opencti_description"],
-        "created": o["created_at"],
-        "last_updated": o["updated_at"],
-        "labels": [label["value"] for label in o["objectLabel"]],
-        "external_reports": [
-            {"name": r["name"], "urls": [e["url"] for e in r["externalReferences"]]}
-            for r in o["reports"]
-        ]
-        + [{"name": "Self", "urls": [e["url"] for e in o["externalReferences"]]}],
-        "notes": [note["content"] for note in o["notes"]],
-        "opinions": [
+# Each field of the parsed observable, with the GraphQL fields it is parsed from and how
+obs_outputs = {
+    "observable_value": (["observable_value"], lambda o: o["observable_value"]),
+    "stix_id": (["standard_id"], lambda o: o["standard_id"]),
+    "opencti_id": (["id"], lambda o: o["id"]),
+    "data_type": (["entity_type"], lambda o: o["entity_type"]),
+    "description": (["x_opencti_description"], lambda o: o["x_opencti_description"]),
+    "created": (["created_at"], lambda o: o["created_at"]),
+    "last_updated": (["updated_at"], lambda o: o["updated_at"]),
+    "labels": (
+        [Nested("objectLabel", ["value"], many=True)],
+        lambda o: [label["value"] for label in o["objectLabel"]],
+    ),
+    "score": (["x_opencti_score"], lambda o: o["x_opencti_score"]),
+    "external_reports": (
+        [Connection("reports", containers_needs)] + urls_needs,
+        lambda o: container_refs(o["reports"])
+        + [{"name": "Self", "urls": external_urls(o)}],
+    ),
+    "cases": (
+        [Connection("cases", containers_needs)],
+        lambda o: container_refs(o["cases"]),
+    ),
+    "groupings": (
+        [Connection("groupings", containers_needs)],
+        lambda o: container_refs(o["groupings"]),
+    ),
+    "notes": (
+        [Connection("notes", ["content"])],
+        lambda o: [note["content"] for note in o["notes"]],
+    ),
+    "opinions": (
+        [Connection("opinions", ["opinion", "explanation"])],
+        lambda o: [
             {"sentiment": op["opinion"], "explanation": op["explanation"]}
             for op in o["opinions"]
         ],
-    }
-    return parsed_o
-
-
-obs_projection = """
-    id
-    standard_id
-    observable_value
-    entity_type
-    x_opencti_description
-    created_at
-    updated_at
-    externalReferences {
-      edges {
-        node {
-          url
-        }
-      }
-    }
-    objectLabel {
-      id
-      value
-    }
-    reports {
-      edges {
-        node {
-          id
-          name
-          externalReferences {
-            edges {
-              node {
-                url
-              }
-            }
-          }
-        }
-      }
-    }
-    cases {
-      edges {
-        node {
-          id
-          name
-          externalReferences {
-            edges {
-              node {
-                url
-              }
-            }
-          }
-        }
-      }
-    }
-    groupings {
-      edges {
-        node {
-          id
-          name
-          externalReferences {
-            edges {
-              node {
-                url
-              }
-            }
-          }
-        }
-      }
-    }
-    notes {
-      edges {
-        node {
-          id
-          content
-        }
-      }
-    }
-    opinions {
-      edges {
-        node {
-          id
-          explanation
-          opinion
-        }
-      }
-    }
-"""
+    ),
+}
+
+obs_profiles = {
+    "summary": [
+        "observable_value",
+        "stix_id",
+        "opencti_id",
+        "data_type",
+        "description",
+        "created",
+        "last_updated",
+        "labels",
+    ],
+    "standard": [
+        "observable_value",
+        "stix_id",
+        "opencti_id",
+        "data_type",
+        "description",
+        "created",
+        "last_updated",
+        "labels",
+        "external_reports",
+        "notes",
+        "opinions",
+    ],
+    "full": list(obs_outputs),
+}
+
+obs_projections = build_projections(obs_outputs, obs_profiles)
+obs_projection = obs_projections["standard"]
+
+# The lists in a parsed observable, in the order they are filled when fitting it into a size
+# budget
+obs_lists = ["external_reports", "notes", "opinions", "cases", "groupings"]
+
+
+@timed_parse
+def parse_obs(o, detail="standard"):
+    return parse_profile(obs_outputs, obs_profiles[detail], o)
+
+
+# Read the observable with the given value, OpenCTI Id, or STIX Id
+def read_observable(octi, observable, detail):
+    return octi.stix_cyber_observable.read(
+        filters={
+            "mode": "or",
+            # Search for a matching value across the id and standard_id fields, too, so
+            # so that this function can return an observable by either Id or Value
+            "filters": [
+                {"key": "value", "values": [observable]},
+                {"key": "id", "values": [observable]},
+                {"key": "standard_id", "values": [observable]},
+            ],
+            "filterGroups": [],
+        },
+        customAttributes=obs_projections[detail],
+    )
+
+
+def fit_obs(o, max_bytes):
+    return Budget(max_bytes).fit(o, obs_lists) if o else o
 
 
 async def opencti_observable_lookup(
     observable: Annotated[str, "The value of the observable to look up in OpenCTI"],
     ctx: Context,
+    detail: Annotated[
+        Detail,
+        "How much detail to return: summary (the observable's own fields), standard (adds related reports, notes, and opinions), or full (adds cases, groupings, and score)",
+    ] = "standard",
+    max_bytes: Annotated[
+        int | None,
+        'Approximate max size of the response, in bytes. Lists in the response are cut short to fit, with the number of entries left out given in "truncated" fields. Defaults to the server\'s limit, 0 for no limit',
+    ] = None,
+    bypass_cache: Annotated[
+        bool, "Set to True to skip cached results and always query OpenCTI"
+    ] = False,
 ) -> Annotated[dict, "Data structure representing the observable"] | None:
     """Given obervable, look it up in OpenCTI. If it is stored in OpenCTI return a JSON
     data structure with information about it. Otherwise, if it doesn't exist, None will
     be returned. The observable parameter can also be a STIX id or OpenCTI UUID, and the
-    tool will return the observable with that Id, if it exists in the platform."""
+    tool will return the observable with that Id, if it exists in the platform. With detail set
+    to full, the observable also has "score", "cases", and "groupings" fields."""
     if not OpenCTIConfig.opencti_url:
         await ctx.error("OpenCTI URL was not set. Tool will not work")
         return None
 
-    octi = OpenCTIApiClient(
-        url=OpenCTIConfig.opencti_url, token=OpenCTIConfig.opencti_key, ssl_verify=True
-    )
+    key = make_key("opencti_observable_lookup", observable, detail)
+    miss_key = make_key("opencti_observable_lookup", observable)
+    hit, cached = await cache_lookup(ctx, key, bypass_cache, miss_key)
+    if hit:
+        return fit_obs(cached, max_bytes)
 
-    try:
-        o = octi.stix_cyber_observable.read(
-            filters={
-                "mode": "or",
-                # Search for a matching value across the id and standard_id fields, too, so
-                # so that this function can return an observable by either Id or Value
-                "filters": [
-                    {"key": "value", "values": [observable]},
-                    {"key": "id", "values": [observable]},
-                    {"key": "standard_id", "values": [observable]},
-                ],
-                "filterGroups": [],
-            },
-            customAttributes=obs_projection,
+    # The filter may be a refresh behind, so a fresh query doesn't trust it either
+    if not bypass_cache and not might_exist(observable):
+        await ctx.info(
+            "Observable is not in the membership filter, so it isn't in OpenCTI"
         )
-        await ctx.debug(f"Got {json.dumps(o)}")
+        return None
+
+    pool = get_client_pool(OpenCTIConfig.opencti_url, OpenCTIConfig.opencti_key)
+    mirror = fresh_mirror()
+
+    try:
+        # An observable looked up by Id may have already been seen in another response
+        if not bypass_cache:
+            stored = await stored_entity(
+                pool, "observable", observable, obs_profiles[detail]
+            )
+            if stored is not None:
+                await ctx.debug(f"Returning stored observable {observable}")
+                return fit_obs(stored, max_bytes)
+
+        if mirror is not None:
+            found = mirror.find("observable", [observable])
+            o = found[0] if found else None
+        else:
+            o = await pool.run(read_observable, observable, detail)
+        await debug_json(ctx, "Got", o)
 
         if o is None:
             await ctx.info("Result from OpenCTI was None")
+            cache_store("opencti_observable_lookup", key, None, miss_key)
             return None
 
-        parsed_o = parse_obs(o)
-        await ctx.debug(f"Made {json.dumps(parsed_o)}")
+        forget_misses(o["observable_value"], o["id"], o["standard_id"])
+
+        parsed_o = remember("observable", parse_obs(o, detail))
+        await debug_json(ctx, "Made", parsed_o)
 
-        return parsed_o
+        cache_store("opencti_observable_lookup", key, parsed_o, miss_key)
+        return fit_obs(parsed_o, max_bytes)
     except Exception as e:
+        record_error()
         await ctx.error("Failed: {e}\n".format(e=e))
         raise e
 
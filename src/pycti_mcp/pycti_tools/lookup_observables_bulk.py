@@ -0,0 +1,223 @@
+import asyncio
+from typing import Annotated, List
+from fastmcp import Context
+
+from pycti_mcp.budget import fit_list
+from pycti_mcp.cache import cache_lookup, cache_store, forget_misses, make_key
+from pycti_mcp.client_pool import get_client_pool
+from pycti_mcp.entity_store import remember
+from pycti_mcp.membership import might_exist
+from pycti_mcp.metrics import debug_json, record_error
+from pycti_mcp.mirror import fresh_mirror
+from pycti_mcp.executor import ExecutorConfig
+from pycti_mcp.projection import Detail
+from pycti_mcp.pycti_tools.lookup_observables import (
+    obs_lists,
+    obs_projections,
+    parse_obs,
+)
+
+
+class OpenCTIConfig:
+    opencti_url = ""
+    opencti_key = ""
+
+
+# Fetch every observable matching any of the values (by value, OpenCTI Id, or STIX Id), walking
+# through all of the result pages
+def list_observables(octi, values, detail):
+    return octi.stix_cyber_observable.list(
+        filters={
+            "mode": "or",
+            "filters": [
+                {"key": "value", "values": values},
+                {"key": "id", "values": values},
+                {"key": "standard_id", "values": values},
+            ],
+            "filterGroups": [],
+        },
+        first=len(values),
+        getAll=True,
+        customAttributes=obs_projections[detail],
+    )
+
+
+# Map each of the observables from OpenCTI back to the input value(s) it matched. When more
+# than one observable matches an input, the first one returned by OpenCTI is kept.
+def match_observables(values, found):
+    matches = {}
+    wanted = set(values)
+    by_casefold = {}
+    for v in values:
+        by_casefold.setdefault(v.casefold(), []).append(v)
+
+    for o in found:
+        keys = [o["id"], o["standard_id"], o["observable_value"]]
+        for k in keys:
+            if k in wanted:
+                matches.setdefault(k, o)
+
+        # OpenCTI normalizes some observable values (e.g. hash case) when storing them
+        if o["observable_value"] is not None:
+            for v in by_casefold.get(o["observable_value"].casefold(), []):
+                matches.setdefault(v, o)
+
+    return matches
+
+
+async def opencti_observable_bulk_lookup(
+    observables: Annotated[
+        List[str], "The values (or Ids) of the observables to look up in OpenCTI"
+    ],
+    ctx: Context,
+    detail: Annotated[
+        Detail,
+        "How much detail to return for each observable: summary, standard, or full (see the single observable lookup tool)",
+    ] = "standard",
+    max_bytes: Annotated[
+        int | None,
+        'Approximate max size of the response, in bytes. Lists in the response are cut short to fit, with the number of entries left out given in "truncated" fields. Defaults to the server\'s limit, 0 for no limit',
+    ] = None,
+    bypass_cache: Annotated[
+        bool, "Set to True to skip cached results and always query OpenCTI"
+    ] = False,
+) -> Annotated[list[dict], "List of results, one per requested observable"] | None:
+    """Given a list of observables, look all of them up in OpenCTI at once. This is much faster than looking
+    up many observables one at a time. Returns a list with one entry for each distinct requested observable,
+    in the order they were requested, with the following fields: "observable" (the requested value), "found"
+    (whether it is stored in OpenCTI), and "result" (the same data structure returned by the single observable
+    lookup tool, or None if not found). The observables can also be STIX ids or OpenCTI UUIDs. If the list had
+    to be cut short to fit max_bytes, its last entry is {"truncated": {"observables": N}}, giving the number of
+    observables left out; look them up in another call.
+    """
+    if not OpenCTIConfig.opencti_url:
+        await ctx.error("OpenCTI URL was not set. Tool will not work")
+        return None
+
+    pool = get_client_pool(OpenCTIConfig.opencti_url, OpenCTIConfig.opencti_key)
+
+    # Drop duplicates, but keep the order the observables were requested in
+    values = list(dict.fromkeys(observables))
+
+    # Answer what we can from the cache shared with opencti_observable_lookup, including the
+    # observables it recently found not to exist, and only query OpenCTI for the rest
+    known = {}
+    for v in values:
+        hit, result = await cache_lookup(
+            ctx,
+            make_key("opencti_observable_lookup", v, detail),
+            bypass_cache,
+            make_key("opencti_observable_lookup", v),
+        )
+        if hit:
+            known[v] = result
+        elif not bypass_cache and not might_exist(v):
+            # Not in the membership filter, so it definitely isn't in OpenCTI (as of the last
+            # refresh, which a fresh query doesn't settle for)
+            known[v] = None
+
+    bulk_results = await query_observables(
+        pool, ctx, [v for v in values if v not in known], detail
+    )
+    for v, result in known.items():
+        bulk_results[v] = {
+            "observable": v,
+            "found": result is not None,
+            "result": result,
+        }
+
+    bulk_results = [bulk_results[v] for v in values]
+    await debug_json(ctx, "Made", bulk_results)
+
+    # Every observable's status is kept ahead of the details of any of them
+    return fit_list(
+        bulk_results,
+        len(bulk_results),
+        max_bytes,
+        "observables",
+        obs_lists,
+        within="result",
+    )[0]
+
+
+# Look up the values in OpenCTI, returning a dict mapping each value to its result entry
+async def query_observables(pool, ctx, values, detail):
+    if not values:
+        return {}
+
+    mirror = fresh_mirror()
+    if mirror is not None:
+        found_list = mirror.find("observable", values)
+        return match_results(values, found_list, {}, detail)
+
+    # Split large batches into several requests, which run concurrently
+    size = max(1, ExecutorConfig.batch_size)
+    chunks = [values[i : i + size] for i in range(0, len(values), size)]
+    results = await asyncio.gather(
+        *[pool.run(list_observables, chunk, detail) for chunk in chunks],
+        return_exceptions=True,
+    )
+
+    found_list = []
+    errors = {}
+    for chunk, result in zip(chunks, results):
+        if isinstance(result, Exception):
+            record_error()
+            await ctx.error("Failed: {e}\n".format(e=result))
+            for v in chunk:
+                errors[v] = str(result)
+        else:
+            found_list += result
+
+    # Only fail the tool call if every one of the requests failed
+    if len(errors) == len(values):
+        raise next(r for r in results if isinstance(r, Exception))
+
+    await ctx.info(
+        f"Found {len(found_list)} observables in OpenCTI for {len(values)} values"
+    )
+    return match_results(values, found_list, errors, detail)
+
+
+# Build the result entry for each of the values from the observables found, caching each one
+def match_results(values, found_list, errors, detail):
+    matches = match_observables(values, found_list)
+
+    forget_misses(
+        *[
+            term
+            for o in found_list
+            for term in (o["observable_value"], o["id"], o["standard_id"])
+        ]
+    )
+
+    parsed = {}
+    bulk_results = {}
+    for v in values:
+        entry = {"observable": v, "found": v in matches, "result": None}
+        if v in matches:
+            o = matches[v]
+            # An observable may have matched more than one input (e.g. by value and by Id)
+            if o["id"] not in parsed:
+                parsed[o["id"]] = remember("observable", parse_obs(o, detail))
+            entry["result"] = parsed[o["id"]]
+        elif v in errors:
+            entry["error"] = errors[v]
+            bulk_results[v] = entry
+            continue
+
+        cache_store(
+            "opencti_observable_lookup",
+            make_key("opencti_observable_lookup", v, detail),
+            entry["result"],
+            make_key("opencti_observable_lookup", v),
+        )
+        bulk_results[v] = entry
+
+    return bulk_results
+
+
+def tool_init(url, key):
+    OpenCTIConfig.opencti_url = url
+    OpenCTIConfig.opencti_key = key
+    return opencti_observable_bulk_lookup
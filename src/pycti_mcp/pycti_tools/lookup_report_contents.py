@@ -0,0 +1,192 @@
+from typing import Annotated, List, Literal
+from fastmcp import Context
+
+from pycti_mcp.budget import Budget
+from pycti_mcp.cache import cache_lookup, cache_store, forget_misses, make_key
+from pycti_mcp.client_pool import get_client_pool
+from pycti_mcp.metrics import debug_json, record_error, timed_parse
+from pycti_mcp.projection import render
+from pycti_mcp.pycti_tools.lookup_reports import (
+    content_types,
+    objects_needs,
+    translate_object,
+)
+
+
+class OpenCTIConfig:
+    opencti_url = ""
+    opencti_key = ""
+
+
+# Objects are fetched a page at a time. The page size requested by the caller is capped at
+# max_page_size.
+default_page_size = 100
+max_page_size = 500
+
+# Without any types given, list the entities and observables in the report, but not the
+# relationships between them
+default_types = ["Stix-Domain-Object", "Stix-Cyber-Observable"]
+
+# Read one page of the report's objects, restricted to the given types by OpenCTI itself. The
+# cursor of each object is fetched too, so that a page cut short to fit the size budget can be
+# continued from the last object returned.
+report_contents_query = f"""
+    query ReportContents($id: String!, $types: [String], $first: Int, $after: ID) {{
+      report(id: $id) {{
+        id
+        standard_id
+        name
+        objects(types: $types, first: $first, after: $after) {{
+          edges {{
+            cursor
+            node {{
+{render(objects_needs, indent=14)}
+            }}
+          }}
+          pageInfo {{
+            endCursor
+            hasNextPage
+            globalCount
+          }}
+        }}
+      }}
+    }}
+"""
+
+
+# Returns the report, the page of its objects, and their cursors, or None if the report doesn't
+# exist
+def read_report_contents(octi, report_id, types, first, after):
+    result = octi.query(
+        report_contents_query,
+        {"id": report_id, "types": types, "first": first, "after": after},
+    )
+    rpt = result["data"]["report"]
+    if rpt is None:
+        return None
+    cursors = [edge["cursor"] for edge in rpt["objects"]["edges"]]
+    return rpt, octi.process_multiple(rpt["objects"], with_pagination=True), cursors
+
+
+@timed_parse
+def parse_contents(rpt, page):
+    page_info = page["pagination"]
+    has_more = bool(page_info.get("hasNextPage"))
+    return {
+        "report": {
+            "opencti_id": rpt["id"],
+            "stix_id": rpt["standard_id"],
+            "name": rpt["name"],
+        },
+        "total": page_info.get("globalCount"),
+        "objects": [translate_object(o) for o in page["entities"]],
+        "has_more": has_more,
+        "next_cursor": page_info.get("endCursor") if has_more else None,
+    }
+
+
+# Fit as many of the objects as will into max_bytes. Objects which don't fit are left for the
+# next page, by continuing from the cursor of the last object kept. The first object is always
+# kept, even if it is over the budget, so that the next page never starts where this one did.
+def fit_contents(contents, cursors, max_bytes):
+    budget = Budget(max_bytes)
+    objects = contents["objects"]
+    fitted = dict(contents, objects=[])
+    budget.take(fitted)
+    fitted["objects"] = budget.take_list(objects) or objects[:1]
+
+    omitted = len(objects) - len(fitted["objects"])
+    if omitted:
+        fitted["truncated"] = {"objects": omitted}
+        fitted["has_more"] = True
+        fitted["next_cursor"] = cursors[len(fitted["objects"]) - 1]
+    return fitted
+
+
+async def opencti_report_contents(
+    report_id: Annotated[
+        str, "The OpenCTI Id or STIX Id of the report to list the contents of"
+    ],
+    ctx: Context,
+    entity_types: Annotated[
+        # Any OpenCTI entity type can be given, the listed ones are just the common ones
+        List[str | Literal[tuple(content_types)]],
+        "Only list objects of these entity types. If empty, all entities and observables are listed, but not relationships",
+    ] = [],
+    limit: Annotated[
+        int, f"Max number of objects to return (at most {max_page_size})"
+    ] = default_page_size,
+    cursor: Annotated[
+        str | None,
+        "Cursor returned as next_cursor by a previous call, to fetch the next page of objects",
+    ] = None,
+    max_bytes: Annotated[
+        int | None,
+        'Approximate max size of the response, in bytes. Lists in the response are cut short to fit, with the number of entries left out given in "truncated" fields. Defaults to the server\'s limit, 0 for no limit',
+    ] = None,
+    bypass_cache: Annotated[
+        bool, "Set to True to skip cached results and always query OpenCTI"
+    ] = False,
+) -> Annotated[dict | None, "Data structure listing the objects in the report"]:
+    """Given the Id of a report (for example, one found with the reports lookup tool), list the objects the
+    report contains: the entities, observables, indicators, and (if asked for by type) relationships. The
+    objects can be restricted to some entity types, such as Malware, Indicator, or Stix-Cyber-Observable.
+    Objects are returned a page at a time in the "objects" field of the result, with the total number of
+    matching objects in "total". If "has_more" is true, calling this tool again with the same report and
+    types, and cursor set to the returned "next_cursor", will return the next page. If the page had to be cut
+    short to fit max_bytes, "truncated" gives the number of objects left out, which the next page starts with.
+    If the report isn't found, None will be returned.
+    """
+    if not OpenCTIConfig.opencti_url:
+        await ctx.error("OpenCTI URL was not set. Tool will not work")
+        return None
+
+    types = sorted(set(entity_types)) or default_types
+    first = max(1, min(limit, max_page_size))
+    key = make_key("opencti_report_contents", report_id, types, first, cursor)
+    miss_key = make_key("opencti_report_contents", report_id)
+    hit, cached = await cache_lookup(ctx, key, bypass_cache, miss_key)
+    if hit:
+        return fit_contents(*cached, max_bytes) if cached else None
+
+    pool = get_client_pool(OpenCTIConfig.opencti_url, OpenCTIConfig.opencti_key)
+
+    try:
+        found = await pool.run(read_report_contents, report_id, types, first, cursor)
+        if found is None:
+            await ctx.info(f"Report {report_id} was not found in OpenCTI")
+            cache_store("opencti_report_contents", key, None, miss_key)
+            return None
+
+        rpt, page, cursors = found
+        contents = parse_contents(rpt, page)
+        await debug_json(ctx, "Made", contents)
+
+        # Every entity contained in the report is now known to exist in OpenCTI
+        forget_misses(
+            *[
+                term
+                for o in contents["objects"]
+                for term in (
+                    o["opencti_id"],
+                    o["stix_id"],
+                    o.get("observable_value"),
+                    o.get("value"),
+                    o.get("name"),
+                )
+            ]
+        )
+
+        cache_store("opencti_report_contents", key, [contents, cursors], miss_key)
+        return fit_contents(contents, cursors, max_bytes)
+    except Exception as e:
+        record_error()
+        await ctx.error(f"There was an error {e}")
+
+    return None
+
+
+def tool_init(url, key):
+    OpenCTIConfig.opencti_url = url
+    OpenCTIConfig.opencti_key = key
+    return opencti_report_contents
@@ -1,16 +1,44 @@
-import json
 from dateutil.parser import parse as dateparse
 from typing import Annotated
-from pycti import OpenCTIApiClient
 from fastmcp import Context
 
+from pycti_mcp.budget import Budget
+from pycti_mcp.cache import cache_lookup, cache_store, forget_misses, make_key
+from pycti_mcp.client_pool import get_client_pool
+from pycti_mcp.metrics import debug_json, record_error, timed_parse
+from pycti_mcp.mirror import fresh_mirror, get_mirror, parse_mirror_cursor
+from pycti_mcp.projection import (
+    Detail,
+    Connection,
+    Fragment,
+    Nested,
+    build_projections,
+    external_urls,
+    parse_profile,
+    urls_needs,
+)
+from pycti_mcp.report_buckets import parse_bucket_cursor, search_reports
+
 
 class OpenCTIConfig:
     opencti_url = ""
     opencti_key = ""
 
 
-desired_obj_fields = ["value", "name", "pattern", "pattern_type", "observable_value"]
+# Reports can each contain thousands of objects, so they're always fetched a page at a time. The
+# page size requested by the caller is capped at max_page_size.
+default_page_size = 20
+max_page_size = 50
+
+
+desired_obj_fields = [
+    "value",
+    "name",
+    "pattern",
+    "pattern_type",
+    "observable_value",
+    "relationship_type",
+]
 
 
 def filter_object(o):
@@ -38,166 +66,249 @@ def translate_object(o):
     return new_o
 
 
-def parse_rpt(rpt: dict) -> dict:
-    parsed_rpt = {
-        "stix_id": rpt["standard_id"],
-        "opencti_id": rpt["id"],
-        "labels": [label["value"] for label in rpt["objectLabel"]],
-        "data_type": rpt["entity_type"],
-        "description": rpt["description"],
-        "name": rpt["name"],
-        "created": rpt["created"],
-        "modified": rpt["modified"],
-        "published": rpt["published"],
-        "report_types": rpt["report_types"],
-        "external_urls": [e["url"] for e in rpt["externalReferences"]],
-        "objects": [translate_object(o) for o in filter(filter_object, rpt["objects"])],
-    }
-
-    return parsed_rpt
+# Normalize a date argument so that equivalent spellings of the same date share a cache entry
+def normalize_date(d):
+    if not d:
+        return None
+    try:
+        return dateparse(d).isoformat()
+    except (ValueError, OverflowError):
+        return d
+
+
+# The entity types (GraphQL types) of report objects which have a name
+named_object_types = [
+    "AttackPattern",
+    "Campaign",
+    "CourseOfAction",
+    "Individual",
+    "Organization",
+    "Sector",
+    "System",
+    "Infrastructure",
+    "IntrusionSet",
+    "Position",
+    "City",
+    "Country",
+    "Region",
+    "Malware",
+    "ThreatActor",
+    "Tool",
+    "Vulnerability",
+    "Incident",
+    "Event",
+    "Channel",
+    "Narrative",
+    "Language",
+    "DataComponent",
+    "DataSource",
+    "Case",
+]
+
+# Report objects can be of any type, so their fields are fetched with inline fragments
+objects_needs = [
+    Fragment("BasicObject", ["id", "entity_type"]),
+    Fragment("BasicRelationship", ["id", "entity_type"]),
+    Fragment("StixObject", ["standard_id"]),
+    *[Fragment(t, ["name"]) for t in named_object_types],
+    Fragment("Indicator", ["name", "pattern", "pattern_type"]),
+    Fragment("StixCyberObservable", ["observable_value"]),
+    Fragment("StixCoreRelationship", ["standard_id", "relationship_type"]),
+    Fragment("StixSightingRelationship", ["standard_id"]),
+]
+
+# The entity types a report's objects are counted by, which can also be listed with the
+# opencti_report_contents tool. The abstract types (such as Stix-Cyber-Observable) cover all of
+# the concrete types under them.
+content_types = [
+    "Attack-Pattern",
+    "Campaign",
+    "Course-Of-Action",
+    "Identity",
+    "Incident",
+    "Indicator",
+    "Infrastructure",
+    "Intrusion-Set",
+    "Location",
+    "Malware",
+    "Observed-Data",
+    "Threat-Actor",
+    "Tool",
+    "Vulnerability",
+    "Stix-Cyber-Observable",
+    "stix-core-relationship",
+    "stix-sighting-relationship",
+]
+
+
+def count_alias(entity_type):
+    return "count_" + entity_type.replace("-", "_")
+
+
+# The objects connection, once for each content type, restricted to that type and fetching only
+# its total count
+object_counts_needs = [
+    Nested(
+        "objects",
+        [Nested("pageInfo", ["globalCount"])],
+        args=f'types: ["{t}"], first: 1',
+        alias=count_alias(t),
+    )
+    for t in content_types
+]
+
+
+def object_counts(rpt):
+    counts = {t: rpt[count_alias(t)]["pageInfo"]["globalCount"] for t in content_types}
+    return {t: n for t, n in counts.items() if n}
+
+
+# Each field of the parsed report, with the GraphQL fields it is parsed from and how
+rpt_outputs = {
+    "stix_id": (["standard_id"], lambda rpt: rpt["standard_id"]),
+    "opencti_id": (["id"], lambda rpt: rpt["id"]),
+    "labels": (
+        [Nested("objectLabel", ["value"], many=True)],
+        lambda rpt: [label["value"] for label in rpt["objectLabel"]],
+    ),
+    "data_type": (["entity_type"], lambda rpt: rpt["entity_type"]),
+    "description": (["description"], lambda rpt: rpt["description"]),
+    "name": (["name"], lambda rpt: rpt["name"]),
+    "created": (["created"], lambda rpt: rpt["created"]),
+    "modified": (["modified"], lambda rpt: rpt["modified"]),
+    "published": (["published"], lambda rpt: rpt["published"]),
+    "report_types": (["report_types"], lambda rpt: rpt["report_types"]),
+    "confidence": (["confidence"], lambda rpt: rpt["confidence"]),
+    # pycti fails to process a createdBy without its id
+    "author": (
+        [Nested("createdBy", ["id", Fragment("Identity", ["name"])])],
+        lambda rpt: rpt["createdBy"]["name"] if rpt["createdBy"] else None,
+    ),
+    "external_urls": (urls_needs, external_urls),
+    "object_counts": (object_counts_needs, object_counts),
+    "objects": (
+        [Connection("objects", objects_needs, args="all: true")],
+        lambda rpt: [
+            translate_object(o) for o in filter(filter_object, rpt["objects"])
+        ],
+    ),
+}
 
+rpt_profiles = {
+    "summary": [
+        "stix_id",
+        "opencti_id",
+        "labels",
+        "data_type",
+        "description",
+        "name",
+        "created",
+        "modified",
+        "published",
+        "report_types",
+        "external_urls",
+    ],
+    "standard": [
+        "stix_id",
+        "opencti_id",
+        "labels",
+        "data_type",
+        "description",
+        "name",
+        "created",
+        "modified",
+        "published",
+        "report_types",
+        "external_urls",
+        "object_counts",
+    ],
+    "full": list(rpt_outputs),
+}
 
-report_projection = """
-id
-standard_id
-entity_type
-objectLabel {
-  value
+rpt_projections = build_projections(rpt_outputs, rpt_profiles)
+report_projection = rpt_projections["standard"]
+
+
+# List a page of the reports, as pycti's report.list() does, but fetching the cursor of each
+# report too, so that a page cut short to fit the size budget can be continued from the last
+# report returned
+def build_reports_query(projection):
+    return f"""
+        query Reports($filters: FilterGroup, $search: String, $first: Int, $after: ID, $orderBy: ReportsOrdering, $orderMode: OrderingMode) {{
+          reports(filters: $filters, search: $search, first: $first, after: $after, orderBy: $orderBy, orderMode: $orderMode) {{
+            edges {{
+              cursor
+              node {{
+{projection}
+              }}
+            }}
+            pageInfo {{
+              endCursor
+              hasNextPage
+              globalCount
+            }}
+          }}
+        }}
+    """
+
+
+rpt_list_queries = {
+    detail: build_reports_query(projection)
+    for detail, projection in rpt_projections.items()
 }
-externalReferences {
-  edges {
-    node {
-      source_name
-      description
-      url
+
+
+# Returns the page of reports as pycti's list(withPagination=True) would, with their cursors
+def list_reports(octi, detail, variables):
+    result = octi.query(rpt_list_queries[detail], variables)
+    page = octi.process_multiple(result["data"]["reports"], with_pagination=True)
+    page["cursors"] = [edge["cursor"] for edge in result["data"]["reports"]["edges"]]
+    return page
+
+
+# Replace the reports of a page from the mirror, which doesn't keep their objects, with the full
+# reports read from OpenCTI. Reports deleted since the mirror was updated are left out.
+def read_full_reports(octi, page):
+    ids = [rpt["id"] for rpt in page["entities"]]
+    if not ids:
+        return page
+    filters = {
+        "mode": "and",
+        "filters": [{"key": "id", "values": ids}],
+        "filterGroups": [],
     }
-  }
-}
-created
-modified
-published
-name
-description
-report_types
-objects(all: true) {
-  edges {
-    node {
-      ... on BasicObject {
-        id
-        entity_type
-        parent_types
-      }
-      ... on BasicRelationship {
-        id
-        entity_type
-        parent_types
-      }
-      ... on StixObject {
-        standard_id
-        spec_version
-        created_at
-        updated_at
-      }
-      ... on AttackPattern {
-        name
-      }
-      ... on Campaign {
-        name
-      }
-      ... on CourseOfAction {
-        name
-      }
-      ... on Individual {
-        name
-      }
-      ... on Organization {
-        name
-      }
-      ... on Sector {
-        name
-      }
-      ... on System {
-        name
-      }
-      ... on Indicator {
-        name
-        pattern
-        pattern_type
-      }
-      ... on Infrastructure {
-        name
-      }
-      ... on IntrusionSet {
-        name
-      }
-      ... on Position {
-        name
-      }
-      ... on City {
-        name
-      }
-      ... on Country {
-        name
-      }
-      ... on Region {
-        name
-      }
-      ... on Malware {
-        name
-      }
-      ... on ThreatActor {
-        name
-      }
-      ... on Tool {
-        name
-      }
-      ... on Vulnerability {
-        name
-      }
-      ... on Incident {
-        name
-      }
-      ... on Event {
-        name
-      }
-      ... on Channel {
-        name
-      }
-      ... on Narrative {
-        name
-      }
-      ... on Language {
-        name
-      }
-      ... on DataComponent {
-        name
-      }
-      ... on DataSource {
-        name
-      }
-      ... on Case {
-        name
-      }
-      ... on StixCyberObservable {
-        observable_value
-      }                        
-      ... on StixCoreRelationship {
-        standard_id
-        spec_version
-        created_at
-        updated_at
-        relationship_type
-      }
-     ... on StixSightingRelationship {
-        standard_id
-        spec_version
-        created_at
-        updated_at
-      }
+    found = list_reports(octi, "full", {"filters": filters, "first": len(ids)})
+    by_id = {rpt["id"]: rpt for rpt in found["entities"]}
+    kept = [n for n, opencti_id in enumerate(ids) if opencti_id in by_id]
+    return {
+        **page,
+        "entities": [by_id[ids[n]] for n in kept],
+        "cursors": [page["cursors"][n] for n in kept],
     }
-  }
-}
-"""
+
+
+@timed_parse
+def parse_rpt(rpt: dict, detail: str = "standard") -> dict:
+    return parse_profile(rpt_outputs, rpt_profiles[detail], rpt)
+
+
+# The lists in a parsed report, in the order they are filled when fitting it into a size budget
+rpt_lists = ["external_urls", "objects"]
+
+
+# Build a page of results from the reports (which can be a generator parsing them, so that
+# parsing stops once the budget runs out), fitting as much as will into max_bytes. Reports which
+# don't fit are left for the next page, by continuing from the cursor of the last report kept.
+# Returns the result, and whether anything had to be left out.
+def fit_reports(reports, cursors, cursor, page, max_bytes):
+    budget = Budget(max_bytes)
+    result = {"reports": budget.fit_items(reports, rpt_lists), **page}
+    kept = len(result["reports"])
+    if kept < len(cursors):
+        result["truncated"] = {"reports": len(cursors) - kept}
+        result["has_more"] = True
+        result["next_cursor"] = cursors[kept - 1] if kept else cursor
+    return result, budget.truncated
 
 
 # Look up any reports in the system that match the criteria
@@ -207,29 +318,69 @@ async def opencti_reports_lookup(
     earliest: Annotated[str | None, "The earliest date of a report"] = None,
     latest: Annotated[str | None, "The latest date of a report"] = None,
     search: Annotated[str | None, "Search terms to filter"] = None,
-) -> Annotated[list | None, "Data structure listing the discovered reports"]:
+    limit: Annotated[
+        int, f"Max number of reports to return (at most {max_page_size})"
+    ] = default_page_size,
+    cursor: Annotated[
+        str | None,
+        "Cursor returned as next_cursor by a previous call, to fetch the next page of reports",
+    ] = None,
+    detail: Annotated[
+        Detail,
+        "How much detail to return for each report: summary (without the objects it contains), standard (adds the number of objects of each type), or full (adds the author, confidence, and every object, which can be slow for large reports)",
+    ] = "standard",
+    max_bytes: Annotated[
+        int | None,
+        'Approximate max size of the response, in bytes. Lists in the response are cut short to fit, with the number of entries left out given in "truncated" fields. Defaults to the server\'s limit, 0 for no limit',
+    ] = None,
+    bypass_cache: Annotated[
+        bool, "Set to True to skip cached results and always query OpenCTI"
+    ] = False,
+) -> Annotated[dict | None, "Data structure listing the discovered reports"]:
     """Given a date range (start and end date) and some search terms, find all reports in the system
-    matching the given criteria"""
+    matching the given criteria. Reports are returned a page at a time, newest first, in the "reports"
+    field of the result. If "has_more" is true, more reports match, and calling this tool again with the
+    same criteria and cursor set to the returned "next_cursor" will return the next page. If the result had to
+    be cut short to fit max_bytes, "truncated" gives the number of reports (and, on each report, of its objects
+    and URLs) left out. The next page, from "next_cursor", starts with the reports left out. With detail set to full,
+    each report also has "confidence", "author", and "objects" fields.
+    """
     if not OpenCTIConfig.opencti_url:
         await ctx.error("OpenCTI URL was not set. Tool will not work")
         return None
 
-    octi = OpenCTIApiClient(
-        url=OpenCTIConfig.opencti_url, token=OpenCTIConfig.opencti_key, ssl_verify=True
+    key = make_key(
+        "opencti_reports_lookup",
+        normalize_date(earliest),
+        normalize_date(latest),
+        search,
+        limit,
+        cursor,
+        detail,
     )
+    hit, cached = await cache_lookup(ctx, key, bypass_cache)
+    if hit:
+        cached, cursors = cached
+        page = {k: cached[k] for k in ("has_more", "next_cursor")}
+        return fit_reports(cached["reports"], cursors, cursor, page, max_bytes)[0]
+
+    pool = get_client_pool(OpenCTIConfig.opencti_url, OpenCTIConfig.opencti_key)
 
     await ctx.info(
         f'Searching for reports between {earliest} and {latest} via search term "{search}"'
     )
 
     rpts_list = []
+    page_info = {}
 
     try:
+        # The variables of the reports query (see list_reports())
         fargs = {
             "orderMode": "desc",
             "orderBy": "published",
-            "customAttributes": report_projection,
             "filters": {},
+            "first": max(1, min(limit, max_page_size)),
+            "after": cursor,
         }
 
         if search:
@@ -267,19 +418,80 @@ async def opencti_reports_lookup(
 
             fargs["filters"] = daterange_filter
 
-        await ctx.debug(f"Query: {fargs}")
-        r = octi.report.list(**fargs)
-
-        await ctx.debug(f"{len(r)} Reports found")
+        # Later pages of results from the mirror keep coming from it, even if it has since
+        # fallen behind, as its cursors mean nothing to OpenCTI
+        offset = parse_mirror_cursor(cursor)
+        mirror = get_mirror() if offset is not None else fresh_mirror()
+        r = None
+        if mirror is not None:
+            r = mirror.search_reports(
+                earliest, latest, search, fargs["first"], offset or 0
+            )
+            if detail == "full":
+                r = await pool.run(read_full_reports, r)
+        elif detail != "full" and (
+            not cursor or parse_bucket_cursor(cursor) is not None
+        ):
+            # Date ranges are assembled from the reports cached for each day, fetching only
+            # the days not cached. Full reports list every object, too many to cache by day.
+            r = await search_reports(
+                pool,
+                earliest,
+                latest,
+                search,
+                detail,
+                rpt_projections[detail],
+                fargs["first"],
+                parse_bucket_cursor(cursor) or 0,
+                bypass_cache,
+            )
+        if r is None:
+            await ctx.debug(f"Query: {fargs}")
+            r = await pool.run(list_reports, detail, fargs)
+        page_info = r["pagination"]
+
+        await ctx.debug(f"{len(r['entities'])} Reports found")
+
+        # Every entity contained in the reports is now known to exist in OpenCTI
+        forget_misses(
+            *[
+                term
+                for rpt in r["entities"]
+                for o in rpt.get("objects", [])
+                for term in (
+                    o["id"],
+                    o.get("standard_id"),
+                    o.get("observable_value"),
+                    o.get("value"),
+                    o.get("name"),
+                )
+            ]
+        )
 
-        for rpt in r:
-            parsed_rpt = parse_rpt(rpt)
-            rpts_list.append(parsed_rpt)
-            await ctx.debug(f"Report result: {json.dumps(parsed_rpt)}")
+        has_more = bool(page_info.get("hasNextPage"))
+        page = {
+            "has_more": has_more,
+            "next_cursor": page_info.get("endCursor") if has_more else None,
+        }
+        result, truncated = fit_reports(
+            (parse_rpt(rpt, detail) for rpt in r["entities"]),
+            r["cursors"],
+            cursor,
+            page,
+            max_bytes,
+        )
+        rpts_list = result["reports"]
+        await debug_json(ctx, "Reports result:", result)
+
+        # Truncated results are not cached, as they depend on the budget
+        if not truncated:
+            cache_store("opencti_reports_lookup", key, [result, r["cursors"]])
+        return result
     except Exception as e:
+        record_error()
         await ctx.error(f"There was an error {e}")
 
-    return rpts_list
+    return {"reports": rpts_list, "has_more": False, "next_cursor": None}
 
 
 def tool_init(url, key):
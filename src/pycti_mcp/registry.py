@@ -0,0 +1,83 @@
+import importlib
+import json
+import logging
+import os
+
+from fastmcp.tools.tool import Tool
+from pydantic import PrivateAttr
+
+import pycti_mcp.pycti_tools
+from pycti_mcp import encoding
+from pycti_mcp.coalesce import coalesce_tool
+from pycti_mcp.metrics import instrument_tool
+
+# The tool schemas, generated by build_registry() from the pycti_tools modules. Regenerate it
+# with "python -m pycti_mcp.registry" whenever a tool's signature or docstring changes.
+REGISTRY_PATH = os.path.join(os.path.dirname(__file__), "pycti_tools", "registry.json")
+
+
+def load_tool(module, url, key):
+    """Import the pycti_tools module, and return its tool function, wrapped as a FastMCP Tool
+    whose output is encoded by pycti_mcp.encoding"""
+    tmpmod = importlib.import_module(f"pycti_mcp.pycti_tools.{module}")
+    tool = coalesce_tool(tmpmod.tool_init(url=url, key=key))
+    return Tool.from_function(instrument_tool(tool), serializer=encoding.dumps_str)
+
+
+class LazyTool(Tool):
+    """A tool listed from its schema in the registry, whose module is only imported, and whose
+    function only wrapped, when it is first called"""
+
+    module: str
+    # Not _url and _key: FastMCP components already have a _key, which the tool is added under
+    _opencti_url: str = PrivateAttr(default="")
+    _opencti_key: str = PrivateAttr(default="")
+    _tool: Tool | None = PrivateAttr(default=None)
+
+    def load(self):
+        if self._tool is None:
+            self._tool = load_tool(self.module, self._opencti_url, self._opencti_key)
+        return self._tool
+
+    async def run(self, arguments):
+        return await self.load().run(arguments)
+
+
+def read_registry(path=REGISTRY_PATH):
+    with open(path) as f:
+        return json.load(f)
+
+
+def build_registry():
+    """Return the schemas of all the tools, by importing each of the pycti_tools modules"""
+    registry = []
+    for m in pycti_mcp.pycti_tools.__all__:
+        tool = load_tool(m, "", "")
+        registry.append(
+            {
+                "module": m,
+                "name": tool.name,
+                "description": tool.description,
+                "parameters": tool.parameters,
+                "output_schema": tool.output_schema,
+            }
+        )
+    return registry
+
+
+def register_lazy_tools(mcp, url, key, registry):
+    log = logging.getLogger(__name__)
+
+    # Build all the tools before adding any, so that none are added if the registry is invalid
+    tools = [LazyTool(**spec) for spec in registry]
+    for tool in tools:
+        tool._opencti_url = url
+        tool._opencti_key = key
+        mcp.add_tool(tool)
+        log.info(f"Added Tool {tool.module} to MCP")
+
+
+if __name__ == "__main__":
+    with open(REGISTRY_PATH, "w") as f:
+        json.dump(build_registry(), f, indent=2)
+        f.write("\n")
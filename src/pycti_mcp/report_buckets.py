@@ -0,0 +1,203 @@
+import datetime
+import time
+
+from pycti_mcp.cache import get_response_cache, make_key, tool_ttl
+from pycti_mcp.mirror import utc_timestamp
+
+
+# Settings for the cache of the reports published on each day, which the report lookups' date
+# ranges are assembled from. These are overwritten by the command-line handling in
+# mcp_server_octi.main().
+class ReportBucketConfig:
+    enabled = True
+    # Days which ended more than closed_after seconds ago are cached for closed_ttl seconds, as
+    # few reports are published for days past. Later days are cached for the tool's usual TTL.
+    closed_after = 86400
+    closed_ttl = 6 * 3600
+    # Date ranges spanning more days than this are left to OpenCTI
+    max_days = 90
+    # Days not cached are only fetched to be cached if they have at most this many reports
+    # between them, otherwise the date range is left to OpenCTI, a page at a time
+    max_reports = 1000
+    page_size = 500
+
+
+def bucket_cursor(offset):
+    return f"buckets:{offset}"
+
+
+def parse_bucket_cursor(cursor):
+    """The offset in a cursor returned from the buckets, or None if it came from elsewhere"""
+    if cursor and cursor.startswith("buckets:"):
+        return int(cursor[len("buckets:") :])
+    return None
+
+
+def day_range(earliest, latest):
+    """The days (as YYYY-MM-DD, in UTC) in the date range, newest first, or None if it has no
+    start or spans more than max_days"""
+    if not earliest:
+        return None
+    start = datetime.date.fromisoformat(utc_timestamp(earliest)[:10])
+    if latest:
+        end = datetime.date.fromisoformat(utc_timestamp(latest)[:10])
+    else:
+        end = datetime.datetime.now(datetime.timezone.utc).date()
+
+    days = (end - start).days + 1
+    if days > ReportBucketConfig.max_days:
+        return None
+    return [(end - datetime.timedelta(days=n)).isoformat() for n in range(days)]
+
+
+def next_day(day):
+    return (datetime.date.fromisoformat(day) + datetime.timedelta(days=1)).isoformat()
+
+
+def day_runs(days):
+    """The runs of consecutive days among the days, as the (start, end) ranges to query, where
+    end is the day after the run's last day"""
+    runs = []
+    for day in sorted(days):
+        if runs and runs[-1][1] == day:
+            runs[-1] = (runs[-1][0], next_day(day))
+        else:
+            runs.append((day, next_day(day)))
+    return runs
+
+
+def bucket_key(search, detail, day):
+    return make_key("opencti_reports_lookup:day", search, detail, day)
+
+
+def bucket_ttl(day):
+    ended = datetime.datetime.fromisoformat(next_day(day)).replace(
+        tzinfo=datetime.timezone.utc
+    )
+    if time.time() - ended.timestamp() > ReportBucketConfig.closed_after:
+        return ReportBucketConfig.closed_ttl
+    return tool_ttl("opencti_reports_lookup")
+
+
+# Fetch one page of the reports published from the start of one day to the start of another
+def list_reports(octi, start, end, search, projection, after):
+    kwargs = {
+        "filters": {
+            "mode": "and",
+            "filters": [
+                {
+                    "key": "published",
+                    "values": [f"{start}T00:00:00Z"],
+                    "operator": "gte",
+                },
+                {"key": "published", "values": [f"{end}T00:00:00Z"], "operator": "lt"},
+            ],
+            "filterGroups": [],
+        },
+        "orderBy": "published",
+        "orderMode": "desc",
+        "first": ReportBucketConfig.page_size,
+        "after": after,
+        "withPagination": True,
+        "customAttributes": projection,
+    }
+    if search:
+        kwargs["search"] = search
+    return octi.report.list(**kwargs)
+
+
+async def fill_buckets(pool, days, search, detail, projection, limit=None):
+    """Fetch the reports published on the days, with a single query for each run of
+    consecutive days, caching them by the day they were published. Returns them, keyed by the
+    day, or None without fetching any more if there are more than limit of them.
+
+    The first page of every run is fetched before the rest of any of them, and the runs'
+    reports are counted from those pages' global counts, so that the count costs no requests
+    of its own."""
+    pages = {}
+    count = 0
+    for run in day_runs(days):
+        pages[run] = await pool.run(list_reports, *run, search, projection, None)
+        count += pages[run]["pagination"].get("globalCount") or 0
+        if limit is not None and count > limit:
+            return None
+
+    buckets = {day: [] for day in days}
+    for (start, end), page in pages.items():
+        while True:
+            for rpt in page["entities"]:
+                day = utc_timestamp(rpt["published"])[:10]
+                if day in buckets:
+                    buckets[day].append(rpt)
+            if not page["pagination"].get("hasNextPage"):
+                break
+            after = page["pagination"]["endCursor"]
+            page = await pool.run(list_reports, start, end, search, projection, after)
+
+    cache = get_response_cache()
+    for day, reports in buckets.items():
+        cache.put(bucket_key(search, detail, day), reports, bucket_ttl(day))
+    return buckets
+
+
+async def search_reports(
+    pool, earliest, latest, search, detail, projection, first, offset, bypass=False
+):
+    """A page of the reports published in the date range, matching the search, newest first.
+    The reports published on each day are cached, so only the days missing from the cache
+    (or no longer fresh) are fetched from OpenCTI, with a query for each run of them. Returns
+    them as pycti's list(withPagination=True) would, with a cursor which is the offset of the
+    next page and the cursor of each report, or None if the date range can't be assembled from
+    days, or the days missing have too many reports to be worth fetching in full for the first
+    page."""
+    cache = get_response_cache()
+    if cache is None or not ReportBucketConfig.enabled:
+        return None
+    days = day_range(earliest, latest)
+    if days is None:
+        return None
+
+    buckets = {}
+    if not bypass:
+        for day in days:
+            hit, reports = cache.get(bucket_key(search, detail, day))
+            if hit:
+                buckets[day] = reports
+    missing = [day for day in days if day not in buckets]
+    if missing:
+        # Later pages are of a range whose days had few enough reports for the first page, so
+        # are always assembled from days, as their cursors mean nothing to OpenCTI
+        filled = await fill_buckets(
+            pool,
+            missing,
+            search,
+            detail,
+            projection,
+            None if offset else ReportBucketConfig.max_reports,
+        )
+        if filled is None:
+            return None
+        buckets.update(filled)
+
+    # The first and last days are only partly in the range
+    low = utc_timestamp(earliest)
+    high = utc_timestamp(latest) if latest else None
+    found = []
+    for day in days:
+        for rpt in buckets[day]:
+            published = utc_timestamp(rpt["published"])
+            if published >= low and (high is None or published <= high):
+                found.append((published, rpt))
+    found.sort(key=lambda f: f[0], reverse=True)
+    found = [rpt for _, rpt in found]
+
+    has_more = len(found) > offset + first
+    entities = found[offset : offset + first]
+    return {
+        "entities": entities,
+        "pagination": {
+            "hasNextPage": has_more,
+            "endCursor": bucket_cursor(offset + first) if has_more else None,
+        },
+        "cursors": [bucket_cursor(offset + n + 1) for n in range(len(entities))],
+    }
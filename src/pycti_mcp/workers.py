@@ -0,0 +1,178 @@
+import logging
+import os
+import select
+import signal
+import subprocess
+import time
+
+
+# Settings for serving HTTP from several worker processes. These are overwritten by the
+# command-line handling in mcp_server_octi.main().
+class WorkersConfig:
+    workers = 1
+    # Seconds a stopping worker is given to finish the requests in progress, before it is killed
+    graceful_timeout = 30
+    # Seconds a new worker is given to start up, before it is given up on
+    start_timeout = 60
+    # Seconds between the checks the other workers make for an updated membership snapshot
+    reload_interval = 10
+
+
+def wait_ready(proc, ready_fd, timeout):
+    """Wait for the worker to report that it is ready, by writing to its end of the pipe.
+    Returns False if it exits (or closes the pipe) first, or doesn't start up in time.
+    """
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        readable, _, _ = select.select([ready_fd], [], [], 0.5)
+        if readable:
+            return os.read(ready_fd, 1) != b""
+        if proc.poll() is not None:
+            return False
+    return False
+
+
+def stop_workers(procs):
+    """Ask the workers to stop once their requests in progress are done, killing any which are
+    still running a few seconds after the graceful_timeout (which their servers are given)
+    """
+    for proc in procs:
+        if proc.poll() is None:
+            proc.terminate()
+    deadline = time.monotonic() + WorkersConfig.graceful_timeout + 5
+    for proc in procs:
+        try:
+            proc.wait(max(0, deadline - time.monotonic()))
+        except subprocess.TimeoutExpired:
+            proc.kill()
+            proc.wait()
+
+
+class Supervisor:
+    """Runs worker processes which all serve HTTP on the same listening socket, inherited from
+    this process, and which the OS hands each connection to one of.
+
+    Workers which exit are started again. On SIGHUP, the workers are restarted one at a time:
+    each one's replacement is started (with the code installed now) and ready before it is
+    asked to stop, and it finishes the requests it has in progress, so no request is dropped.
+    SIGTERM and SIGINT stop every worker, just as gracefully.
+
+    command(index, socket_fd, ready_fd) returns the command line to start the index'th worker,
+    which serves on the socket_fd listening socket and writes to ready_fd once it has started.
+    """
+
+    def __init__(self, sock, command, workers=None):
+        self.sock = sock
+        self.command = command
+        self.workers = {}
+        self.failures = {}
+        self.retry_at = {}
+        self.count = workers or WorkersConfig.workers
+        self.stopping = False
+        self.restarting = False
+
+    def launch(self, index):
+        ready_fd, write_fd = os.pipe()
+        try:
+            proc = subprocess.Popen(
+                self.command(index, self.sock.fileno(), write_fd),
+                pass_fds=(self.sock.fileno(), write_fd),
+            )
+        except BaseException:
+            os.close(ready_fd)
+            raise
+        finally:
+            os.close(write_fd)
+        return proc, ready_fd
+
+    def ready(self, index, proc, ready_fd):
+        """Return the launched worker once it is ready, or None if it failed to start"""
+        log = logging.getLogger(__name__)
+        try:
+            ready = wait_ready(proc, ready_fd, WorkersConfig.start_timeout)
+        finally:
+            os.close(ready_fd)
+
+        if not ready:
+            log.error(f"Worker {index} (pid {proc.pid}) failed to start")
+            stop_workers([proc])
+            return None
+        log.info(f"Started worker {index} (pid {proc.pid})")
+        return proc
+
+    def spawn(self, index):
+        return self.ready(index, *self.launch(index))
+
+    def start(self):
+        # The workers start up at the same time, as each takes a while to import everything
+        launched = [(index, *self.launch(index)) for index in range(self.count)]
+        for index, proc, ready_fd in launched:
+            self.workers[index] = self.ready(index, proc, ready_fd)
+        if None in self.workers.values():
+            self.stop()
+            raise RuntimeError("The workers failed to start")
+
+    def restart(self):
+        """Replace each worker in turn, leaving the old one running if its replacement fails"""
+        log = logging.getLogger(__name__)
+        self.restarting = False
+        for index in sorted(self.workers):
+            proc = self.spawn(index)
+            if proc is None:
+                log.error(f"Keeping worker {index}, as its replacement failed to start")
+                continue
+            old, self.workers[index] = self.workers[index], proc
+            self.failures.pop(index, None)
+            if old is not None:
+                stop_workers([old])
+        log.info("Restarted the workers")
+
+    def reap(self):
+        """Start again any workers which have exited, backing off if they keep failing"""
+        log = logging.getLogger(__name__)
+        for index, proc in list(self.workers.items()):
+            if proc is not None:
+                if proc.poll() is None:
+                    continue
+                log.warning(
+                    f"Worker {index} (pid {proc.pid}) exited with status {proc.returncode}"
+                )
+                self.workers[index] = None
+                self.retry_at[index] = time.monotonic()
+
+            if time.monotonic() < self.retry_at[index]:
+                continue
+            proc = self.spawn(index)
+            if proc is None:
+                self.failures[index] = self.failures.get(index, 0) + 1
+                self.retry_at[index] = time.monotonic() + min(
+                    60, 2 ** self.failures[index]
+                )
+            else:
+                self.failures.pop(index, None)
+                self.workers[index] = proc
+
+    def stop(self):
+        stop_workers([proc for proc in self.workers.values() if proc is not None])
+        self.workers.clear()
+
+    def run(self):
+        def on_stop(signum, frame):
+            self.stopping = True
+
+        def on_restart(signum, frame):
+            self.restarting = True
+
+        signal.signal(signal.SIGTERM, on_stop)
+        signal.signal(signal.SIGINT, on_stop)
+        signal.signal(signal.SIGHUP, on_restart)
+
+        self.start()
+        try:
+            while not self.stopping:
+                if self.restarting:
+                    self.restart()
+                self.reap()
+                time.sleep(0.5)
+        finally:
+            self.stop()
@@ -0,0 +1,37 @@
+import pytest
+
+
+class FakePool:
+    """Stands in for the client pool, running each request against a fake pycti client"""
+
+    def __init__(self, octi):
+        self.octi = octi
+
+    async def run(self, fn, *args):
+        return fn(self.octi, *args)
+
+
+class FakeContext:
+    """Stands in for the MCP context, keeping the warnings sent to the client"""
+
+    def __init__(self):
+        self.warnings = []
+
+    async def warning(self, message):
+        self.warnings.append(message)
+
+    async def info(self, message):
+        pass
+
+    debug = error = info
+
+
+@pytest.fixture
+def context():
+    return FakeContext()
+
+
+# Returns the client pool for a fake pycti client: octi_pool(octi)
+@pytest.fixture
+def octi_pool():
+    return FakePool
@@ -0,0 +1,178 @@
+import asyncio
+import re
+import time
+
+import pytest
+
+from pycti_mcp import alias_index
+from pycti_mcp.alias_index import AliasIndex
+from pycti_mcp.cache import get_negative_cache, get_response_cache, make_key
+from pycti_mcp.pycti_tools import lookup_adversary
+from pycti_mcp.pycti_tools.lookup_adversaries_bulk import query_adversaries
+
+
+def adversary(id_, name, aliases=()):
+    return {
+        "id": id_,
+        "standard_id": f"intrusion-set--{id_}",
+        "name": name,
+        "aliases": list(aliases),
+        "entity_type": "Intrusion-Set",
+        "description": "",
+        "created_at": "2024-01-01T00:00:00Z",
+        "updated_at": "2024-01-01T00:00:00Z",
+        "objectLabel": [],
+        "first_seen": None,
+        "last_seen": None,
+        "externalReferences": [],
+    }
+
+
+def report(n):
+    return {"name": f"Report {n}", "externalReferences": [], "published": f"{n:04d}"}
+
+
+class FakeAdversaries:
+    """Stands in for pycti's list() of an adversary type, matching names as OpenCTI does"""
+
+    def __init__(self, found, fail=False):
+        self.found = found
+        self.fail = fail
+        self.filters = []
+
+    def list(self, filters, **kwargs):
+        if self.fail:
+            raise ValueError("Upstream failure")
+        self.filters.append(filters["filters"][0]["key"])
+        terms = {v.casefold() for f in filters["filters"] for v in f["values"]}
+        return [
+            a
+            for a in self.found
+            if terms & {t.casefold() for t in [a["id"], a["name"]] + a["aliases"]}
+        ]
+
+
+class FakeOpenCTI:
+    """Stands in for pycti, serving intrusion sets (and no other adversaries) along with the
+    reports containing them. The combined adversary query fails validation, as it does on
+    platforms older than it, so the tools fall back to separate list calls."""
+
+    def __init__(self, advs, reports, failing=()):
+        self.reports = reports
+        self.queries = []
+        self.intrusion_set = FakeAdversaries(advs)
+        for adv_type in ["campaign", "threat_actor_group", "threat_actor_individual"]:
+            setattr(self, adv_type, FakeAdversaries([], fail=adv_type in failing))
+
+    def query(self, query, variables):
+        if "AdversaryList" in query:
+            raise ValueError("GRAPHQL_VALIDATION_FAILED")
+        self.queries.append(query)
+        data = {}
+        for alias, field, var, first in re.findall(
+            r"(c\d+): (\w+)\(filters: \$(\w+), first: (\d+)", query
+        ):
+            opencti_id = variables[var]["filters"][0]["values"][0]
+            found = self.reports.get(opencti_id, []) if field == "reports" else []
+            data[alias] = {"edges": [{"node": n} for n in found[: int(first)]]}
+        return {"data": data}
+
+    def process_multiple(self, data, with_pagination=False):
+        return [edge["node"] for edge in data["edges"]]
+
+
+@pytest.fixture(autouse=True)
+def fallback(monkeypatch):
+    monkeypatch.setattr(lookup_adversary.OpenCTIConfig, "combined_query", True)
+    monkeypatch.setattr(alias_index, "_index", None)
+    get_response_cache().clear()
+    get_negative_cache().clear()
+
+
+def test_names_are_mapped_to_their_adversaries(octi_pool, context):
+    octi = FakeOpenCTI(
+        [
+            adversary("is-1", "APT1"),
+            adversary("is-28", "APT28", ["Fancy Bear", "Sofacy"]),
+        ],
+        {"is-1": [report(2), report(1)], "is-28": [report(n) for n in range(150)]},
+    )
+    names = ["APT1", "Fancy Bear", "sofacy", "Nobody"]
+    results = asyncio.run(
+        query_adversaries(octi_pool(octi), context, names, "standard")
+    )
+
+    assert list(results) == names
+    assert [ta["opencti_id"] for ta in results["APT1"]["result"]] == ["is-1"]
+    # Each name gets the adversary it is a name or alias of, ignoring case
+    assert results["Fancy Bear"]["result"] == results["sofacy"]["result"]
+    assert results["sofacy"]["result"][0]["opencti_id"] == "is-28"
+    assert results["Nobody"] == {"name": "Nobody", "found": False, "result": None}
+
+    # The combined query is given up on, and the reports, notes, and opinions are listed with
+    # a query for each, with at most the single lookup's limit for each adversary
+    assert not lookup_adversary.OpenCTIConfig.combined_query
+    assert len(octi.queries) == 3
+    apt1_reports = results["APT1"]["result"][0]["external_reports"]
+    assert [r["name"] for r in apt1_reports] == ["Report 1", "Report 2", "Self"]
+    apt28_reports = results["sofacy"]["result"][0]["external_reports"]
+    assert len(apt28_reports) == lookup_adversary.enrichment_limit + 1
+
+    # The results are cached for the single lookup, including the name not found
+    hit, value = get_response_cache().get(
+        make_key("opencti_adversary_lookup", "sofacy", "standard")
+    )
+    assert hit and value == results["sofacy"]["result"]
+    hit, _ = get_negative_cache().get(make_key("opencti_adversary_lookup", "Nobody"))
+    assert hit
+
+
+def test_partial_failures(octi_pool, context):
+    octi = FakeOpenCTI(
+        [adversary("is-1", "APT1")], {}, failing=["campaign", "threat_actor_group"]
+    )
+    results = asyncio.run(
+        query_adversaries(octi_pool(octi), context, ["APT1", "Nobody"], "summary")
+    )
+
+    # The adversaries found are returned, but not cached, as some of the types failed
+    assert results["APT1"]["found"]
+    assert not results["Nobody"]["found"] and "error" not in results["Nobody"]
+    hit, _ = get_response_cache().get(
+        make_key("opencti_adversary_lookup", "APT1", "summary")
+    )
+    assert not hit
+
+    # If every request fails, so does the lookup
+    octi = FakeOpenCTI(
+        [], {}, failing=["campaign", "threat_actor_group", "threat_actor_individual"]
+    )
+    octi.intrusion_set.fail = True
+    with pytest.raises(ValueError):
+        asyncio.run(query_adversaries(octi_pool(octi), context, ["APT1"], "summary"))
+
+
+def test_names_resolved_by_the_alias_index(monkeypatch, octi_pool, context):
+    advs = [adversary("is-28", "APT28", ["Fancy Bear"])]
+    idx = AliasIndex("http://opencti")
+    idx.build({"is-28": ("intrusion_set", "APT28", ["Fancy Bear"])})
+    idx.last_refresh = time.time()
+    monkeypatch.setattr(alias_index, "_index", idx)
+
+    octi = FakeOpenCTI(advs, {})
+    names = ["apt28", "Fancy Bears", "Nobody"]
+    results = asyncio.run(query_adversaries(octi_pool(octi), context, names, "summary"))
+    # Only the intrusion set is read, by its Id, and the name no adversary has isn't looked up
+    assert octi.intrusion_set.filters == ["id"]
+    assert octi.campaign.filters == []
+    assert "matched_name" not in results["apt28"]["result"][0]
+    fuzzy = results["Fancy Bears"]["result"][0]
+    assert (fuzzy["matched_name"], fuzzy["fuzzy"]) == ("Fancy Bear", True)
+    assert not results["Nobody"]["found"]
+
+    # A fresh query looks every name up by name, as without the index
+    octi = FakeOpenCTI(advs, {})
+    results = asyncio.run(
+        query_adversaries(octi_pool(octi), context, ["Nobody"], "summary", True)
+    )
+    assert octi.intrusion_set.filters == octi.campaign.filters == ["name"]
@@ -0,0 +1,122 @@
+import asyncio
+
+import pytest
+
+from pycti_mcp import alias_index
+from pycti_mcp.cache import get_negative_cache, get_response_cache
+from pycti_mcp.pycti_tools import lookup_adversary
+
+
+def adversary():
+    return {
+        "id": "is-1",
+        "standard_id": "intrusion-set--1",
+        "name": "APT1",
+        "aliases": [],
+        "entity_type": "Intrusion-Set",
+        "description": "",
+        "created_at": "2024-01-01T00:00:00Z",
+        "updated_at": "2024-01-01T00:00:00Z",
+        "objectLabel": [],
+        "first_seen": None,
+        "last_seen": None,
+        "externalReferences": [],
+    }
+
+
+class FakeAdversaries:
+    def __init__(self, octi, found):
+        self.octi = octi
+        self.found = found
+
+    def read(self, filters, customAttributes):
+        self.octi.requests.append("read")
+        return dict(self.found) if self.found else None
+
+
+class FakeContainers:
+    def __init__(self, octi):
+        self.octi = octi
+
+    def list(self, filters, customAttributes, **kwargs):
+        self.octi.requests.append("list")
+        return []
+
+
+class FakeOpenCTI:
+    """Stands in for pycti, with one intrusion set, in no containers. The combined adversary
+    query fails with the error given, if any."""
+
+    def __init__(self, error=None):
+        self.error = error
+        self.requests = []
+        for adv_type in lookup_adversary.adversary_types:
+            found = adversary() if adv_type == "intrusion_set" else None
+            setattr(self, adv_type, FakeAdversaries(self, found))
+        self.report = self.note = self.opinion = FakeContainers(self)
+
+    def query(self, query, variables):
+        self.requests.append("query")
+        if self.error is not None:
+            raise ValueError(self.error)
+        found = [adversary()] if "intrusionSets" in query else []
+        node = [{**a, "reports": [], "notes": [], "opinions": []} for a in found]
+        return {"data": {"adversary": {"edges": [{"node": a} for a in node]}}}
+
+    def process_multiple(self, data, with_pagination=False):
+        return [edge["node"] for edge in data["edges"]]
+
+
+@pytest.fixture(autouse=True)
+def combined(monkeypatch):
+    monkeypatch.setattr(lookup_adversary.OpenCTIConfig, "combined_query", True)
+    monkeypatch.setattr(lookup_adversary.OpenCTIConfig, "opencti_url", "http://x")
+    monkeypatch.setattr(alias_index, "_index", None)
+
+
+# Returns a function looking up APT1 with the given fake pycti client, with empty caches
+@pytest.fixture
+def lookup(monkeypatch, octi_pool, context):
+    def lookup(octi):
+        get_response_cache().clear()
+        get_negative_cache().clear()
+        monkeypatch.setattr(
+            lookup_adversary, "get_client_pool", lambda url, key: octi_pool(octi)
+        )
+        return asyncio.run(lookup_adversary.opencti_adversary_lookup("APT1", context))
+
+    return lookup
+
+
+def test_combined_query(lookup):
+    octi = FakeOpenCTI()
+    result = lookup(octi)
+    assert [ta["opencti_id"] for ta in result] == ["is-1"]
+    # One request for each adversary type, including its reports, notes, and opinions
+    assert octi.requests == ["query"] * len(lookup_adversary.adversary_types)
+
+
+def test_combined_query_fallback(lookup, context):
+    types = len(lookup_adversary.adversary_types)
+
+    # A platform which doesn't know the combined query is read with the separate requests,
+    # from then on
+    octi = FakeOpenCTI("GRAPHQL_VALIDATION_FAILED: Unknown argument")
+    result = lookup(octi)
+    assert [ta["opencti_id"] for ta in result] == ["is-1"]
+    assert octi.requests[0] == "query" and octi.requests.count("read") == types
+    # The intrusion set found is then enriched with the three lists
+    assert octi.requests.count("list") == 3
+    assert context.warnings
+    assert not lookup_adversary.OpenCTIConfig.combined_query
+
+    octi = FakeOpenCTI()
+    assert lookup(octi) == result
+    assert "query" not in octi.requests
+
+
+def test_other_query_errors_only_fall_back_once(lookup):
+    octi = FakeOpenCTI("Timeout")
+    assert [ta["opencti_id"] for ta in lookup(octi)] == ["is-1"]
+    assert "read" in octi.requests
+    assert lookup_adversary.OpenCTIConfig.combined_query
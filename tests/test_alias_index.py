@@ -0,0 +1,105 @@
+import time
+
+from pycti_mcp import alias_index
+from pycti_mcp.alias_index import (
+    AliasIndex,
+    AliasIndexConfig,
+    match_fields,
+    normalize,
+    resolve_adversary,
+)
+
+
+def index():
+    idx = AliasIndex("http://opencti")
+    idx.build(
+        {
+            "is-28": ("intrusion_set", "APT28", ["Fancy Bear", "Sofacy"]),
+            "is-29": ("intrusion_set", "APT29", ["Cozy Bear"]),
+            "tag-28": ("threat_actor_group", "APT 28", []),
+            "cmp-1": ("campaign", "Operation Pawn Storm", ["Pawn Storm"]),
+        }
+    )
+    return idx
+
+
+def test_normalize():
+    assert normalize("APT 28") == normalize("apt-28") == normalize("APT28") == "apt28"
+    assert normalize("Équipe") == "equipe"
+    assert normalize("--") == ""
+
+
+def test_exact_names_and_aliases():
+    idx = index()
+    # The first adversary of each type with the name, with types in the tools' order
+    assert list(idx.resolve("apt_28").items()) == [
+        ("intrusion_set", ("is-28", "APT28", "APT28")),
+        ("threat_actor_group", ("tag-28", "APT 28", "APT 28")),
+    ]
+    assert idx.resolve("cozy bear") == {
+        "intrusion_set": ("is-29", "APT29", "Cozy Bear")
+    }
+    assert idx.resolve("PAWN-STORM") == {
+        "campaign": ("cmp-1", "Operation Pawn Storm", "Pawn Storm")
+    }
+
+
+def test_fuzzy_names():
+    idx = index()
+    assert idx.resolve("Fancy Bears") == {
+        "intrusion_set": ("is-28", "APT28", "Fancy Bear")
+    }
+    assert idx.resolve("Sofacyy") == {"intrusion_set": ("is-28", "APT28", "Sofacy")}
+    # Names with other digits are other adversaries, however similar
+    assert idx.resolve("APT 27") == {}
+    assert idx.resolve("Something else entirely") == {}
+    # Names which can't be normalized are left to OpenCTI
+    assert idx.resolve("???") is None
+    assert idx.stats()["fuzzy"] == 2
+    assert idx.stats()["unknown"] == 2
+
+
+def test_snapshot(tmp_path):
+    path = tmp_path / "aliases.json"
+    index().save(path)
+
+    loaded = AliasIndex("http://opencti")
+    assert loaded.load(path)
+    assert loaded.resolve("Cozy Bear") == {
+        "intrusion_set": ("is-29", "APT29", "Cozy Bear")
+    }
+    assert not AliasIndex("http://elsewhere").load(path)
+
+
+def test_match_fields():
+    # Names which are an adversary's name or alias, but for case, get no extra fields
+    assert match_fields("cozy bear", "Cozy Bear") == {}
+    assert match_fields("APT-28", "APT28") == {"matched_name": "APT28", "fuzzy": False}
+    assert match_fields("Fancy Bears", "Fancy Bear") == {
+        "matched_name": "Fancy Bear",
+        "fuzzy": True,
+    }
+
+
+def test_only_current_indexes_resolve_names(monkeypatch, tmp_path):
+    idx = index()
+    monkeypatch.setattr(alias_index, "_index", idx)
+    # Never refreshed, as when loaded from a snapshot saved before any refresh
+    assert resolve_adversary("Cozy Bear") is None
+
+    idx.last_refresh = time.time()
+    assert resolve_adversary("Cozy Bear") == {
+        "intrusion_set": ("is-29", "APT29", "Cozy Bear")
+    }
+    assert resolve_adversary("Nobody at all") == {}
+    # A fresh query is looked up in OpenCTI, even for names no adversary has
+    assert resolve_adversary("Nobody at all", bypass=True) is None
+
+    # An index whose refreshes have been failing is no longer trusted, nor is a snapshot of it
+    idx.last_refresh = time.time() - 2 * AliasIndexConfig.refresh_interval - 1
+    assert resolve_adversary("Cozy Bear") is None
+    path = tmp_path / "aliases.json"
+    idx.save(path)
+    loaded = AliasIndex("http://opencti")
+    loaded.load(path)
+    assert loaded.ready() and not loaded.current()
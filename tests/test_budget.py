@@ -0,0 +1,93 @@
+from pycti_mcp.budget import Budget, encoded_size, fit_list
+
+
+def report(i, objects):
+    return {
+        "name": f"Report {i}",
+        "external_urls": [f"https://example.com/{i}"],
+        "objects": [{"name": f"Object {i}-{j}"} for j in range(objects)],
+    }
+
+
+def test_unlimited_returns_everything():
+    reports = [report(i, 100) for i in range(10)]
+    fitted, truncated = fit_list(reports, len(reports), 0, "reports", ["objects"])
+    assert fitted == reports
+    assert not truncated
+
+
+def test_items_fit_before_their_lists():
+    reports = [report(i, 100) for i in range(3)]
+    budget = Budget(600)
+    fitted = budget.fit_items(reports, ["external_urls", "objects"])
+
+    # Every report is kept, ahead of any of their objects
+    assert [r["name"] for r in fitted] == ["Report 0", "Report 1", "Report 2"]
+    assert all(len(r["external_urls"]) == 1 for r in fitted)
+    for r in fitted:
+        assert len(r["objects"]) + r["truncated"]["objects"] == 100
+    assert budget.truncated
+    assert budget.used <= 600
+
+    # The originals are left untouched
+    assert all(len(r["objects"]) == 100 for r in reports)
+
+
+def test_items_left_out_are_counted():
+    reports = [report(i, 0) for i in range(100)]
+    limit = 10 * encoded_size(reports[0])
+    fitted, truncated = fit_list(iter(reports), len(reports), limit, "reports")
+    assert truncated
+    assert len(fitted) == 11
+    assert fitted[-1] == {"truncated": {"reports": 90}}
+
+
+def test_items_are_parsed_lazily():
+    parsed = []
+
+    def parse():
+        for i in range(100):
+            parsed.append(i)
+            yield report(i, 0)
+
+    Budget(200).fit_items(parse())
+    assert len(parsed) < 10
+
+
+def test_first_item_always_kept():
+    big = {"name": "x" * 1000, "objects": [{"name": "y"}]}
+    fitted = Budget(10).fit(big, ["objects"])
+    assert fitted["name"] == big["name"]
+    assert fitted["objects"] == []
+    assert fitted["truncated"] == {"objects": 1}
+
+
+def test_lists_within_entries():
+    entries = [
+        {"observable": str(i), "found": True, "result": report(i, 50)} for i in range(3)
+    ]
+    entries.append({"observable": "missing", "found": False, "result": None})
+    fitted, truncated = fit_list(
+        entries, len(entries), 500, "observables", ["objects"], within="result"
+    )
+    assert truncated
+    assert [e["observable"] for e in fitted] == ["0", "1", "2", "missing"]
+    assert "truncated" in fitted[0]["result"]
+    assert "truncated" not in fitted[0]
+
+
+def test_lists_within_lists_of_entries():
+    entries = [
+        {"name": str(i), "found": True, "result": [report(i, 50), report(i + 10, 50)]}
+        for i in range(3)
+    ]
+    fitted, truncated = fit_list(
+        entries, len(entries), 800, "names", ["objects"], within="result"
+    )
+    assert truncated
+    assert [e["name"] for e in fitted] == ["0", "1", "2"]
+    assert all(len(e["result"]) == 2 for e in fitted)
+    for e in fitted:
+        for r in e["result"]:
+            assert len(r["objects"]) + r["truncated"]["objects"] == 50
+    assert all(len(r["objects"]) == 50 for e in entries for r in e["result"])
@@ -0,0 +1,129 @@
+import asyncio
+
+import pytest
+
+from pycti_mcp import cache
+from pycti_mcp.cache import (
+    CacheConfig,
+    ResponseCache,
+    cache_lookup,
+    cache_store,
+    forget_misses,
+    get_negative_cache,
+    get_response_cache,
+    make_key,
+)
+
+
+class Clock:
+    """Stands in for time.monotonic(), moved on by the test"""
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(cache.time, "monotonic", clock)
+    return clock
+
+
+@pytest.fixture(autouse=True)
+def empty_caches():
+    get_response_cache().clear()
+    get_negative_cache().clear()
+
+
+def test_entries_expire(clock):
+    c = ResponseCache()
+    c.put("a", {"x": 1}, 10)
+    c.put("b", {"x": 2}, 0)
+    assert c.get("a") == (True, {"x": 1})
+    assert c.get("b") == (False, None)
+
+    clock.now += 10
+    assert c.get("a") == (False, None)
+    assert c.stats()["expirations"] == 1 and len(c) == 0
+
+
+def test_least_recently_used_entries_are_evicted():
+    c = ResponseCache(max_entries=2)
+    c.put("a", 1, 60)
+    c.put("b", 2, 60)
+    c.get("a")
+    c.put("c", 3, 60)
+    assert c.keys() == ["a", "c"]
+    assert c.stats()["evictions"] == 1
+
+    # The size bound evicts as many entries as it takes, and values too large are not cached
+    c = ResponseCache(max_bytes=40)
+    c.put("a", "x" * 10, 60)
+    c.put("b", "x" * 10, 60)
+    c.put("c", "x" * 25, 60)
+    assert c.keys() == ["c"]
+    c.put("d", "x" * 50, 60)
+    assert c.get("d") == (False, None) and c.keys() == ["c"]
+
+
+def test_keys():
+    # Keys of dict arguments don't depend on the order the dict was built in, but lists do
+    assert make_key("t", {"a": 1, "b": 2}) == make_key("t", {"b": 2, "a": 1})
+    assert make_key("t", ["a", "b"]) != make_key("t", ["b", "a"])
+    assert make_key("t", "a", None) != make_key("t", "a")
+    assert make_key("t", "a") != make_key("u", "a")
+
+
+# Returns a function looking up a cached response, as the tools do
+@pytest.fixture
+def lookup(context):
+    def lookup(key, bypass=False, miss_key=None):
+        return asyncio.run(cache_lookup(context, key, bypass, miss_key))
+
+    return lookup
+
+
+def test_misses_are_cached_apart(monkeypatch, lookup):
+    tool = "opencti_observable_lookup"
+    key, miss_key = make_key(tool, "a", "full"), make_key(tool, "a")
+
+    # A miss is found by its miss key, whatever the level of detail
+    cache_store(tool, key, None, miss_key)
+    assert lookup(make_key(tool, "a", "summary"), miss_key=miss_key) == (True, None)
+    assert get_response_cache().stats()["entries"] == 0
+    assert lookup(key, bypass=True, miss_key=miss_key) == (False, None)
+
+    # Once found, the miss is forgotten
+    cache_store(tool, key, {"found": "a"}, miss_key)
+    assert lookup(key, miss_key=miss_key) == (True, {"found": "a"})
+    assert len(get_negative_cache()) == 0
+
+    # Other tools' empty results are cached as usual
+    cache_store("opencti_reports_lookup", "r", [])
+    assert lookup("r") == (True, [])
+    assert len(get_negative_cache()) == 0
+
+    # Nothing is cached once caching is disabled
+    monkeypatch.setattr(CacheConfig, "enabled", False)
+    cache_store(tool, key, {"found": "a"}, miss_key)
+    assert lookup(key, miss_key=miss_key) == (False, None)
+
+
+def test_forget_misses():
+    tools = CacheConfig.negative_tools
+    for term in ["a", "b", "c"]:
+        cache_store(tools[0], make_key(tools[0], term, "standard"), None)
+        cache_store(tools[0], make_key(tools[0], term), None)
+
+    # Either with fewer terms than misses, or more
+    forget_misses("a", None)
+    forget_misses(*[f"x{n}" for n in range(100)], "b")
+    keys = get_negative_cache().keys()
+    assert make_key(tools[0], "a") not in keys
+    assert make_key(tools[0], "b") not in keys
+    assert make_key(tools[0], "c") in keys
+    # The misses cached with their level of detail are left for their TTL
+    assert make_key(tools[0], "b", "standard") in keys
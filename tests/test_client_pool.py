@@ -0,0 +1,83 @@
+import threading
+
+import pytest
+
+from pycti_mcp.client_pool import OpenCTIClientPool
+
+
+class FakeSession:
+    def close(self):
+        pass
+
+
+class FakeClient:
+    def __init__(self, n):
+        self.n = n
+        self.session = FakeSession()
+
+
+class FakePool(OpenCTIClientPool):
+    """A client pool building fake clients, numbered in the order they are built, or failing to
+    build them while failing is set"""
+
+    def __init__(self, pool_size):
+        super().__init__("http://opencti", "key", pool_size, health_check=False)
+        self.built = 0
+        self.failing = False
+
+    def _new_client(self):
+        if self.failing:
+            raise ConnectionError("OpenCTI is down")
+        self.built += 1
+        return FakeClient(self.built)
+
+
+def acquire_in_thread(pool):
+    acquired = []
+    thread = threading.Thread(target=lambda: acquired.append(pool.acquire()))
+    thread.start()
+    return thread, acquired
+
+
+def test_clients_are_reused_and_bounded():
+    pool = FakePool(2)
+    first, second = pool.acquire(), pool.acquire()
+    thread, acquired = acquire_in_thread(pool)
+    thread.join(0.05)
+    assert not acquired
+
+    # A caller waiting at capacity gets the next client handed back
+    pool.release(second)
+    thread.join(1)
+    assert acquired == [second]
+    pool.release(first)
+    assert pool.acquire() is first
+    assert pool.built == 2
+
+
+def test_discarded_clients_free_their_slot():
+    pool = FakePool(1)
+    octi = pool.acquire()
+    thread, acquired = acquire_in_thread(pool)
+    thread.join(0.05)
+    assert not acquired
+
+    # The caller waiting for a client gets a fresh one in the discarded client's slot
+    pool.discard(octi)
+    thread.join(1)
+    assert acquired[0].n == 2
+    assert pool.stats()["clients_created"] == 1
+
+
+def test_failed_clients_free_their_slot():
+    pool = FakePool(1)
+    pool.failing = True
+    with pytest.raises(ConnectionError):
+        pool.acquire()
+
+    pool.failing = False
+    octi = pool.acquire()
+    assert octi.n == 1
+    pool.release(octi)
+    assert pool.stats()["clients_idle"] == 1
+    assert pool.acquire() is octi
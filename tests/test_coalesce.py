@@ -0,0 +1,162 @@
+import asyncio
+
+import pytest
+from fastmcp import Context
+
+from pycti_mcp.coalesce import SingleFlight, coalesce_tool, get_flights
+from pycti_mcp.metrics import current_tool, get_metrics
+
+
+class Upstream:
+    """Stands in for an upstream request, which completes (or fails) when released"""
+
+    def __init__(self):
+        self.calls = 0
+        self.cancelled = 0
+        self.release = asyncio.Event()
+        self.error = None
+
+    async def call(self, value="result"):
+        self.calls += 1
+        try:
+            await self.release.wait()
+        except asyncio.CancelledError:
+            self.cancelled += 1
+            raise
+        if self.error is not None:
+            raise self.error
+        return value
+
+
+def test_concurrent_calls_share_one_call():
+    async def run():
+        flights = SingleFlight()
+        upstream = Upstream()
+        joined = []
+        calls = [
+            asyncio.create_task(
+                flights.run("a", upstream.call, on_join=lambda: joined.append(1))
+            )
+            for _ in range(5)
+        ]
+        other = asyncio.create_task(flights.run("b", upstream.call))
+        await asyncio.sleep(0)
+        upstream.release.set()
+        assert await asyncio.gather(*calls, other) == ["result"] * 6
+        assert upstream.calls == 2
+        assert len(joined) == 4
+        assert flights.in_flight() == 0
+
+    asyncio.run(run())
+
+
+def test_errors_reach_every_caller():
+    async def run():
+        flights = SingleFlight()
+        upstream = Upstream()
+        upstream.error = RuntimeError("upstream failed")
+        calls = [asyncio.create_task(flights.run("a", upstream.call)) for _ in range(3)]
+        await asyncio.sleep(0)
+        upstream.release.set()
+        results = await asyncio.gather(*calls, return_exceptions=True)
+        assert all(isinstance(r, RuntimeError) for r in results)
+        assert upstream.calls == 1
+
+        # A failed call isn't remembered: the next caller tries again
+        upstream.error = None
+        assert await flights.run("a", upstream.call) == "result"
+        assert upstream.calls == 2
+
+    asyncio.run(run())
+
+
+def test_cancellation():
+    async def run():
+        flights = SingleFlight()
+        upstream = Upstream()
+        first = asyncio.create_task(flights.run("a", upstream.call))
+        second = asyncio.create_task(flights.run("a", upstream.call))
+        await asyncio.sleep(0)
+
+        # Cancelling the caller which started the call leaves it running for the other
+        first.cancel()
+        await asyncio.sleep(0)
+        assert upstream.cancelled == 0
+        upstream.release.set()
+        assert await second == "result"
+        with pytest.raises(asyncio.CancelledError):
+            await first
+
+        # Once every caller has been cancelled, so is the call
+        upstream.release.clear()
+        callers = [
+            asyncio.create_task(flights.run("b", upstream.call)) for _ in range(2)
+        ]
+        await asyncio.sleep(0)
+        for c in callers:
+            c.cancel()
+        await asyncio.gather(*callers, return_exceptions=True)
+        await asyncio.sleep(0)
+        assert upstream.cancelled == 1
+        assert flights.in_flight() == 0
+
+    asyncio.run(run())
+
+
+def test_coalesce_tool():
+    upstream = Upstream()
+
+    async def example_tool(
+        name: str, ctx: Context, detail: str = "standard"
+    ) -> str | None:
+        return await upstream.call(f"{name}/{detail}")
+
+    tool = coalesce_tool(example_tool)
+
+    async def run():
+        current_tool.set("example_tool")
+        calls = [
+            # Given or defaulted, the same arguments are coalesced, whatever the context
+            tool("APT1", "ctx-1"),
+            tool("APT1", "ctx-2", detail="standard"),
+            tool(name="APT1", ctx="ctx-3"),
+            tool("APT1", "ctx-1", detail="full"),
+        ]
+        tasks = [asyncio.create_task(c) for c in calls]
+        await asyncio.sleep(0)
+        upstream.release.set()
+        return await asyncio.gather(*tasks)
+
+    results = asyncio.run(run())
+    assert results == ["APT1/standard"] * 3 + ["APT1/full"]
+    assert upstream.calls == 2
+    assert get_metrics().stats()["example_tool"]["coalesced"] == 2
+    assert get_flights().in_flight() == 0
+
+
+def test_logging_failures_dont_fail_shared_calls():
+    upstream = Upstream()
+
+    class GoneContext:
+        """The context of a caller whose session has closed"""
+
+        async def info(self, message):
+            raise RuntimeError("Session closed")
+
+    async def example_tool(name: str, ctx: Context) -> str | None:
+        await ctx.info(f"Looking up {name}")
+        result = await upstream.call(name)
+        await ctx.info(f"Found {result}")
+        return result
+
+    tool = coalesce_tool(example_tool)
+
+    async def run():
+        calls = [tool("APT1", GoneContext()), tool("APT1", "ctx-2")]
+        tasks = [asyncio.create_task(c) for c in calls]
+        await asyncio.sleep(0)
+        upstream.release.set()
+        return await asyncio.gather(*tasks)
+
+    assert asyncio.run(run()) == ["APT1", "APT1"]
+    assert upstream.calls == 1
@@ -0,0 +1,53 @@
+import pytest
+from pydantic_core import to_json
+
+from pycti_mcp import encoding
+from pycti_mcp.cache import forget_misses, get_negative_cache, make_key
+
+encoders = ["json"] + ([] if encoding.orjson is None else ["orjson"])
+
+report = {
+    "name": "Threat report",
+    "labels": ["stub"],
+    "confidence": 75,
+    "objects": [
+        {"entity_type": "Malware", "name": "Evil", "pattern": None},
+        {"entity_type": "IPv4-Addr", "observable_value": "10.0.0.1"},
+    ],
+}
+
+
+@pytest.fixture(params=encoders)
+def encoder(request):
+    previous = encoding.encoder
+    encoding.use_encoder(request.param)
+    yield request.param
+    encoding.use_encoder(previous)
+
+
+def test_encoded_as_fastmcp_encodes_responses(encoder):
+    assert encoding.dumps(report) == to_json(report)
+    assert encoding.encoded_size(report) == len(to_json(report))
+    assert encoding.loads(encoding.dumps(report)) == report
+
+
+def test_unencodable_values_are_strings(encoder):
+    assert encoding.loads(encoding.dumps({"set": {1}})) == {"set": "{1}"}
+
+
+@pytest.mark.parametrize("misses", [1, 100])
+def test_forget_misses(misses):
+    negative_cache = get_negative_cache()
+    negative_cache.clear()
+    for n in range(misses):
+        negative_cache.put(make_key("opencti_observable_lookup", f"v{n}"), None, 60)
+    negative_cache.put(make_key("opencti_indicator_lookup", ["v0"], []), None, 60)
+
+    # Whether there are more misses cached than terms given, or fewer, only the misses for the
+    # terms are forgotten
+    forget_misses(*[f"v{n}" for n in range(0, 50, 2)], None)
+    assert len(negative_cache) == misses - min(misses, 25) + 1
+    assert not negative_cache.get(make_key("opencti_observable_lookup", "v0"))[0]
+    if misses > 1:
+        assert negative_cache.get(make_key("opencti_observable_lookup", "v1"))[0]
+    assert negative_cache.get(make_key("opencti_indicator_lookup", ["v0"], []))[0]
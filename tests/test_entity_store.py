@@ -0,0 +1,102 @@
+import asyncio
+
+import pytest
+
+from pycti_mcp.entity_store import (
+    EntityStore,
+    EntityStoreConfig,
+    get_entity_store,
+    stored_entity,
+)
+
+
+def observable(updated="2024-06-01T00:00:00Z", **fields):
+    return {
+        "opencti_id": "obs-1",
+        "stix_id": "ipv4-addr--1",
+        "last_updated": updated,
+        **fields,
+    }
+
+
+class FakePool:
+    """Stands in for the client pool, answering the updated_at checks"""
+
+    def __init__(self, updated):
+        self.updated = updated
+        self.checks = 0
+
+    async def run(self, fn, kind, opencti_id):
+        self.checks += 1
+        return self.updated
+
+
+@pytest.fixture(autouse=True)
+def empty_store():
+    get_entity_store().clear()
+
+
+def lookup(pool, id_, profile):
+    return asyncio.run(stored_entity(pool, "observable", id_, profile))
+
+
+def test_found_by_either_id_with_enough_fields():
+    store = EntityStore()
+    store.put("observable", observable(labels=["a"]))
+    assert store.get("observable", "obs-1", ["labels"]) is not None
+    assert store.get("observable", "ipv4-addr--1", ["labels"]) is not None
+    assert store.get("observable", "obs-1", ["notes"]) is None
+    assert store.get("indicator", "obs-1", ["labels"]) is None
+
+    # Fields parsed from the same version are merged, an older version is ignored, and a newer
+    # version replaces them
+    store.put("observable", observable(notes=["n"]))
+    assert store.get("observable", "obs-1", ["labels", "notes"]) is not None
+    store.put("observable", observable("2024-01-01T00:00:00Z", labels=["old"]))
+    assert store.get("observable", "obs-1", ["labels"]).fields["labels"] == ["a"]
+    store.put("observable", observable("2024-07-01T00:00:00Z", labels=["b"]))
+    assert store.get("observable", "obs-1", ["notes"]) is None
+
+
+def test_bounded():
+    store = EntityStore(max_entries=2)
+    for n in range(3):
+        store.put("observable", {**observable(), "opencti_id": f"obs-{n}"})
+    assert store.get("observable", "obs-0", []) is None
+    assert store.stats()["entries"] == 2
+    assert store.stats()["evictions"] == 1
+
+
+def test_checked_for_updates(monkeypatch):
+    get_entity_store().put("observable", observable(labels=["a"]))
+    pool = FakePool("2024-06-01T00:00:00Z")
+    assert lookup(pool, "ipv4-addr--1", ["labels"]) == {"labels": ["a"]}
+    assert pool.checks == 0
+
+    # Once it has been stored a while, it is only returned if it hasn't been updated since
+    monkeypatch.setattr(EntityStoreConfig, "check_after", -1)
+    assert lookup(pool, "obs-1", ["labels"]) == {"labels": ["a"]}
+    assert pool.checks == 1
+    pool.updated = "2024-07-01T00:00:00Z"
+    assert lookup(pool, "obs-1", ["labels"]) is None
+    assert get_entity_store().get("observable", "obs-1", []) is None
+
+
+def test_container_lists_age_out(monkeypatch):
+    store = EntityStore()
+    store.put("observable", observable(labels=["a"], notes=["n"]))
+    assert store.get("observable", "obs-1", ["notes"]) is not None
+
+    # Unchanged entities are still returned, but not the containers they were in back then
+    monkeypatch.setattr(EntityStoreConfig, "max_age", -1)
+    assert store.get("observable", "obs-1", ["labels"]) is not None
+    assert store.get("observable", "obs-1", ["labels", "notes"]) is None
+
+    # The lists are as old as the oldest response they are from
+    monkeypatch.setattr(EntityStoreConfig, "max_age", 300)
+    stored = store.get("observable", "obs-1", [])
+    stored.fetched -= 600
+    store.put("observable", observable(labels=["a"]))
+    assert store.get("observable", "obs-1", ["notes"]) is None
+    store.put("observable", observable(notes=["m"]))
+    assert store.get("observable", "obs-1", ["notes"]).fields["notes"] == ["m"]
@@ -0,0 +1,74 @@
+import asyncio
+import threading
+
+import pytest
+
+from pycti_mcp import executor
+from pycti_mcp.executor import ExecutorConfig, UpstreamBusyError, run_blocking
+from pycti_mcp.metrics import current_tool
+
+
+@pytest.fixture(autouse=True)
+def small_executor(monkeypatch):
+    # One worker thread, and one call allowed to wait for it
+    monkeypatch.setattr(ExecutorConfig, "max_workers", 1)
+    monkeypatch.setattr(ExecutorConfig, "queue_depth", 1)
+    executor.shutdown()
+    yield
+    executor.shutdown()
+
+
+async def until(condition):
+    for _ in range(100):
+        if condition():
+            return
+        await asyncio.sleep(0.01)
+    raise AssertionError("Timed out")
+
+
+def test_calls_beyond_the_queue_are_refused():
+    release = threading.Event()
+
+    def blocking(value):
+        release.wait()
+        return value, current_tool.get()
+
+    async def run():
+        current_tool.set("example_tool")
+        calls = [asyncio.create_task(run_blocking(blocking, n)) for n in range(2)]
+        await asyncio.sleep(0)
+        with pytest.raises(UpstreamBusyError):
+            await run_blocking(blocking, 2)
+        release.set()
+        return await asyncio.gather(*calls)
+
+    # The calls run with the caller's context
+    assert asyncio.run(run()) == [(0, "example_tool"), (1, "example_tool")]
+
+
+def test_cancelled_calls_hold_their_slot_until_done():
+    release = threading.Event()
+    running = threading.Event()
+
+    def blocking():
+        running.set()
+        release.wait()
+
+    async def run():
+        running_call = asyncio.create_task(run_blocking(blocking))
+        await until(running.is_set)
+        waiting_call = asyncio.create_task(run_blocking(lambda: "waited"))
+        await asyncio.sleep(0)
+        running_call.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await running_call
+
+        # Its thread is still running, so there is no room for another call
+        with pytest.raises(UpstreamBusyError):
+            await run_blocking(lambda: None)
+        release.set()
+        assert await waiting_call == "waited"
+        await until(lambda: executor._slots._value == 2)
+        assert await run_blocking(lambda: "done") == "done"
+
+    asyncio.run(run())
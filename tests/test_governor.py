@@ -0,0 +1,164 @@
+import asyncio
+
+import pytest
+import requests
+
+from pycti_mcp.executor import UpstreamBusyError
+from pycti_mcp.governor import (
+    AIMDLimiter,
+    CircuitOpenError,
+    Governor,
+    GovernorConfig,
+    UpstreamOverloadedError,
+)
+
+
+@pytest.fixture(autouse=True)
+def no_retry_delay(monkeypatch):
+    monkeypatch.setattr(GovernorConfig, "retry_base_delay", 0)
+
+
+class Upstream:
+    """Stands in for OpenCTI, failing with each of the given errors in turn, then succeeding"""
+
+    def __init__(self, *errors):
+        self.errors = list(errors)
+        self.calls = 0
+
+    async def request(self):
+        self.calls += 1
+        if self.errors:
+            raise self.errors.pop(0)
+        return "result"
+
+
+def test_limiter_aimd():
+    async def run():
+        limiter = AIMDLimiter(8, 100)
+
+        # Normal latency keeps the limit where it is
+        for _ in range(20):
+            await limiter.acquire()
+            limiter.release(0.1)
+        assert limiter.limit == 8
+
+        # Requests failing from overload halve it, once per round trip
+        for _ in range(3):
+            await limiter.acquire()
+            limiter.release(0.1, overloaded=True)
+        assert limiter.limit == 4
+
+        # Then it grows by about one per limit's worth of requests
+        for _ in range(10):
+            await limiter.acquire()
+            limiter.release(0.1)
+        assert 5 < limiter.limit < 7
+
+        # Latency well above the usual halves it too
+        limiter.last_decrease = 0
+        for _ in range(5):
+            await limiter.acquire()
+            limiter.release(1.0)
+        assert limiter.limit < 4
+
+    asyncio.run(run())
+
+
+def test_limiter_caps_in_flight():
+    async def run():
+        limiter = AIMDLimiter(2, 1)
+        await limiter.acquire()
+        await limiter.acquire()
+        waiting = asyncio.create_task(limiter.acquire())
+        await asyncio.sleep(0)
+        assert not waiting.done()
+
+        # Beyond max_waiting, callers are turned away
+        with pytest.raises(UpstreamBusyError):
+            await limiter.acquire()
+
+        limiter.release(0.01)
+        await waiting
+        assert limiter.in_flight == 2
+
+        # A cancelled waiter gives up its place
+        cancelled = asyncio.create_task(limiter.acquire())
+        await asyncio.sleep(0)
+        cancelled.cancel()
+        await asyncio.gather(cancelled, return_exceptions=True)
+        assert not limiter.waiters
+
+    asyncio.run(run())
+
+
+def test_cancelled_callers_hold_their_slot_until_the_request_is_done():
+    async def run():
+        governor = Governor(1, 10)
+        done = asyncio.Event()
+
+        async def request():
+            # Stands in for a request still running in its thread
+            await done.wait()
+            raise requests.ConnectionError("Connection reset")
+
+        caller = asyncio.create_task(governor.run(request))
+        await asyncio.sleep(0)
+        caller.cancel()
+        await asyncio.gather(caller, return_exceptions=True)
+        assert governor.limiter.in_flight == 1
+
+        done.set()
+        await asyncio.sleep(0)
+        await asyncio.sleep(0)
+        assert governor.limiter.in_flight == 0
+
+    asyncio.run(run())
+
+
+def test_retries():
+    governor = Governor(4, 10)
+    upstream = Upstream(
+        requests.exceptions.ConnectionError(), UpstreamOverloadedError(503)
+    )
+    assert asyncio.run(governor.run(upstream.request)) == "result"
+    assert upstream.calls == 3
+    assert governor.retries == 2
+
+    # Errors which would just happen again aren't retried
+    upstream = Upstream(ValueError("GRAPHQL_VALIDATION_FAILED"))
+    with pytest.raises(ValueError):
+        asyncio.run(governor.run(upstream.request))
+    assert upstream.calls == 1
+
+    # Nor are reads which keep failing retried forever
+    upstream = Upstream(*[requests.exceptions.Timeout()] * 5)
+    with pytest.raises(requests.exceptions.Timeout):
+        asyncio.run(governor.run(upstream.request))
+    assert upstream.calls == GovernorConfig.retries + 1
+    assert governor.limiter.in_flight == 0
+
+
+def test_circuit_breaker(monkeypatch):
+    monkeypatch.setattr(GovernorConfig, "retries", 0)
+    governor = Governor(4, 10)
+
+    async def fail_many():
+        for _ in range(GovernorConfig.breaker_min_requests):
+            with pytest.raises(UpstreamOverloadedError):
+                await governor.run(Upstream(UpstreamOverloadedError(502)).request)
+
+    asyncio.run(fail_many())
+    assert governor.breaker.state == "open"
+
+    # While open, requests fail at once, without reaching OpenCTI
+    upstream = Upstream()
+    with pytest.raises(CircuitOpenError):
+        asyncio.run(governor.run(upstream.request))
+    assert upstream.calls == 0
+
+    # After the cooldown, a successful trial request closes it again
+    governor.breaker.opened_at -= GovernorConfig.breaker_cooldown
+    assert governor.breaker.state == "half_open"
+    assert asyncio.run(governor.run(upstream.request)) == "result"
+    assert governor.breaker.state == "closed"
+    assert asyncio.run(governor.run(upstream.request)) == "result"
@@ -0,0 +1,173 @@
+import asyncio
+import os
+import time
+
+import pytest
+
+from pycti_mcp import membership
+from pycti_mcp.membership import (
+    MembershipConfig,
+    ObservableMembership,
+    get_membership,
+    might_exist,
+    run_membership_refresh,
+)
+from pycti_mcp.pycti_tools import lookup_observables, lookup_observables_bulk
+from pycti_mcp.workers import WorkersConfig
+
+
+def page(*values):
+    return {
+        "entities": [
+            {
+                "observable_value": v,
+                "id": f"id-{v}",
+                "standard_id": f"std-{v}",
+                "updated_at": "2024-06-01T00:00:00Z",
+            }
+            for v in values
+        ],
+        "pagination": {"hasNextPage": False, "globalCount": len(values)},
+    }
+
+
+class FakePool:
+    """Stands in for the client pool, answering each request with the page given, once it is
+    allowed to by the test"""
+
+    def __init__(self, answer):
+        self.answer = answer
+        self.requests = 0
+        self.allowed = asyncio.Event()
+
+    async def run(self, fn, *args):
+        self.requests += 1
+        await self.allowed.wait()
+        return self.answer
+
+
+@pytest.fixture(autouse=True)
+def no_membership(monkeypatch):
+    monkeypatch.setattr(membership, "_membership", None)
+    monkeypatch.setattr(WorkersConfig, "reload_interval", 0.01)
+
+
+def snapshot(tmp_path, *values):
+    path = tmp_path / "membership"
+    saved = ObservableMembership("http://opencti")
+    asyncio.run(saved.refresh(allowed_pool(page(*values))))
+    saved.save(path)
+    return path
+
+
+def allowed_pool(answer):
+    pool = FakePool(answer)
+    pool.allowed.set()
+    return pool
+
+
+async def until(condition):
+    for _ in range(100):
+        if condition():
+            return
+        await asyncio.sleep(0.01)
+    raise AssertionError("Timed out")
+
+
+def test_snapshot_is_used_once_caught_up(tmp_path, monkeypatch):
+    monkeypatch.setattr(MembershipConfig, "snapshot_path", str(snapshot(tmp_path, "a")))
+    pool = FakePool(page("b"))
+    monkeypatch.setattr(membership, "get_client_pool", lambda url, key: pool)
+
+    async def run():
+        task = asyncio.create_task(run_membership_refresh("http://opencti", "key"))
+        try:
+            # The snapshot is loaded, but lookups don't use it while it is catching up
+            await until(lambda: pool.requests)
+            assert get_membership() is None
+            pool.allowed.set()
+            await until(get_membership)
+            filter_ = get_membership()
+            assert filter_.might_exist("a") and filter_.might_exist("b")
+            assert not filter_.might_exist("c")
+        finally:
+            task.cancel()
+
+    asyncio.run(run())
+
+
+def test_filters_no_longer_refreshed_are_dropped(monkeypatch):
+    pool = allowed_pool(page("a"))
+    monkeypatch.setattr(membership, "get_client_pool", lambda url, key: pool)
+
+    async def run():
+        task = asyncio.create_task(run_membership_refresh("http://opencti", "key"))
+        try:
+            await until(get_membership)
+            assert not might_exist("c")
+            # The refreshes have been failing, since OpenCTI stopped answering
+            get_membership().last_refresh -= 2 * MembershipConfig.refresh_interval
+            assert might_exist("c")
+        finally:
+            task.cancel()
+
+    asyncio.run(run())
+
+
+def test_followers_only_use_current_snapshots(tmp_path, monkeypatch):
+    path = snapshot(tmp_path, "a")
+    monkeypatch.setattr(MembershipConfig, "snapshot_path", str(path))
+    long_ago = time.time() - 3 * MembershipConfig.refresh_interval
+    os.utime(path, (long_ago, long_ago))
+
+    async def run():
+        task = asyncio.create_task(
+            run_membership_refresh("http://opencti", "key", follower=True)
+        )
+        try:
+            await asyncio.sleep(0.05)
+            assert get_membership() is None
+            # Once the worker refreshing the filter saves it again, it is used
+            os.utime(path)
+            await until(get_membership)
+            assert not get_membership().might_exist("c")
+        finally:
+            task.cancel()
+
+    asyncio.run(run())
+
+
+def test_bypass_cache_skips_the_filter(monkeypatch, context):
+    filter_ = ObservableMembership("http://opencti")
+    asyncio.run(filter_.refresh(allowed_pool(page("a"))))
+    monkeypatch.setattr(membership, "_membership", filter_)
+    pool = allowed_pool(None)
+    for module in (lookup_observables, lookup_observables_bulk):
+        monkeypatch.setattr(module.OpenCTIConfig, "opencti_url", "http://opencti")
+        monkeypatch.setattr(module, "get_client_pool", lambda url, key: pool)
+
+    def lookup(bypass_cache):
+        asyncio.run(
+            lookup_observables.opencti_observable_lookup(
+                "10.0.0.1", context, bypass_cache=bypass_cache
+            )
+        )
+
+    def bulk_lookup(bypass_cache):
+        asyncio.run(
+            lookup_observables_bulk.opencti_observable_bulk_lookup(
+                ["10.0.0.1"], context, bypass_cache=bypass_cache
+            )
+        )
+
+    lookup(False)
+    bulk_lookup(False)
+    assert pool.requests == 0
+
+    # A fresh query asks OpenCTI, as the observable may be newer than the filter
+    pool.answer = []
+    bulk_lookup(True)
+    assert pool.requests == 1
+    pool.answer = None
+    lookup(True)
+    assert pool.requests == 2
@@ -0,0 +1,64 @@
+import asyncio
+
+from pycti_mcp.cache import get_negative_cache, get_response_cache
+from pycti_mcp.metrics import get_metrics, instrument_tool, record_error
+
+
+async def handles_errors(fail):
+    # Fans out to two requests that both fail, as the bulk lookups do
+    async def request():
+        record_error()
+
+    await asyncio.gather(request(), request())
+    if fail:
+        raise ValueError("Upstream failure")
+    return {}
+
+
+async def succeeds():
+    return {}
+
+
+def errors(fn, *args):
+    tool = instrument_tool(fn)
+    try:
+        asyncio.run(tool(*args))
+    except ValueError:
+        pass
+    return get_metrics().stats()[fn.__name__]
+
+
+def test_each_failed_call_is_one_error():
+    get_metrics()._tools.clear()
+    stats = errors(succeeds)
+    assert (stats["calls"], stats["errors"]) == (1, 0)
+
+    stats = errors(handles_errors, False)
+    assert (stats["calls"], stats["errors"]) == (1, 1)
+
+    # A call that handles some errors and then raises is still just one failed call
+    stats = errors(handles_errors, True)
+    assert (stats["calls"], stats["errors"]) == (2, 2)
+
+
+def test_cache_stats_are_grouped_into_families():
+    get_response_cache().clear()
+    get_response_cache().put("a", {"x": 1}, 60)
+    get_negative_cache()
+    lines = get_metrics().render().splitlines()
+
+    # Each stat's header is followed by its samples for every cache, before the next family
+    start = lines.index(
+        "# HELP pycti_mcp_cache_hits Cache lookups which found an entry"
+    )
+    assert lines[start + 1] == "# TYPE pycti_mcp_cache_hits counter"
+    samples = [line.split(" ")[0] for line in lines[start + 2 : start + 5]]
+    assert samples == [
+        'pycti_mcp_cache_hits{cache="response"}',
+        'pycti_mcp_cache_hits{cache="negative"}',
+        'pycti_mcp_cache_hits{cache="entities"}',
+    ]
+    assert lines[start + 5].startswith("# HELP pycti_mcp_cache_misses")
+    assert [line for line in lines if "pycti_mcp_cache_entries{" in line][0] == (
+        'pycti_mcp_cache_entries{cache="response"} 1'
+    )
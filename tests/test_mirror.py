@@ -0,0 +1,235 @@
+import json
+import time
+
+from pycti_mcp.mirror import Mirror, MirrorConfig, opencti_extension, parse_sse
+
+
+def observable(n, **fields):
+    return {
+        "id": f"obs-{n}",
+        "standard_id": f"ipv4-addr--{n}",
+        "observable_value": f"10.0.0.{n}",
+        "updated_at": "2024-01-01T00:00:00Z",
+        **fields,
+    }
+
+
+def report(n, published, name):
+    return {
+        "id": f"rpt-{n}",
+        "standard_id": f"report--{n}",
+        "name": name,
+        "description": "",
+        "published": published,
+    }
+
+
+def stix(entity, stix_type, **fields):
+    return {
+        "id": entity["standard_id"],
+        "type": stix_type,
+        "extensions": {opencti_extension: {"id": entity["id"]}},
+        **fields,
+    }
+
+
+# A fake OpenCTI stream: the SSE lines for each (id, event, message) given
+def fake_stream(*events):
+    for event_id, event, message in events:
+        yield f"id: {event_id}"
+        yield f"event: {event}"
+        yield f"data: {json.dumps(message)}"
+        yield ""
+
+
+class FakeOpenCTI:
+    """Stands in for the entity reads the mirror makes for each event"""
+
+    def __init__(self):
+        self.entities = {}
+        self.reads = []
+
+    def fetch(self, kind, entity_id):
+        self.reads.append(entity_id)
+        return self.entities.get(entity_id)
+
+
+def follow(mirror, opencti, lines):
+    for event_id, event, payload in parse_sse(lines):
+        mirror.apply(event_id, event, payload, opencti.fetch)
+
+
+def loaded_mirror():
+    mirror = Mirror(None, "http://opencti")
+    mirror.set_meta(loaded=1, last_event_id="0-0", synced_at=time.time())
+    return mirror
+
+
+def test_parse_sse():
+    lines = [": comment", "id: 1-0", "event: create", "data: {}", "", "data: x", ""]
+    assert list(parse_sse(lines)) == [("1-0", "create", "{}"), ("1-0", "message", "x")]
+
+
+def test_find_by_any_term():
+    mirror = loaded_mirror()
+    mirror.upsert("observable", [observable(1), observable(2)])
+    mirror.upsert(
+        "intrusion_set",
+        [
+            {
+                "id": "is-1",
+                "standard_id": "intrusion-set--1",
+                "name": "APT1",
+                "aliases": ["Comment Crew"],
+            }
+        ],
+    )
+
+    assert [o["id"] for o in mirror.find("observable", ["10.0.0.1"])] == ["obs-1"]
+    found = mirror.find("observable", ["IPV4-ADDR--2", "obs-1", "10.0.0.1"])
+    assert sorted(o["id"] for o in found) == ["obs-1", "obs-2"]
+    assert mirror.find("intrusion_set", ["comment crew"])[0]["name"] == "APT1"
+    assert mirror.find("campaign", ["APT1"]) == []
+
+
+def test_search():
+    mirror = loaded_mirror()
+    mirror.upsert(
+        "indicator",
+        [
+            {
+                "id": "ind-1",
+                "name": "a",
+                "pattern": "rule evil_1 { }",
+                "pattern_type": "yara",
+            },
+            {
+                "id": "ind-2",
+                "name": "b",
+                "pattern": "[file:name = 'evil_2']",
+                "pattern_type": "stix",
+            },
+        ],
+    )
+    assert len(mirror.search_indicators(["EVIL"], [])) == 2
+    assert [i["id"] for i in mirror.search_indicators(["evil", "rule"], [])] == [
+        "ind-1"
+    ]
+    assert [i["id"] for i in mirror.search_indicators(["evil"], ["stix"])] == ["ind-2"]
+    # LIKE wildcards in the search strings are matched literally
+    assert mirror.search_indicators(["evil%2"], []) == []
+
+    mirror.upsert(
+        "report",
+        [report(n, f"2024-0{n}-01T00:00:00Z", f"Report {n}") for n in range(1, 6)],
+    )
+    page = mirror.search_reports("2024-02-01", None, None, 2, 0)
+    assert [r["id"] for r in page["entities"]] == ["rpt-5", "rpt-4"]
+    assert page["pagination"]["hasNextPage"]
+    page = mirror.search_reports("2024-02-01", None, None, 2, 2)
+    assert [r["id"] for r in page["entities"]] == ["rpt-3", "rpt-2"]
+    assert not page["pagination"]["hasNextPage"]
+    assert [
+        r["id"]
+        for r in mirror.search_reports(None, None, "report 3", 10, 0)["entities"]
+    ] == ["rpt-3"]
+
+
+def test_stream_updates():
+    mirror = loaded_mirror()
+    opencti = FakeOpenCTI()
+    o = observable(1)
+    r = report(1, "2024-01-01T00:00:00Z", "Report 1")
+
+    # A new observable is read, and added
+    opencti.entities["obs-1"] = o
+    follow(
+        mirror,
+        opencti,
+        fake_stream(("1000-0", "create", {"data": stix(o, "ipv4-addr")})),
+    )
+    assert mirror.find("observable", ["10.0.0.1"]) == [o]
+
+    # Adding the observable to a report changes the observable's reports, so it is read again
+    opencti.entities["rpt-1"] = r
+    opencti.entities["obs-1"] = dict(o, reports=[{"name": "Report 1"}])
+    patch = {
+        "patch": [{"op": "add", "path": "/object_refs/0", "value": o["standard_id"]}]
+    }
+    opencti.reads.clear()
+    follow(
+        mirror,
+        opencti,
+        fake_stream(
+            ("2000-0", "update", {"data": stix(r, "report"), "context": patch}),
+        ),
+    )
+    assert opencti.reads == ["rpt-1", "obs-1"]
+    assert mirror.find("observable", ["obs-1"])[0]["reports"] == [{"name": "Report 1"}]
+    assert mirror.find("report", ["report--1"])[0]["name"] == "Report 1"
+
+    # Events for entities which aren't mirrored are skipped
+    opencti.reads.clear()
+    follow(
+        mirror,
+        opencti,
+        fake_stream(
+            ("3000-0", "create", {"data": {"id": "malware--1", "type": "malware"}})
+        ),
+    )
+    assert opencti.reads == []
+
+    # Deleted entities are dropped, along with the terms they're found by
+    follow(
+        mirror,
+        opencti,
+        fake_stream(("4000-0", "delete", {"data": stix(o, "ipv4-addr")})),
+    )
+    assert mirror.find("observable", ["10.0.0.1", "obs-1"]) == []
+
+    assert mirror.last_event_id == "4000-0"
+    assert mirror.stats()["events"] == 4
+
+
+def test_freshness():
+    mirror = Mirror(None, "http://opencti")
+    assert mirror.lag() is None and not mirror.fresh()
+
+    mirror.set_meta(loaded=1, last_event_id="0-0", synced_at=time.time() - 3600)
+    assert mirror.lag() >= 3600
+    assert not mirror.fresh()
+
+    # A heartbeat means the stream has caught up
+    follow(mirror, FakeOpenCTI(), ["event: heartbeat", "data: now", ""])
+    assert mirror.lag() < MirrorConfig.max_lag
+    assert mirror.fresh()
+
+    # An event's Id gives the time it happened
+    stale = int((time.time() - 3600) * 1000)
+    follow(
+        mirror,
+        FakeOpenCTI(),
+        fake_stream(
+            (f"{stale}-0", "create", {"data": {"id": "x--1", "type": "malware"}})
+        ),
+    )
+    assert not mirror.fresh()
+
+
+def test_checkpoint_survives_restart(tmp_path):
+    path = str(tmp_path / "mirror.sqlite")
+    mirror = Mirror(path, "http://opencti")
+    mirror.upsert("observable", [observable(1)])
+    mirror.set_meta(loaded=1, last_event_id="5000-0", synced_at=time.time())
+    mirror.db.close()
+
+    mirror = Mirror(path, "http://opencti")
+    assert mirror.loaded
+    assert mirror.last_event_id == "5000-0"
+    assert mirror.find("observable", ["10.0.0.1"])
+
+    # The mirror of another platform is thrown away
+    mirror.db.close()
+    mirror = Mirror(path, "http://other")
+    assert not mirror.loaded
+    assert mirror.find("observable", ["10.0.0.1"]) == []
@@ -0,0 +1,123 @@
+import asyncio
+
+import pytest
+
+from pycti_mcp.cache import get_negative_cache, get_response_cache, make_key
+from pycti_mcp.entity_store import get_entity_store
+from pycti_mcp.executor import ExecutorConfig
+from pycti_mcp.pycti_tools import lookup_observables_bulk
+
+
+def observable(n, value):
+    return {
+        "observable_value": value,
+        "id": f"obs-{n}",
+        "standard_id": f"file--{n}",
+        "entity_type": "StixFile",
+        "x_opencti_description": None,
+        "created_at": "2024-01-01T00:00:00Z",
+        "updated_at": "2024-01-01T00:00:00Z",
+        "objectLabel": [],
+    }
+
+
+class FakePool:
+    """Stands in for the client pool, answering each list_observables() call with the
+    observables matching its values, after a moment, and counting the calls in progress
+    """
+
+    def __init__(self, observables, failing=()):
+        self.observables = observables
+        self.failing = failing
+        self.chunks = []
+        self.running = 0
+        self.max_running = 0
+
+    async def run(self, fn, values, detail):
+        self.chunks.append(values)
+        self.running += 1
+        self.max_running = max(self.max_running, self.running)
+        await asyncio.sleep(0.01)
+        self.running -= 1
+        if set(values) & set(self.failing):
+            raise ValueError("Upstream failure")
+        return [
+            o
+            for o in self.observables
+            if {o["id"], o["standard_id"], o["observable_value"].casefold()}
+            & {v.casefold() for v in values}
+        ]
+
+
+@pytest.fixture(autouse=True)
+def small_batches(monkeypatch):
+    monkeypatch.setattr(ExecutorConfig, "batch_size", 2)
+    monkeypatch.setattr(
+        lookup_observables_bulk.OpenCTIConfig, "opencti_url", "http://opencti"
+    )
+    get_response_cache().clear()
+    get_negative_cache().clear()
+    get_entity_store().clear()
+
+
+# Returns a function looking up the values through the given pool
+@pytest.fixture
+def lookup(monkeypatch, context):
+    def lookup(pool, values):
+        monkeypatch.setattr(
+            lookup_observables_bulk, "get_client_pool", lambda url, key: pool
+        )
+        return asyncio.run(
+            lookup_observables_bulk.opencti_observable_bulk_lookup(
+                values, context, detail="summary"
+            )
+        )
+
+    return lookup
+
+
+def test_values_are_looked_up_in_concurrent_batches(lookup):
+    pool = FakePool([observable(1, "abcd"), observable(2, "10.0.0.2")])
+    values = ["ABCD", "obs-1", "file--2", "nothing", "ABCD", "10.0.0.2"]
+    results = lookup(pool, values)
+
+    # The distinct values, in batches which all run at once
+    assert pool.chunks == [["ABCD", "obs-1"], ["file--2", "nothing"], ["10.0.0.2"]]
+    assert pool.max_running == 3
+
+    # One entry for each distinct value, in order, whether it was given as the value (in any
+    # case), OpenCTI Id, or STIX Id
+    assert [r["observable"] for r in results] == values[:4] + ["10.0.0.2"]
+    assert [r["found"] for r in results] == [True, True, True, False, True]
+    assert [r["result"]["opencti_id"] for r in results if r["found"]] == [
+        "obs-1",
+        "obs-1",
+        "obs-2",
+        "obs-2",
+    ]
+
+    # Each is cached for the single lookup, and the next bulk lookup asks only for the rest
+    hit, cached = get_response_cache().get(
+        make_key("opencti_observable_lookup", "file--2", "summary")
+    )
+    assert hit and cached["observable_value"] == "10.0.0.2"
+    pool.chunks = []
+    lookup(pool, ["obs-1", "obs-3"])
+    assert pool.chunks == [["obs-3"]]
+
+
+def test_failed_batches(lookup):
+    pool = FakePool([observable(1, "a"), observable(3, "c")], failing=["b"])
+    results = lookup(pool, ["a", "b", "c"])
+
+    # The values in the failed batch get its error, and aren't cached
+    assert [r["found"] for r in results] == [False, False, True]
+    assert [r.get("error") for r in results] == ["Upstream failure"] * 2 + [None]
+    assert get_response_cache().get(
+        make_key("opencti_observable_lookup", "b", "summary")
+    ) == (False, None)
+    assert not get_negative_cache().get(make_key("opencti_observable_lookup", "b"))[0]
+
+    # If every batch fails, so does the lookup
+    with pytest.raises(ValueError):
+        lookup(FakePool([], failing=["d"]), ["d"])
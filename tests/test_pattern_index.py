@@ -0,0 +1,91 @@
+import asyncio
+
+from pycti_mcp.pattern_index import PatternIndex, PatternIndexConfig
+from pycti_mcp.pycti_tools.lookup_indicators import pattern_matches
+
+
+def indicator(id_, pattern, pattern_type, updated_at="2024-01-01T00:00:00Z"):
+    return {
+        "id": id_,
+        "pattern": pattern,
+        "pattern_type": pattern_type,
+        "updated_at": updated_at,
+    }
+
+
+class FakePool:
+    """Stands in for the client pool, serving the pages of indicators updated since a time"""
+
+    def __init__(self, indicators):
+        self.indicators = indicators
+        self.requests = []
+
+    async def run(self, fn, since, after):
+        self.requests.append(since)
+        found = [i for i in self.indicators if not since or i["updated_at"] >= since]
+        return {"entities": found, "pagination": {"hasNextPage": False}}
+
+
+def test_candidates():
+    index = PatternIndex(None, "http://opencti")
+    index.upsert(
+        [
+            indicator("ind-1", "rule Evil_1 { condition: true }", "yara"),
+            indicator("ind-2", "[file:name = 'evil_2.exe']", "stix"),
+            indicator("ind-3", "title: Evil Sigma", "Sigma"),
+        ]
+    )
+
+    assert sorted(index.candidates(["EVIL"], [])) == ["ind-1", "ind-2", "ind-3"]
+    assert index.candidates(["evil", "rule"], []) == ["ind-1"]
+    assert sorted(index.candidates(["evil"], ["stix", "sigma"])) == ["ind-2", "ind-3"]
+    assert index.candidates(["evil"], ["snort"]) == []
+    # Quotes in the search strings are matched literally
+    assert index.candidates(["= 'evil"], []) == ["ind-2"]
+
+    # Strings too short to be indexed are left to be verified, and can't narrow a search down
+    assert sorted(index.candidates(["evil", "tr"], [])) == ["ind-1", "ind-2", "ind-3"]
+    assert index.candidates(["tr"], []) is None
+
+    # An indicator whose pattern changes is moved to its new pattern type's partition
+    index.upsert([indicator("ind-1", "alert tcp any any", "snort")])
+    assert index.candidates(["evil"], ["yara"]) == []
+    assert index.candidates(["alert"], ["snort"]) == ["ind-1"]
+
+
+def test_too_many_candidates(monkeypatch):
+    monkeypatch.setattr(PatternIndexConfig, "max_candidates", 2)
+    index = PatternIndex(None, "http://opencti")
+    index.upsert([indicator(f"ind-{n}", f"rule evil_{n}", "yara") for n in range(3)])
+    assert index.candidates(["evil_1"], []) == ["ind-1"]
+    assert index.candidates(["evil"], []) is None
+
+
+def test_refresh_is_incremental(tmp_path):
+    pool = FakePool(
+        [
+            indicator("ind-1", "rule a", "yara", "2024-01-01T00:00:00Z"),
+            indicator("ind-2", "rule b", "yara", "2024-01-02T00:00:00Z"),
+        ]
+    )
+    path = str(tmp_path / "patterns.sqlite")
+    index = PatternIndex(path, "http://opencti")
+    asyncio.run(index.refresh(pool))
+    assert index.loaded
+    assert index.last_updated == "2024-01-02T00:00:00Z"
+
+    # A restarted server resumes from where the index got to
+    index.db.close()
+    index = PatternIndex(path, "http://opencti")
+    pool.indicators.append(indicator("ind-3", "rule c", "yara", "2024-01-03T00:00:00Z"))
+    asyncio.run(index.refresh(pool))
+    assert pool.requests == [None, "2024-01-02T00:00:00Z"]
+    assert sorted(index.candidates(["rule"], [])) == ["ind-1", "ind-2", "ind-3"]
+
+
+def test_pattern_matches():
+    i = indicator("ind-1", "rule Evil_1 { condition: true }", "yara")
+    assert pattern_matches(i, ["evil", "TR"], [])
+    assert pattern_matches(i, ["evil"], ["YARA", "stix"])
+    assert not pattern_matches(i, ["evil", "false"], [])
+    assert not pattern_matches(i, ["evil"], ["stix"])
@@ -0,0 +1,234 @@
+# Checks that each lookup tool's projections and parsers agree: parsing must only read fields
+# that the projection fetched, and every field the projection fetches (at any depth) must be
+# read.
+import re
+
+import pytest
+
+from pycti_mcp.projection import profile_needs
+from pycti_mcp.pycti_tools import (
+    lookup_adversary,
+    lookup_indicators,
+    lookup_observables,
+    lookup_reports,
+)
+
+
+class StrictDict(dict):
+    """A dict which raises KeyError on reads of missing keys and records the keys read"""
+
+    def __init__(self, *args):
+        super().__init__(*args)
+        self.read = set()
+
+    def __getitem__(self, key):
+        self.read.add(key)
+        return super().__getitem__(key)
+
+    def __contains__(self, key):
+        self.read.add(key)
+        return super().__contains__(key)
+
+
+# Build an object shaped like one fetched with the given needs, as flattened by pycti.
+# Fragment fields are merged into the enclosing object, and connections become lists. A list
+# whose entries can be of several types (selected with fragments) has an entry with every
+# fragment's fields, and one without each fragment's.
+def sample(needs):
+    obj = StrictDict()
+    for f in needs:
+        if isinstance(f, str):
+            obj[f] = f
+        elif f.fragment:
+            obj.update(sample(f.fields))
+        elif f.many:
+            fragments = [n for n in f.fields if not isinstance(n, str) and n.fragment]
+            kinds = [f.fields] + [
+                [n for n in f.fields if n is not m] for m in fragments
+            ]
+            obj[f.key()] = [sample(fields) for fields in kinds]
+        else:
+            obj[f.key()] = sample(f.fields)
+    return obj
+
+
+def merge_tree(into, tree):
+    for key, sub in tree.items():
+        if sub is None:
+            into.setdefault(key, None)
+        else:
+            into[key] = merge_tree(into.get(key) or {}, sub)
+    return into
+
+
+# The fields in the needs, as a tree of dicts of each field (by its alias, if it has one) to
+# its own fields (None for plain fields), shaped as pycti returns them
+def needs_tree(needs):
+    tree = {}
+    for f in needs:
+        if isinstance(f, str):
+            tree.setdefault(f, None)
+        elif f.fragment:
+            merge_tree(tree, needs_tree(f.fields))
+        else:
+            merge_tree(tree, {f.key(): needs_tree(f.fields)})
+    return tree
+
+
+# The fields a rendered projection selects, as a tree like needs_tree(), with inline fragments
+# merged into the enclosing object and each connection's edges and nodes flattened
+def selected_tree(projection):
+    tokens = re.findall(r"\.\.\. on \w+|(?:\w+: )?\w+(?:\([^)]*\))?|[{}]", projection)
+
+    def selection(i):
+        tree = {}
+        while i < len(tokens) and tokens[i] != "}":
+            token = tokens[i]
+            sub = None
+            if i + 1 < len(tokens) and tokens[i + 1] == "{":
+                sub, i = selection(i + 2)
+            else:
+                i += 1
+            if token.startswith("..."):
+                merge_tree(tree, sub)
+                continue
+            if sub is not None and list(sub) == ["edges"]:
+                sub = sub["edges"]["node"]
+            merge_tree(tree, {re.match(r"\w+", token).group(): sub})
+        return tree, i + 1
+
+    return selection(0)[0]
+
+
+# The fields of a sample() object which the parser read, as a tree like needs_tree()
+def read_tree(obj):
+    tree = {}
+    for key in obj.read & set(obj):
+        value = obj[key]
+        if isinstance(value, StrictDict):
+            tree[key] = read_tree(value)
+        elif isinstance(value, list):
+            tree[key] = {}
+            for entry in value:
+                merge_tree(tree[key], read_tree(entry))
+        else:
+            tree[key] = None
+    return tree
+
+
+# The adversaries' reports are ordered before they are parsed
+def parse_adv(ta, detail="standard"):
+    return lookup_adversary.parse_adv(lookup_adversary.order_reports(ta), detail)
+
+
+# Each tool's outputs, profiles, parser, and the needs and projection its requests are made
+# with for a level of detail
+tools = {
+    "observable": (
+        lookup_observables.obs_outputs,
+        lookup_observables.obs_profiles,
+        lookup_observables.parse_obs,
+        lambda detail: profile_needs(
+            lookup_observables.obs_outputs, lookup_observables.obs_profiles[detail]
+        ),
+        lambda detail: lookup_observables.obs_projections[detail],
+    ),
+    "indicator": (
+        lookup_indicators.ind_outputs,
+        lookup_indicators.ind_profiles,
+        lookup_indicators.parse_indicator,
+        lambda detail: profile_needs(
+            lookup_indicators.ind_outputs,
+            lookup_indicators.ind_profiles[detail],
+            lookup_indicators.ind_base,
+        ),
+        lambda detail: lookup_indicators.ind_projections[detail],
+    ),
+    "report": (
+        lookup_reports.rpt_outputs,
+        lookup_reports.rpt_profiles,
+        lookup_reports.parse_rpt,
+        lambda detail: profile_needs(
+            lookup_reports.rpt_outputs, lookup_reports.rpt_profiles[detail]
+        ),
+        lambda detail: lookup_reports.rpt_projections[detail],
+    ),
+}
+for adv_type in lookup_adversary.adversary_types:
+    tools[adv_type] = (
+        lookup_adversary.adv_outputs,
+        lookup_adversary.adv_profiles,
+        parse_adv,
+        lambda detail, t=adv_type: lookup_adversary.adv_needs(t, detail),
+        lambda detail, t=adv_type: lookup_adversary.build_adversary_query(t, detail),
+    )
+
+cases = [
+    (tool, detail) for tool, (_, profiles, *_) in tools.items() for detail in profiles
+]
+
+# Fields which each tool fetches without parsing them: the indicators' names, which are used to
+# forget cached misses, and the Id of the report's author, which pycti needs to process it
+unparsed = {
+    "indicator": {"name": None},
+    "report": {"createdBy": {"id": None}},
+}
+
+
+@pytest.mark.parametrize("tool,detail", cases)
+def test_projection_matches_parser(tool, detail):
+    _, profiles, parse, needs, projection = tools[tool]
+    expected = needs_tree(needs(detail))
+
+    # The projection sent to OpenCTI selects exactly the fields needed
+    selected = selected_tree(projection(detail))
+    if tool in lookup_adversary.adversary_types:
+        selected = selected["AdversaryLookup"]["adversary"]
+    assert selected == expected
+
+    # Raises KeyError if the parser reads a field the projection doesn't fetch
+    obj = sample(needs(detail))
+    parsed = parse(obj, detail)
+    assert list(parsed)[: len(profiles[detail])] == profiles[detail]
+
+    # Every field fetched is read, however deeply nested
+    also = {k: v for k, v in unparsed.get(tool, {}).items() if k in obj}
+    assert merge_tree(read_tree(obj), also) == expected
+
+
+@pytest.mark.parametrize("tool", list(tools))
+def test_standard_is_default(tool):
+    outputs, profiles, parse, *_ = tools[tool]
+    obj = sample(profile_needs(outputs, profiles["standard"]))
+    assert parse(obj) == parse(obj, "standard")
+
+
+@pytest.mark.parametrize("tool", list(tools))
+def test_profiles_are_nested(tool):
+    _, profiles, *_ = tools[tool]
+    assert set(profiles["summary"]) <= set(profiles["standard"])
+    assert set(profiles["standard"]) <= set(profiles["full"])
+
+
+# A connection as OpenCTI returns it, which pycti leaves as is for some fields
+def raw_connection(*nodes):
+    return {"edges": [{"node": node} for node in nodes]}
+
+
+@pytest.mark.parametrize("tool", ["observable", "intrusion_set"])
+def test_unflattened_containers(tool):
+    _, _, parse, needs, _ = tools[tool]
+    obj = sample(needs("full"))
+    for field in ["cases", "groupings"]:
+        obj[field] = raw_connection(
+            {
+                "name": f"A {field[:-1]}",
+                "externalReferences": raw_connection({"url": "https://example.com"}),
+            }
+        )
+
+    parsed = parse(obj, "full")
+    for field in ["cases", "groupings"]:
+        assert parsed[field] == [
+            {"name": f"A {field[:-1]}", "urls": ["https://example.com"]}
+        ]
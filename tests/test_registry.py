@@ -0,0 +1,56 @@
+import asyncio
+import subprocess
+import sys
+
+from fastmcp import FastMCP
+
+from pycti_mcp import encoding
+from pycti_mcp.registry import (
+    build_registry,
+    load_tool,
+    read_registry,
+    register_lazy_tools,
+)
+
+
+def listed_tools(mcp):
+    tools = asyncio.run(mcp.get_tools())
+    return sorted(
+        (t.to_mcp_tool().model_dump() for t in tools.values()),
+        key=lambda t: t["name"],
+    )
+
+
+def test_registry_is_up_to_date():
+    # If this fails, regenerate the registry with "python -m pycti_mcp.registry"
+    assert read_registry() == build_registry()
+
+    # The tools listed from the registry are listed just as the tools themselves would be
+    lazy = FastMCP("lazy")
+    register_lazy_tools(lazy, "", "", read_registry())
+    eager = FastMCP("eager")
+    for spec in read_registry():
+        eager.add_tool(load_tool(spec["module"], "", ""))
+    assert listed_tools(lazy) == listed_tools(eager)
+
+
+def test_tool_output_encoding():
+    # The tools' responses are encoded by pycti_mcp.encoding rather than by FastMCP
+    tool = load_tool("lookup_observables", "", "")
+    assert tool.serializer is encoding.dumps_str
+
+
+def test_startup_imports():
+    # Starting the server and listing its tools imports neither pycti nor the tools
+    script = """
+import asyncio, sys
+from fastmcp import FastMCP
+from pycti_mcp.mcp_server_octi import register_tools
+
+mcp = FastMCP("test")
+register_tools(mcp, "http://localhost:8080", "key")
+assert len(asyncio.run(mcp.get_tools())) == 7
+for module in ["pycti", "requests", "pycti_mcp.pycti_tools.lookup_adversary"]:
+    assert module not in sys.modules, module
+"""
+    subprocess.run([sys.executable, "-c", script], check=True)
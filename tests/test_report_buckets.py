@@ -0,0 +1,156 @@
+import asyncio
+
+import pytest
+
+from pycti_mcp.cache import get_response_cache
+from pycti_mcp.report_buckets import (
+    ReportBucketConfig,
+    bucket_ttl,
+    day_range,
+    search_reports,
+)
+
+
+def report(id_, published):
+    return {"id": id_, "published": published}
+
+
+class FakePool:
+    """Stands in for the client pool and OpenCTI, serving the reports published in a range,
+    newest first"""
+
+    def __init__(self, reports):
+        self.reports = reports
+        self.requests = []
+        self.report = self
+
+    async def run(self, fn, *args):
+        return fn(self, *args)
+
+    def list(self, filters, first, **kwargs):
+        start, end = (f["values"][0][:10] for f in filters["filters"])
+        found = sorted(
+            (r for r in self.reports if start <= r["published"] < end),
+            key=lambda r: r["published"],
+            reverse=True,
+        )
+        self.requests.append((start, end))
+        return {
+            "entities": found[:first],
+            "pagination": {"hasNextPage": False, "globalCount": len(found)},
+        }
+
+
+@pytest.fixture(autouse=True)
+def empty_cache():
+    get_response_cache().clear()
+
+
+def search(pool, earliest, latest, first=10, offset=0):
+    page = asyncio.run(
+        search_reports(pool, earliest, latest, None, "standard", [], first, offset)
+    )
+    if page is None:
+        return None
+    return [r["id"] for r in page["entities"]], page["pagination"]
+
+
+def test_ranges_are_assembled_from_days():
+    pool = FakePool(
+        [
+            report("rpt-1", "2024-03-01T08:00:00Z"),
+            report("rpt-2", "2024-03-02T08:00:00Z"),
+            report("rpt-3", "2024-03-02T20:00:00Z"),
+            report("rpt-4", "2024-03-04T08:00:00Z"),
+        ]
+    )
+    assert search(pool, "2024-03-01", "2024-03-03")[0] == ["rpt-3", "rpt-2", "rpt-1"]
+    assert pool.requests == [("2024-03-01", "2024-03-04")]
+
+    # Overlapping ranges only fetch the days not already cached, in a single query
+    assert search(pool, "2024-03-02", "2024-03-05")[0] == ["rpt-4", "rpt-3", "rpt-2"]
+    assert pool.requests[1:] == [("2024-03-04", "2024-03-06")]
+    assert search(pool, "2024-03-01", "2024-03-05")[0] == [
+        "rpt-4",
+        "rpt-3",
+        "rpt-2",
+        "rpt-1",
+    ]
+    assert len(pool.requests) == 2
+
+    # The first and last days are only partly in the range, as given to the hour
+    assert search(pool, "2024-03-02T12:00:00Z", "2024-03-04T09:00:00+02:00")[0] == [
+        "rpt-3"
+    ]
+    assert len(pool.requests) == 2
+
+
+def test_only_missing_days_are_fetched():
+    pool = FakePool(
+        [report(f"rpt-{n}", f"2024-03-{1 + n:02d}T00:00:00Z") for n in range(6)]
+    )
+    search(pool, "2024-03-03", "2024-03-04")
+    # The days either side of those cached are fetched a run at a time, and those cached aren't
+    assert search(pool, "2024-03-01", "2024-03-06")[0] == [
+        "rpt-5",
+        "rpt-4",
+        "rpt-3",
+        "rpt-2",
+        "rpt-1",
+        "rpt-0",
+    ]
+    assert pool.requests == [
+        ("2024-03-03", "2024-03-05"),
+        ("2024-03-01", "2024-03-03"),
+        ("2024-03-05", "2024-03-07"),
+    ]
+
+
+def test_days_with_many_reports_are_left_to_opencti(monkeypatch):
+    monkeypatch.setattr(ReportBucketConfig, "max_reports", 2)
+    pool = FakePool(
+        [report(f"rpt-{n}", f"2024-03-{1 + n:02d}T00:00:00Z") for n in range(3)]
+    )
+    # The reports are counted from the first page of the days, which isn't cached
+    assert search(pool, "2024-03-01", "2024-03-03") is None
+    assert pool.requests == [("2024-03-01", "2024-03-04")]
+
+    # Only the reports of the days not yet cached count
+    assert search(pool, "2024-03-02", "2024-03-03")[0] == ["rpt-2", "rpt-1"]
+    assert search(pool, "2024-03-01", "2024-03-03")[0] == ["rpt-2", "rpt-1", "rpt-0"]
+    assert pool.requests[1:] == [
+        ("2024-03-02", "2024-03-04"),
+        ("2024-03-01", "2024-03-02"),
+    ]
+
+
+def test_pages():
+    pool = FakePool(
+        [report(f"rpt-{n}", f"2024-03-{1 + n:02d}T00:00:00Z") for n in range(5)]
+    )
+    ids, pagination = search(pool, "2024-03-01", "2024-03-10", first=2)
+    assert ids == ["rpt-4", "rpt-3"]
+    assert pagination == {"hasNextPage": True, "endCursor": "buckets:2"}
+    ids, pagination = search(pool, "2024-03-01", "2024-03-10", first=2, offset=4)
+    assert ids == ["rpt-0"]
+    assert not pagination["hasNextPage"]
+    assert len(pool.requests) == 1
+
+
+def test_day_range(monkeypatch):
+    assert day_range("2024-02-28", "2024-03-01T23:00:00-02:00") == [
+        "2024-03-02",
+        "2024-03-01",
+        "2024-02-29",
+        "2024-02-28",
+    ]
+    # Ranges without a start, or too long to be worth it, are left to OpenCTI
+    assert day_range(None, "2024-03-01") is None
+    monkeypatch.setattr(ReportBucketConfig, "max_days", 30)
+    assert day_range("2024-01-01", "2024-03-01") is None
+
+
+def test_bucket_ttl():
+    # Days long past change rarely, so are kept for longer
+    assert bucket_ttl("2024-03-01") == ReportBucketConfig.closed_ttl
+    assert bucket_ttl("2999-03-01") < ReportBucketConfig.closed_ttl
@@ -0,0 +1,74 @@
+import asyncio
+
+import pytest
+
+from pycti_mcp.budget import encoded_size
+from pycti_mcp.cache import get_negative_cache, get_response_cache, make_key
+from pycti_mcp.pycti_tools import lookup_report_contents
+from pycti_mcp.pycti_tools.lookup_report_contents import fit_contents
+
+
+def contents(*names):
+    return {
+        "report": {"opencti_id": "rpt-1", "stix_id": "report--1", "name": "Report"},
+        "total": len(names),
+        "objects": [{"entity_type": "Malware", "name": name} for name in names],
+        "has_more": False,
+        "next_cursor": None,
+    }
+
+
+class FakeOpenCTI:
+    """Stands in for pycti, knowing of no reports"""
+
+    def __init__(self):
+        self.queries = 0
+
+    def query(self, query, variables):
+        self.queries += 1
+        return {"data": {"report": None}}
+
+
+@pytest.fixture(autouse=True)
+def empty_caches(monkeypatch):
+    monkeypatch.setattr(
+        lookup_report_contents.OpenCTIConfig, "opencti_url", "http://opencti"
+    )
+    get_response_cache().clear()
+    get_negative_cache().clear()
+
+
+def test_pages_cut_short_continue_from_the_last_object_kept():
+    page = contents("A" * 100, "B" * 100, "C" * 100)
+    two = encoded_size(dict(page, objects=[])) + 2 * encoded_size(page["objects"][0])
+    fitted = fit_contents(page, ["c1", "c2", "c3"], two)
+    assert [o["name"][0] for o in fitted["objects"]] == ["A", "B"]
+    assert fitted["truncated"] == {"objects": 1}
+    assert fitted["has_more"] and fitted["next_cursor"] == "c2"
+
+    # The first object is kept even over the budget, so the next page moves on from it
+    fitted = fit_contents(page, ["c1", "c2", "c3"], 10)
+    assert [o["name"][0] for o in fitted["objects"]] == ["A"]
+    assert fitted["next_cursor"] == "c1"
+
+    assert fit_contents(page, ["c1", "c2", "c3"], 0) == page
+
+
+def test_reports_not_found_are_cached_as_misses(monkeypatch, octi_pool, context):
+    octi = FakeOpenCTI()
+    monkeypatch.setattr(
+        lookup_report_contents, "get_client_pool", lambda url, key: octi_pool(octi)
+    )
+
+    def lookup(**kwargs):
+        return asyncio.run(
+            lookup_report_contents.opencti_report_contents("rpt-9", context, **kwargs)
+        )
+
+    assert lookup() is None
+    assert get_response_cache().stats()["entries"] == 0
+    assert get_negative_cache().get(make_key("opencti_report_contents", "rpt-9"))[0]
+
+    # The miss is found whatever the types, page size, or cursor asked for
+    assert lookup(entity_types=["Malware"], limit=10, cursor="c1") is None
+    assert octi.queries == 1
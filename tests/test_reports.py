@@ -0,0 +1,162 @@
+import asyncio
+
+import pytest
+
+from pycti_mcp.cache import get_response_cache
+from pycti_mcp.mirror import Mirror
+from pycti_mcp.pycti_tools import lookup_reports
+from pycti_mcp.pycti_tools.lookup_reports import count_alias, content_types
+
+
+def report(n):
+    return {
+        "standard_id": f"report--{n}",
+        "id": f"rpt-{n}",
+        "objectLabel": [],
+        "entity_type": "Report",
+        "description": "A report about something " * 10,
+        "name": f"Report {n}",
+        "created": "2024-03-01T00:00:00Z",
+        "modified": "2024-03-01T00:00:00Z",
+        "published": f"2024-03-{n + 1:02d}T00:00:00Z",
+        "report_types": ["threat-report"],
+        "externalReferences": [],
+    }
+
+
+# A report as the standard projection fetches it, and as the mirror keeps it
+def counted_report(n):
+    counts = {t: {"pageInfo": {"globalCount": 0}} for t in content_types}
+    counts["Indicator"]["pageInfo"]["globalCount"] = 1
+    return {**report(n), **{count_alias(t): c for t, c in counts.items()}}
+
+
+def full_report(n):
+    indicator = {
+        "id": f"ind-{n}",
+        "standard_id": f"indicator--{n}",
+        "entity_type": "Indicator",
+        "name": f"Indicator {n}",
+    }
+    return {
+        **counted_report(n),
+        "confidence": 50,
+        "createdBy": None,
+        "objects": [indicator],
+    }
+
+
+class FakeOpenCTI:
+    """Stands in for pycti, serving the reports newest first. A report's cursor is the offset
+    of the report after it."""
+
+    def __init__(self, count):
+        self.reports = [report(n) for n in reversed(range(count))]
+        self.ids = {rpt["id"] for rpt in self.reports}
+        self.queries = 0
+
+    def query(self, query, variables):
+        self.queries += 1
+        if variables.get("filters"):
+            # Full reports read by Id
+            ids = variables["filters"]["filters"][0]["values"]
+            found = [full_report(int(i[4:])) for i in ids if i in self.ids]
+            return {
+                "data": {
+                    "reports": {
+                        "edges": [{"cursor": "", "node": rpt} for rpt in found],
+                        "pageInfo": {},
+                    }
+                }
+            }
+        offset = int(variables["after"] or 0)
+        nodes = self.reports[offset : offset + variables["first"]]
+        end = offset + len(nodes)
+        return {
+            "data": {
+                "reports": {
+                    "edges": [
+                        {"cursor": str(offset + n + 1), "node": node}
+                        for n, node in enumerate(nodes)
+                    ],
+                    "pageInfo": {
+                        "endCursor": str(end),
+                        "hasNextPage": end < len(self.reports),
+                        "globalCount": len(self.reports),
+                    },
+                }
+            }
+        }
+
+    def process_multiple(self, data, with_pagination=False):
+        return {
+            "entities": [edge["node"] for edge in data["edges"]],
+            "pagination": data["pageInfo"],
+        }
+
+
+@pytest.fixture
+def octi(monkeypatch, octi_pool):
+    get_response_cache().clear()
+    octi = FakeOpenCTI(7)
+    monkeypatch.setattr(lookup_reports.OpenCTIConfig, "opencti_url", "http://opencti")
+    monkeypatch.setattr(
+        lookup_reports, "get_client_pool", lambda url, key: octi_pool(octi)
+    )
+    return octi
+
+
+def lookup(context, cursor=None, max_bytes=0):
+    return asyncio.run(
+        lookup_reports.opencti_reports_lookup(
+            context, limit=3, cursor=cursor, detail="summary", max_bytes=max_bytes
+        )
+    )
+
+
+def all_pages(context, max_bytes):
+    names, truncated, cursor = [], 0, None
+    while True:
+        result = lookup(context, cursor, max_bytes)
+        names += [rpt["name"] for rpt in result["reports"]]
+        truncated += result.get("truncated", {}).get("reports", 0)
+        if not result["has_more"]:
+            return names, truncated
+        cursor = result["next_cursor"]
+
+
+def test_pages_cut_short_continue_from_the_last_report_kept(octi, context):
+    everything = [f"Report {n}" for n in reversed(range(7))]
+    names, truncated = all_pages(context, 1000)
+    assert truncated and names == everything
+    assert all_pages(context, 0) == (everything, 0)
+
+    # A cached page cut short to fit continues from the same report as it would from OpenCTI
+    queries = octi.queries
+    from_cache = lookup(context, max_bytes=1000)
+    assert octi.queries == queries
+    get_response_cache().clear()
+    assert lookup(context, max_bytes=1000) == from_cache
+    assert from_cache["truncated"] and from_cache["next_cursor"] != "3"
+
+
+def test_full_reports_from_the_mirror(octi, monkeypatch, context):
+    mirror = Mirror(None, "http://opencti")
+    mirror.upsert("report", [counted_report(n) for n in range(4)])
+    monkeypatch.setattr(lookup_reports, "fresh_mirror", lambda: mirror)
+    # A report deleted since the mirror was last updated
+    octi.ids.remove("rpt-2")
+
+    result = asyncio.run(
+        lookup_reports.opencti_reports_lookup(context, limit=3, detail="full")
+    )
+    # The reports are found in the mirror, which doesn't keep their objects, so those are read
+    # from OpenCTI, with a single request
+    assert octi.queries == 1
+    assert [rpt["name"] for rpt in result["reports"]] == ["Report 3", "Report 1"]
+    assert result["reports"][0]["objects"][0]["name"] == "Indicator 3"
+    assert result["reports"][0]["object_counts"] == {"Indicator": 1}
+    assert result["next_cursor"] == "mirror:3"
+
+    result = asyncio.run(lookup_reports.opencti_reports_lookup(context, limit=3))
+    assert octi.queries == 1 and len(result["reports"]) == 3
@@ -0,0 +1,111 @@
+import asyncio
+import os
+import signal
+import socket
+import subprocess
+import sys
+import time
+
+import pytest
+from fastmcp import Client
+
+from pycti_mcp.workers import Supervisor, WorkersConfig
+
+# Stands in for a worker: reports that it is ready, then answers each connection with its pid
+worker = """
+import os, socket, sys
+sock = socket.socket(fileno=int(sys.argv[1]))
+os.write(int(sys.argv[2]), b"1")
+while True:
+    conn, _ = sock.accept()
+    conn.sendall(str(os.getpid()).encode())
+    conn.close()
+"""
+
+
+def served_by(port):
+    with socket.create_connection(("127.0.0.1", port)) as conn:
+        return int(conn.recv(16))
+
+
+@pytest.fixture
+def supervisor(monkeypatch):
+    monkeypatch.setattr(WorkersConfig, "graceful_timeout", 1)
+    sock = socket.create_server(("127.0.0.1", 0))
+    supervisor = Supervisor(
+        sock,
+        lambda index, socket_fd, ready_fd: [
+            sys.executable,
+            "-c",
+            worker,
+            str(socket_fd),
+            str(ready_fd),
+        ],
+        workers=2,
+    )
+    supervisor.start()
+    yield supervisor, sock.getsockname()[1]
+    supervisor.stop()
+    sock.close()
+
+
+def test_workers_share_the_socket(supervisor):
+    supervisor, port = supervisor
+    pids = {proc.pid for proc in supervisor.workers.values()}
+    assert len(pids) == 2
+    assert served_by(port) in pids
+
+    # A restart replaces every worker, and the socket is served throughout
+    supervisor.restart()
+    new_pids = {proc.pid for proc in supervisor.workers.values()}
+    assert not pids & new_pids
+    assert served_by(port) in new_pids
+
+
+def test_exited_workers_are_replaced(supervisor):
+    supervisor, port = supervisor
+    crashed = supervisor.workers[1]
+    os.kill(crashed.pid, signal.SIGKILL)
+    crashed.wait()
+
+    supervisor.reap()
+    assert supervisor.workers[1].pid != crashed.pid
+    assert supervisor.workers[1].poll() is None
+
+    # Stopped workers are waited for, rather than left behind
+    procs = list(supervisor.workers.values())
+    supervisor.stop()
+    assert all(proc.poll() is not None for proc in procs)
+
+
+def test_workers_serve_the_tools(tmp_path):
+    # The real server, with the fastmcp and uvicorn installed, lists its tools from either worker
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        port = s.getsockname()[1]
+    server = subprocess.Popen(
+        [sys.executable, "-m", "pycti_mcp.mcp_server_octi", "-s", "-w", "2"]
+        + ["-p", str(port), "--graceful-timeout", "1"],
+        env={**os.environ, "FASTMCP_HOST": "127.0.0.1"},
+    )
+
+    async def list_tools():
+        async with Client(f"http://127.0.0.1:{port}/mcp/") as client:
+            return await client.list_tools()
+
+    try:
+        deadline = time.monotonic() + 60
+        while True:
+            try:
+                tools = asyncio.run(list_tools())
+                break
+            except Exception:
+                if time.monotonic() > deadline or server.poll() is not None:
+                    raise
+                time.sleep(0.5)
+        assert len(tools) == 7
+        # Each call is served without a session, so any worker can take it
+        assert len(asyncio.run(list_tools())) == 7
+    finally:
+        server.terminate()
+        assert server.wait(30) == 0